@@ -0,0 +1,338 @@
+# imports from packages
+import argparse
+import configargparse
+import contextlib
+import glob
+import h5py as h5
+import io
+import json
+import numpy as np
+import os
+import platform
+import resource
+import shutil
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+# imports from our code
+from ..duplicate_analysis.check_duplicates_utils import (
+    analyze_duplicates_between_two_files,
+    remove_duplicates_between_two_list_of_files,
+    remove_duplicates_from_single_list_of_files,
+    stream_duplicates_from_single_list_of_files,
+)
+from ..duplicate_analysis.mix_positives import mix_positives_and_negatives
+from ..hdf5_handling.retrieve_images import export_images_from_regex
+from ..utils.hdf5_utils import DEFAULT_CHUNK_TARGET_MB
+from .synthetic_corpus import generate_synthetic_corpora
+
+
+BENCHMARKS = {
+    "dedup_single": remove_duplicates_from_single_list_of_files,
+    "dedup_single_streaming": stream_duplicates_from_single_list_of_files,
+    "dedup_double": remove_duplicates_between_two_list_of_files,
+    "analyze": analyze_duplicates_between_two_files,
+    "mix_positives": mix_positives_and_negatives,
+    "retrieve_images": export_images_from_regex,
+}
+
+
+def parse_script_arguments():
+    parser = argparse.ArgumentParser()
+    parser = configargparse.ArgumentParser(
+        config_file_parser_class=configargparse.YAMLConfigFileParser,
+        parents=[parser],
+        add_help=False,
+    )
+
+    # config argparse
+    parser.add_argument("--config", is_config_file=True)
+
+    # where the synthetic corpora and outputs are written, and where the results go
+    parser.add_argument("--work_dir", type=str)
+    parser.add_argument("--output_path", type=str, default="benchmark_results.json")
+    parser.add_argument("--baseline_path", type=str, default=None)
+    parser.add_argument("--keep_files", action="store_true")
+
+    # synthetic corpus options
+    parser.add_argument("--num_rows", type=int, nargs="+", default=[1000, 4000, 16000])
+    parser.add_argument("--rows_per_file", type=int, default=1000)
+    parser.add_argument("--duplicate_rate", type=float, default=0.1)
+    parser.add_argument("--cross_duplicate_rate", type=float, default=0.1)
+    parser.add_argument("--positive_rate", type=float, default=0.2)
+    parser.add_argument("--num_channels", type=int, default=13)
+    parser.add_argument("--image_size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+
+    # benchmark options
+    parser.add_argument("--benchmarks", type=str, nargs="+", default=sorted(BENCHMARKS), choices=sorted(BENCHMARKS))
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--hash_type", type=str, default="sha256", choices=["sha256", "blake2b128"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--trace_memory", action="store_true")
+    parser.add_argument("--verbose", action="store_true")
+
+    args = parser.parse_args()
+    print(parser.format_values())
+
+    return args
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux; worker processes of the benchmarked function are counted separately
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak_rss / 1024.0, peak_children_rss / 1024.0
+
+
+def run_benchmark_in_process(name, kwargs, seed, trace_memory, verbose):
+    # runs in a fresh process, so the peak rss belongs to this benchmark alone
+    baseline_rss_mb, _ = get_peak_rss_mb()
+
+    # mix_positives samples with the global numpy generator; seeding keeps repeats comparable
+    np.random.seed(seed)
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        BENCHMARKS[name](**kwargs)
+    seconds = time.perf_counter() - start
+
+    result = {"seconds": seconds}
+    if trace_memory:
+        result["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    peak_rss_mb, peak_children_rss_mb = get_peak_rss_mb()
+    result["baseline_rss_mb"] = baseline_rss_mb
+    result["peak_rss_mb"] = peak_rss_mb
+    result["peak_children_rss_mb"] = peak_children_rss_mb
+
+    return result
+
+
+def get_directory_size(directory):
+    file_names = glob.glob(os.path.join(directory, "**"), recursive=True)
+    return sum(os.path.getsize(file_name) for file_name in file_names if os.path.isfile(file_name))
+
+
+def get_corpus_dirs(corpus_dir, single_file=False):
+    # source and target directories of a corpus, or of the same corpus written as one file per directory
+    suffix = "_single_file" if single_file else ""
+    return os.path.join(corpus_dir, "source" + suffix), os.path.join(corpus_dir, "target" + suffix)
+
+
+def get_benchmark_kwargs(name, args, corpus_dir, output_dir, corpus_stats):
+    source_dir, target_dir = get_corpus_dirs(corpus_dir=corpus_dir)
+    source_regex = os.path.join(source_dir, "*.hdf5")
+    target_regex = os.path.join(target_dir, "*.hdf5")
+
+    if name in ["dedup_single", "dedup_single_streaming"]:
+        return {
+            "regex": source_regex,
+            "save_dir": output_dir,
+            "chunk_size": args.rows_per_file,
+            "hash_type": args.hash_type,
+            "workers": args.workers,
+        }
+    if name == "dedup_double":
+        return {
+            "source_regex": source_regex,
+            "target_regex": target_regex,
+            "save_dir": output_dir,
+            "hash_type": args.hash_type,
+            "workers": args.workers,
+        }
+    if name == "analyze":
+        # analyze compares two files, so it runs on the corpora written as a single file each
+        source_dir, target_dir = get_corpus_dirs(corpus_dir=corpus_dir, single_file=True)
+        return {
+            "source_file_name": os.path.join(source_dir, "task_0.hdf5"),
+            "target_file_name": os.path.join(target_dir, "task_0.hdf5"),
+            "save_dir": output_dir,
+            "hash_type": args.hash_type,
+            "chunk_size": args.rows_per_file,
+        }
+    if name == "mix_positives":
+        # positives come from the source corpus, four negatives per positive from the target corpus
+        num_positives = max(2, min(corpus_stats["num_positive_source_rows"], corpus_stats["num_rows"] // 20))
+        num_positives -= num_positives % 2
+        return {
+            "args": argparse.Namespace(
+                pos_regex=source_regex,
+                neg_regex=target_regex,
+                save_dir=output_dir,
+                positive_samples=num_positives,
+                negative_samples=4 * num_positives,
+                chunk_size=5 * num_positives // 2,
+                compression=None,
+                target_file_size_mb=None,
+                write_workers=1,
+                chunk_target_mb=DEFAULT_CHUNK_TARGET_MB,
+                lazy=True,
+            ),
+        }
+    if name == "retrieve_images":
+        return {
+            "regex": source_regex,
+            "image_dir": output_dir,
+            "workers": max(args.workers, 1) * 4,
+        }
+
+    raise ValueError("Unknown benchmark: " + name)
+
+
+def run_benchmark(name, kwargs, output_dir, num_rows, args):
+    results = []
+    for repeat in range(args.repeats):
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            result = executor.submit(
+                run_benchmark_in_process,
+                name,
+                kwargs,
+                args.seed,
+                args.trace_memory,
+                args.verbose,
+            ).result()
+
+        result["benchmark"] = name
+        result["num_rows"] = num_rows
+        result["repeat"] = repeat
+        result["rows_per_second"] = num_rows / max(result["seconds"], 1e-9)
+        result["output_mb"] = get_directory_size(output_dir) / 2**20 if os.path.isdir(output_dir) else 0.0
+        results.append(result)
+
+        print(
+            "{:<24} rows: {:>8}  seconds: {:>9.3f}  rows/s: {:>11.1f}  peak rss: {:>8.1f} MB".format(
+                name, num_rows, result["seconds"], result["rows_per_second"], result["peak_rss_mb"]
+            )
+        )
+
+    if not args.keep_files and os.path.isdir(output_dir):
+        shutil.rmtree(output_dir)
+
+    return results
+
+
+def compare_with_baseline(results, baseline_path):
+    # ratio of baseline to current seconds (> 1 is faster now) for every benchmark and size in both runs
+    with open(baseline_path, "r") as baseline_file:
+        baseline = json.load(baseline_file)
+
+    def get_best_seconds(run_results):
+        best_seconds = {}
+        for result in run_results:
+            key = (result["benchmark"], result["num_rows"])
+            best_seconds[key] = min(best_seconds.get(key, np.inf), result["seconds"])
+        return best_seconds
+
+    current_seconds = get_best_seconds(results)
+    baseline_seconds = get_best_seconds(baseline["results"])
+
+    comparison = []
+    print("\nSpeedup against ", baseline_path)
+    for key in sorted(current_seconds):
+        if key in baseline_seconds:
+            speedup = baseline_seconds[key] / max(current_seconds[key], 1e-9)
+            comparison.append({"benchmark": key[0], "num_rows": key[1], "speedup": speedup})
+            print("{:<24} rows: {:>8}  speedup: {:>6.2f}x".format(key[0], key[1], speedup))
+
+    return comparison
+
+
+def get_environment():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "h5py": h5.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run_script():
+    args = parse_script_arguments()
+    assert args.work_dir is not None
+
+    results = []
+    corpora = []
+    for num_rows in args.num_rows:
+        corpus_dir = os.path.join(args.work_dir, "corpus_" + str(num_rows))
+        source_dir, target_dir = get_corpus_dirs(corpus_dir=corpus_dir)
+        if os.path.isdir(corpus_dir):
+            shutil.rmtree(corpus_dir)
+
+        start = time.perf_counter()
+        corpus_options = {
+            "num_rows": num_rows,
+            "duplicate_rate": args.duplicate_rate,
+            "cross_duplicate_rate": args.cross_duplicate_rate,
+            "positive_rate": args.positive_rate,
+            "seed": args.seed,
+            "num_channels": args.num_channels,
+            "image_size": args.image_size,
+        }
+        corpus_stats = generate_synthetic_corpora(
+            source_dir=source_dir,
+            target_dir=target_dir,
+            rows_per_file=args.rows_per_file,
+            **corpus_options,
+        )
+        corpus_stats["num_rows"] = num_rows
+        corpus_stats["corpus_mb"] = get_directory_size(corpus_dir) / 2**20
+        corpora.append(corpus_stats)
+
+        # the same rows in one file per corpus, so analyze scales with num_rows like the other benchmarks
+        if "analyze" in args.benchmarks:
+            single_file_source_dir, single_file_target_dir = get_corpus_dirs(corpus_dir=corpus_dir, single_file=True)
+            generate_synthetic_corpora(
+                source_dir=single_file_source_dir,
+                target_dir=single_file_target_dir,
+                rows_per_file=num_rows,
+                **corpus_options,
+            )
+        print("\nGenerated corpus of ", num_rows, "rows in ", round(time.perf_counter() - start, 2), "seconds")
+
+        for name in args.benchmarks:
+            output_dir = os.path.join(args.work_dir, "output_" + str(num_rows), name)
+            kwargs = get_benchmark_kwargs(
+                name=name,
+                args=args,
+                corpus_dir=corpus_dir,
+                output_dir=output_dir,
+                corpus_stats=corpus_stats,
+            )
+            results += run_benchmark(name=name, kwargs=kwargs, output_dir=output_dir, num_rows=num_rows, args=args)
+
+        if not args.keep_files:
+            shutil.rmtree(corpus_dir)
+            shutil.rmtree(os.path.join(args.work_dir, "output_" + str(num_rows)), ignore_errors=True)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": get_environment(),
+        "config": {key: value for key, value in vars(args).items() if key != "config"},
+        "corpora": corpora,
+        "results": results,
+    }
+    if args.baseline_path is not None:
+        report["comparison"] = compare_with_baseline(results=results, baseline_path=args.baseline_path)
+
+    output_dir = os.path.dirname(args.output_path)
+    if output_dir != "" and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    with open(args.output_path, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+
+    print("\nBenchmark results saved to: ", args.output_path)
+
+
+if __name__ == "__main__":
+    run_script()
@@ -0,0 +1,123 @@
+import numpy as np
+
+from ..utils.hdf5_utils import TaskFileWriter
+
+
+# same schema as the real corpus: 13 band 64 x 64 float images, labels and (lon, lat, lon, lat) bounds
+NUM_CHANNELS = 13
+IMAGE_SIZE = 64
+TILE_EXTENT = 0.0058
+GRID_WIDTH = 2000
+
+
+def get_row_ids(num_rows, duplicate_rate, first_id, rng, duplicate_pool=None):
+    # every row is generated from an integer id, so a duplicate is simply a repeated id; duplicates reuse
+    # ids of this corpus, or of duplicate_pool (e.g. the ids of another corpus) when it is given
+    num_duplicates = int(round(duplicate_rate * num_rows))
+    if duplicate_pool is None:
+        num_duplicates = min(num_duplicates, num_rows - 1) if num_rows > 0 else 0
+    num_unique = num_rows - num_duplicates
+
+    unique_ids = np.arange(first_id, first_id + num_unique, dtype=np.int64)
+    pool = unique_ids if duplicate_pool is None else np.asarray(duplicate_pool, dtype=np.int64)
+    duplicate_ids = pool[rng.integers(0, pool.shape[0], size=num_duplicates)] if num_duplicates > 0 else []
+
+    return rng.permutation(np.concatenate([unique_ids, np.asarray(duplicate_ids, dtype=np.int64)]))
+
+
+def get_labels(row_ids, seed, positive_rate):
+    # the first draw of every row's generator decides its label, see generate_rows
+    return np.array([np.random.default_rng([seed, row_id]).random() < positive_rate for row_id in row_ids.tolist()])
+
+
+def generate_rows(row_ids, seed, positive_rate, num_channels=NUM_CHANNELS, image_size=IMAGE_SIZE):
+    num_rows = row_ids.shape[0]
+    images = np.empty((num_rows, num_channels, image_size, image_size), dtype=np.float32)
+    labels = np.empty((num_rows, 1), dtype=np.float32)
+    bounds = np.empty((num_rows, 4), dtype=np.float64)
+
+    for i, row_id in enumerate(row_ids.tolist()):
+        rng = np.random.default_rng([seed, row_id])
+        labels[i, 0] = float(rng.random() < positive_rate)
+        # reflectance-like values: a per band level plus noise
+        levels = rng.uniform(500.0, 3000.0, size=(num_channels, 1, 1)).astype(np.float32)
+        images[i] = levels + rng.standard_normal((num_channels, image_size, image_size), dtype=np.float32) * 200.0
+
+    lon = 85.0 + (row_ids % GRID_WIDTH) * TILE_EXTENT
+    lat = 22.0 + (row_ids // GRID_WIDTH) * TILE_EXTENT
+    bounds[:, 0] = lon
+    bounds[:, 1] = lat
+    bounds[:, 2] = lon + TILE_EXTENT
+    bounds[:, 3] = lat + TILE_EXTENT
+
+    return {"images": images, "labels": labels, "bounds": bounds}
+
+
+def write_synthetic_corpus(
+    save_dir,
+    row_ids,
+    rows_per_file,
+    seed=0,
+    positive_rate=0.2,
+    num_channels=NUM_CHANNELS,
+    image_size=IMAGE_SIZE,
+    block_size=256,
+    compression=None,
+):
+    # writes task_<i>.hdf5 files of rows_per_file rows, generated block by block
+    with TaskFileWriter(save_dir=save_dir, chunk_size=rows_per_file, compression=compression) as writer:
+        for start in range(0, row_ids.shape[0], block_size):
+            writer.write(
+                slabs=generate_rows(
+                    row_ids=row_ids[start : start + block_size],
+                    seed=seed,
+                    positive_rate=positive_rate,
+                    num_channels=num_channels,
+                    image_size=image_size,
+                )
+            )
+
+        return writer.num_files
+
+
+def generate_synthetic_corpora(
+    source_dir,
+    target_dir,
+    num_rows,
+    rows_per_file,
+    duplicate_rate=0.1,
+    cross_duplicate_rate=0.1,
+    positive_rate=0.2,
+    seed=0,
+    num_channels=NUM_CHANNELS,
+    image_size=IMAGE_SIZE,
+    compression=None,
+):
+    # a source corpus with duplicate_rate duplicates within itself, and a target corpus of the same size
+    # whose rows repeat source rows at cross_duplicate_rate
+    rng = np.random.default_rng(seed)
+    source_ids = get_row_ids(num_rows=num_rows, duplicate_rate=duplicate_rate, first_id=0, rng=rng)
+    target_ids = get_row_ids(
+        num_rows=num_rows,
+        duplicate_rate=cross_duplicate_rate,
+        first_id=num_rows,
+        rng=rng,
+        duplicate_pool=source_ids,
+    )
+
+    options = {
+        "rows_per_file": rows_per_file,
+        "seed": seed,
+        "positive_rate": positive_rate,
+        "num_channels": num_channels,
+        "image_size": image_size,
+        "compression": compression,
+    }
+    write_synthetic_corpus(save_dir=source_dir, row_ids=source_ids, **options)
+    write_synthetic_corpus(save_dir=target_dir, row_ids=target_ids, **options)
+
+    return {
+        "num_unique_source_rows": int(np.unique(source_ids).shape[0]),
+        "num_target_rows_in_source": int(np.isin(target_ids, source_ids).sum()),
+        "num_positive_source_rows": int(get_labels(row_ids=source_ids, seed=seed, positive_rate=positive_rate).sum()),
+    }
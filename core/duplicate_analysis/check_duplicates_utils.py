@@ -1,10 +1,11 @@
 # import from general packages
 import numpy as np
-from hashlib import sha256
 import os
 from collections import defaultdict
 import h5py as h5
 import math
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 
 # import from our packages
@@ -12,29 +13,175 @@ from ..utils.hdf5_utils import (
     get_all_hdf5_files_from_regex,
     get_common_keys,
     open_hdf5_file,
+    HDF5FilePool,
     retrieve_datasets_from_hdf5_file,
+    TaskFileWriter,
+    get_chunk_size_for_target_file_size,
+    save_task_file,
+    DEFAULT_CHUNK_TARGET_MB,
+)
+from ..utils.instrumentation import get_nbytes, merge_worker_results, run_recording_stages, stage
+from ..utils.spatial_index import load_or_build_spatial_index
+from ..utils.virtual_corpus import VirtualCorpus
+from .digest_index import DigestIndex
+from .digest_set import DigestSet
+from .hash_utils import (
+    DEFAULT_BLOCK_SIZE,
+    hash_datasets_in_blocks,
+    iterate_row_blocks,
 )
 
 
-def hash_datasets(list_of_files, keys):
-    hash_strings = set()
+def hash_file(file, keys, hash_type="sha256", block_size=DEFAULT_BLOCK_SIZE, record_reads=False):
+    return hash_datasets_in_blocks(
+        datasets=file,
+        keys=keys,
+        num_datapoints=get_num_datapoints(datasets=file),
+        hash_type=hash_type,
+        block_size=block_size,
+        record_reads=record_reads,
+    )
 
-    for file in list_of_files:
-        num_datapoints = get_num_datapoints(datasets=file)
 
-        for i in range(num_datapoints):
-            hash_encoder = None
-            for key in keys:
-                if hash_encoder is None:
-                    hash_encoder = sha256(file[key][i])
-                else:
-                    hash_encoder.update(file[key][i])
+def select_digests(digests, unique_within_file):
+    if unique_within_file:
+        _, indices = np.unique(digests, return_index=True)
+        indices.sort()
+    else:
+        indices = np.arange(digests.shape[0])
+
+    return digests[indices], indices
+
+
+def hash_hdf5_file_from_path(file_name, keys, hash_type, block_size, unique_within_file):
+    # runs inside worker processes, so every worker opens its own h5py handle
+    with stage("open"):
+        file = open_hdf5_file(filepath=file_name, verbose=False)
+    try:
+        digests = hash_file(file=file, keys=keys, hash_type=hash_type, block_size=block_size, record_reads=True)
+    finally:
+        file.close()
 
-            hash_strings.add(hash_encoder.hexdigest())
+    return select_digests(digests=digests, unique_within_file=unique_within_file)
+
+
+def hash_list_of_files(
+    list_of_files,
+    keys,
+    hash_type="sha256",
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    unique_within_file=False,
+):
+    # returns one (digests, row indices) pair per file, in the same order as list_of_files (an HDF5FilePool)
+    num_rows = sum(list_of_files.get_num_datapoints(i, keys=keys) for i in range(len(list_of_files)))
+    num_bytes = sum(list_of_files.get_nbytes(i, keys=keys) for i in range(len(list_of_files)))
+
+    with stage("hash", rows=num_rows, nbytes=num_bytes):
+        if workers <= 1:
+            hashed_files = []
+            for file in list_of_files:
+                digests = hash_file(
+                    file=file, keys=keys, hash_type=hash_type, block_size=block_size, record_reads=True
+                )
+                hashed_files.append(select_digests(digests=digests, unique_within_file=unique_within_file))
+
+            return hashed_files
+
+        worker_function = partial(
+            run_recording_stages,
+            hash_hdf5_file_from_path,
+            keys=sorted(keys),
+            hash_type=hash_type,
+            block_size=block_size,
+            unique_within_file=unique_within_file,
+        )
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return merge_worker_results(worker_results=executor.map(worker_function, list_of_files.file_names))
+
+
+def hash_datasets(
+    list_of_files,
+    keys,
+    hash_type="sha256",
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    bloom_filter_bits=0,
+):
+    hash_strings = DigestSet(hash_type=hash_type, bloom_filter_bits=bloom_filter_bits)
+
+    hashed_files = hash_list_of_files(
+        list_of_files=list_of_files,
+        keys=keys,
+        hash_type=hash_type,
+        block_size=block_size,
+        workers=workers,
+        unique_within_file=True,
+    )
+    for digests, _ in hashed_files:
+        hash_strings.add(digests=digests)
 
     return hash_strings
 
 
+def get_first_occurrence_mask(digests, seen_digests):
+    return seen_digests.add(digests=digests)
+
+
+def hash_unique_digests_per_file(file_names, keys, hash_type, block_size, workers):
+    with HDF5FilePool(file_names=file_names) as list_of_files:
+        hashed_files = hash_list_of_files(
+            list_of_files=list_of_files,
+            keys=keys,
+            hash_type=hash_type,
+            block_size=block_size,
+            workers=workers,
+            unique_within_file=True,
+        )
+
+    return [digests for digests, _ in hashed_files]
+
+
+def load_digest_index(index_dir, list_of_files, keys, hash_type, block_size, workers):
+    digest_index = DigestIndex(index_dir=index_dir)
+    digest_index.update(
+        file_names=list_of_files.file_names,
+        keys=keys,
+        hash_type=hash_type,
+        hash_function=partial(
+            hash_unique_digests_per_file,
+            keys=keys,
+            hash_type=hash_type,
+            block_size=block_size,
+            workers=workers,
+        ),
+    )
+    print("Number of unique digests in index: ", len(digest_index), "\n")
+
+    return digest_index
+
+
+def get_first_occurrence_masks(list_of_files, keys, hash_type, block_size, workers):
+    hashed_files = hash_list_of_files(
+        list_of_files=list_of_files,
+        keys=keys,
+        hash_type=hash_type,
+        block_size=block_size,
+        workers=workers,
+        unique_within_file=True,
+    )
+
+    # merging in file order keeps the same first-occurrence semantics as the serial scan
+    seen_digests = DigestSet(hash_type=hash_type)
+    masks = []
+    for file_index, (digests, indices) in enumerate(hashed_files):
+        mask = np.zeros(list_of_files.get_num_datapoints(file_index), dtype=bool)
+        mask[indices[get_first_occurrence_mask(digests=digests, seen_digests=seen_digests)]] = True
+        masks.append(mask)
+
+    return masks
+
+
 def compare_datapoint(file_1, file_2, index_1, index_2, common_keys):
     is_duplicate = True
     for key in common_keys:
@@ -52,61 +199,96 @@ def compare_datapoint(file_1, file_2, index_1, index_2, common_keys):
 
 
 def put_duplicates_at_the_start_of_dsets(dsets_map, duplicate_indices, keys):
-    new_dsets_map = defaultdict(list)
-    for key in keys:
-        for index in duplicate_indices:
-            new_dsets_map[key].append(dsets_map[key][index])
-
     num_datapoints = get_num_datapoints(datasets=dsets_map)
-    for key in keys:
-        for index in range(num_datapoints):
-            if index not in duplicate_indices:
-                new_dsets_map[key].append(dsets_map[key][index])
+
+    duplicate_indices = np.asarray(duplicate_indices, dtype=np.int64)
+    is_duplicate = np.zeros(num_datapoints, dtype=bool)
+    is_duplicate[duplicate_indices] = True
+    new_order = np.concatenate([duplicate_indices, np.flatnonzero(~is_duplicate)])
 
     datasets = {}
     for key in keys:
-        datasets[key] = np.array(new_dsets_map[key])
+        datasets[key] = np.asarray(dsets_map[key])[new_order]
 
     return datasets
 
 
+def bucket_datapoints_by_hash(dsets, keys, hash_type="sha256"):
+    digests = hash_file(file=dsets, keys=keys, hash_type=hash_type)
+
+    buckets = defaultdict(list)
+    for index, digest in enumerate(digests.tolist()):
+        buckets[digest].append(index)
+
+    return buckets
+
+
+def find_duplicate_pairs(source_dsets, target_dsets, keys, hash_type="sha256"):
+    # hash join: only rows whose digests collide are compared exactly
+    num_rows = get_num_datapoints(datasets=source_dsets) + get_num_datapoints(datasets=target_dsets)
+    num_bytes = get_nbytes(datasets=source_dsets) + get_nbytes(datasets=target_dsets)
+    with stage("hash", rows=num_rows, nbytes=num_bytes):
+        source_buckets = bucket_datapoints_by_hash(dsets=source_dsets, keys=keys, hash_type=hash_type)
+        target_buckets = bucket_datapoints_by_hash(dsets=target_dsets, keys=keys, hash_type=hash_type)
+
+    duplicate_pairs = []
+    for digest, target_indices in target_buckets.items():
+        source_indices = source_buckets.get(digest)
+        if source_indices is None:
+            continue
+
+        for i in source_indices:
+            for j in target_indices:
+                if compare_datapoint(source_dsets, target_dsets, i, j, keys):
+                    duplicate_pairs.append((i, j))
+
+    # same order as a row-major scan over (source, target) pairs
+    duplicate_pairs.sort()
+    source_duplicate_indices = [pair[0] for pair in duplicate_pairs]
+    target_duplicate_indices = [pair[1] for pair in duplicate_pairs]
+
+    return source_duplicate_indices, target_duplicate_indices
+
+
 def convert_hdf5_file_to_map(file, keys):
     dset_map = {}
-    for key in keys:
-        dset_map[key] = np.array(file[key])
+    with stage("read") as span:
+        for key in keys:
+            dset_map[key] = np.array(file[key])
+        span.add(rows=get_num_datapoints(datasets=dset_map) or 0, nbytes=get_nbytes(datasets=dset_map))
 
     return dset_map
 
 
-def analyze_duplicates_between_two_files(source_file_name, target_file_name, save_dir):
+def analyze_duplicates_between_two_files(
+    source_file_name,
+    target_file_name,
+    save_dir,
+    hash_type="sha256",
+    chunk_size=0,
+    target_file_size_mb=None,
+):
     assert h5.is_hdf5(source_file_name) and h5.is_hdf5(target_file_name)
 
     print("Source filename: ", source_file_name)
     print("Target filename: ", target_file_name)
 
-    source_file = h5.File(source_file_name, "r")
-    target_file = h5.File(target_file_name, "r")
-
-    common_keys = get_common_keys(list_of_files=[source_file, target_file])
-    print("\nCommon keys between all hdf5 files: ", common_keys, "\n")
-
-    source_num_datapoints = get_num_datapoints(datasets=source_file)
-    target_num_datapoints = get_num_datapoints(datasets=target_file)
-
-    source_dsets = convert_hdf5_file_to_map(file=source_file, keys=common_keys)
-    target_dsets = convert_hdf5_file_to_map(file=target_file, keys=common_keys)
+    with HDF5FilePool(file_names=[source_file_name, target_file_name]) as hdf5_files:
+        source_file = hdf5_files[0]
+        target_file = hdf5_files[1]
 
-    source_file.close()
-    target_file.close()
+        common_keys = get_common_keys(list_of_files=hdf5_files)
+        print("\nCommon keys between all hdf5 files: ", common_keys, "\n")
 
-    source_file_duplicate_indices = []
-    target_file_duplicate_indices = []
+        source_dsets = convert_hdf5_file_to_map(file=source_file, keys=common_keys)
+        target_dsets = convert_hdf5_file_to_map(file=target_file, keys=common_keys)
 
-    for i in range(source_num_datapoints):
-        for j in range(target_num_datapoints):
-            if compare_datapoint(source_dsets, target_dsets, i, j, common_keys):
-                source_file_duplicate_indices.append(i)
-                target_file_duplicate_indices.append(j)
+    source_file_duplicate_indices, target_file_duplicate_indices = find_duplicate_pairs(
+        source_dsets=source_dsets,
+        target_dsets=target_dsets,
+        keys=common_keys,
+        hash_type=hash_type,
+    )
 
     print("Number of duplicates: ", len(source_file_duplicate_indices))
 
@@ -125,27 +307,66 @@ def analyze_duplicates_between_two_files(source_file_name, target_file_name, sav
     divide_and_save_dataset(
         datasets=source_dsets_modified,
         save_dir=os.path.join(save_dir, "source"),
-        chunk_size=0,
+        chunk_size=chunk_size,
+        target_file_size_mb=target_file_size_mb,
     )
 
     divide_and_save_dataset(
         datasets=target_dsets_modified,
         save_dir=os.path.join(save_dir, "target"),
-        chunk_size=0,
+        chunk_size=chunk_size,
+        target_file_size_mb=target_file_size_mb,
     )
 
 
-def remove_duplicates_between_two_list_of_files(source_regex, target_regex, save_dir):
-    source_hdf5_files = get_all_hdf5_files_from_regex(regex=source_regex, verbose=True)
-    target_hdf5_files = get_all_hdf5_files_from_regex(regex=target_regex, verbose=True)
-
-    common_keys = get_common_keys(list_of_files=source_hdf5_files + target_hdf5_files)
+def remove_duplicates_between_two_list_of_files(
+    source_regex,
+    target_regex,
+    save_dir,
+    hash_type="sha256",
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    index_dir=None,
+    bloom_filter_bits=0,
+    catalog=None,
+):
+    source_hdf5_files = get_all_hdf5_files_from_regex(regex=source_regex, verbose=True, catalog=catalog)
+    target_hdf5_files = get_all_hdf5_files_from_regex(regex=target_regex, verbose=True, catalog=catalog)
+
+    common_keys = get_common_keys(list_of_files=source_hdf5_files).intersection(
+        get_common_keys(list_of_files=target_hdf5_files)
+    )
     print("\nCommon keys between all hdf5 files: ", common_keys, "\n")
 
-    hash_strings_from_source_files = hash_datasets(
-        list_of_files=source_hdf5_files,
-        keys=common_keys,
-    )
+    if index_dir is None:
+        source_digests = hash_datasets(
+            list_of_files=source_hdf5_files,
+            keys=common_keys,
+            hash_type=hash_type,
+            block_size=block_size,
+            workers=workers,
+            bloom_filter_bits=bloom_filter_bits,
+        )
+    else:
+        source_digests = load_digest_index(
+            index_dir=index_dir,
+            list_of_files=source_hdf5_files,
+            keys=common_keys,
+            hash_type=hash_type,
+            block_size=block_size,
+            workers=workers,
+        )
+
+    target_digests = None
+    if workers > 1:
+        hashed_files = hash_list_of_files(
+            list_of_files=target_hdf5_files,
+            keys=common_keys,
+            hash_type=hash_type,
+            block_size=block_size,
+            workers=workers,
+        )
+        target_digests = [digests for digests, _ in hashed_files]
 
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
@@ -156,83 +377,213 @@ def remove_duplicates_between_two_list_of_files(source_regex, target_regex, save
         file = h5.File(file_path, "w")
 
         target_hdf5_file = target_hdf5_files[file_index]
-        num_datapoints = get_num_datapoints(datasets=target_hdf5_file)
+        num_datapoints = target_hdf5_files.get_num_datapoints(file_index)
         dsets = defaultdict(list)
 
-        for i in range(num_datapoints):
-            hash_encoder = None
+        for start, end in iterate_row_blocks(num_datapoints=num_datapoints, block_size=block_size):
+            slabs = {}
             for key in common_keys:
-                if hash_encoder is None:
-                    hash_encoder = sha256(target_hdf5_file[key][i])
-                else:
-                    hash_encoder.update(target_hdf5_file[key][i])
+                slabs[key] = target_hdf5_file[key][start:end]
 
-            hash_string = hash_encoder.hexdigest()
-            if hash_string not in hash_strings_from_source_files:
-                for key in common_keys:
-                    dsets[key].append(target_hdf5_file[key][i])
+            if target_digests is None:
+                digests = hash_file(file=slabs, keys=common_keys, hash_type=hash_type, block_size=block_size)
+            else:
+                digests = target_digests[file_index][start:end]
+            is_unique = ~source_digests.contains(digests=digests)
+
+            for key in common_keys:
+                dsets[key].append(slabs[key][is_unique])
 
         num_unique_elements = None
         for key in common_keys:
-            dataset = np.array(dsets[key])
+            dataset = np.concatenate(dsets[key]) if len(dsets[key]) > 0 else np.array([])
             if num_unique_elements is None:
                 num_unique_elements = dataset.shape[0]
             file.create_dataset(key, data=dataset)
 
+        file.close()
+        target_hdf5_files.close_file(file_index)
+
         print("\nNum total elements: ", num_datapoints)
         print("Num unique elements: ", num_unique_elements, "\n")
 
-    for hdf5_file_to_close in source_hdf5_files + target_hdf5_files:
-        hdf5_file_to_close.close()
+    source_hdf5_files.close()
+    target_hdf5_files.close()
+
+
+def remove_spatial_duplicates_between_two_list_of_files(
+    source_regex,
+    target_regex,
+    save_dir,
+    min_overlap=0.0,
+    spatial_index_path=None,
+    catalog=None,
+):
+    # drops every target row whose tile overlaps a source tile by at least min_overlap of the smaller tile
+    source_spatial_index = load_or_build_spatial_index(
+        regex=source_regex,
+        index_path=spatial_index_path,
+        catalog=catalog,
+    )
+    print("\nNumber of source tiles in spatial index: ", len(source_spatial_index), "\n")
+
+    target_hdf5_files = get_all_hdf5_files_from_regex(regex=target_regex, verbose=True, catalog=catalog)
+    common_keys = get_common_keys(list_of_files=target_hdf5_files)
+    print("\nCommon keys between all target hdf5 files: ", common_keys, "\n")
+
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+
+    for file_index in range(len(target_hdf5_files)):
+        target_hdf5_file = target_hdf5_files[file_index]
+        num_datapoints = target_hdf5_files.get_num_datapoints(file_index)
+
+        overlapping_indices, _ = source_spatial_index.query_overlaps(
+            boxes=target_hdf5_file["bounds"][:, :4],
+            min_overlap=min_overlap,
+        )
+        is_unique = np.ones(num_datapoints, dtype=bool)
+        is_unique[overlapping_indices] = False
 
+        file_name = "task_" + str(file_index) + ".hdf5"
+        file = h5.File(os.path.join(save_dir, file_name), "w")
+        for key in common_keys:
+            file.create_dataset(key, data=target_hdf5_file[key][()][is_unique])
+        file.close()
+        target_hdf5_files.close_file(file_index)
 
-def remove_duplicates_from_single_list_of_files(regex, save_dir, chunk_size):
-    hdf5_files = get_all_hdf5_files_from_regex(regex=regex)
+        print("\nNum total elements: ", num_datapoints)
+        print("Num elements without spatial overlap: ", int(is_unique.sum()), "\n")
+
+    target_hdf5_files.close()
+
+
+def remove_duplicates_from_single_list_of_files(
+    regex,
+    save_dir,
+    chunk_size,
+    hash_type="sha256",
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    compression=None,
+    target_file_size_mb=None,
+    write_workers=1,
+    chunk_target_mb=DEFAULT_CHUNK_TARGET_MB,
+    catalog=None,
+):
+    hdf5_files = get_all_hdf5_files_from_regex(regex=regex, catalog=catalog)
 
     common_keys = get_common_keys(list_of_files=hdf5_files)
     print("\nCommon keys between all hdf5 files: ", common_keys, "\n")
 
-    dedupped_datasets = defaultdict(list)
-    hash_of_datasets = set()
-    num_total_elements = 0
+    # hashing reads block by block, then only the first occurrences are read, straight into the output arrays
+    first_occurrence_masks = get_first_occurrence_masks(
+        list_of_files=hdf5_files,
+        keys=common_keys,
+        hash_type=hash_type,
+        block_size=block_size,
+        workers=workers,
+    )
 
-    for i in range(len(hdf5_files)):
-        print("Index of file being processed: ", i)
+    unique_indices = np.flatnonzero(np.concatenate([np.zeros(0, dtype=bool)] + first_occurrence_masks))
 
-        file = hdf5_files[i]
-        num_datapoints = get_num_datapoints(datasets=file)
-        dsets = {}
-        for key in common_keys:
-            dsets[key] = np.array(file[key])
+    corpus = VirtualCorpus(hdf5_files=hdf5_files, keys=common_keys)
+    dedupped_datasets = corpus.read_rows(global_indices=unique_indices)
+    corpus.close()
 
-        num_total_elements += num_datapoints
+    for key in common_keys:
+        print("key:", key, " shape unique elements: ", dedupped_datasets[key].shape)
 
-        for i in range(num_datapoints):
-            hash_encoder = None
-            for key in common_keys:
-                if hash_encoder is None:
-                    hash_encoder = sha256(dsets[key][i])
-                else:
-                    hash_encoder.update(dsets[key][i])
+    print("\nNumber of total elements (including duplicates): ", len(corpus), "\n")
 
-            hash_value = hash_encoder.hexdigest()
+    divide_and_save_dataset(
+        datasets=dedupped_datasets,
+        save_dir=save_dir,
+        chunk_size=chunk_size,
+        compression=compression,
+        target_file_size_mb=target_file_size_mb,
+        workers=write_workers,
+        chunk_target_mb=chunk_target_mb,
+    )
 
-            if hash_value not in hash_of_datasets:
-                hash_of_datasets.add(hash_value)
 
+def stream_duplicates_from_single_list_of_files(
+    regex,
+    save_dir,
+    chunk_size,
+    hash_type="sha256",
+    block_size=DEFAULT_BLOCK_SIZE,
+    workers=1,
+    compression=None,
+    target_file_size_mb=None,
+    chunk_target_mb=DEFAULT_CHUNK_TARGET_MB,
+    catalog=None,
+):
+    # peak memory is bounded by one block of rows plus the set of digests seen so far
+    hdf5_files = get_all_hdf5_files_from_regex(regex=regex, catalog=catalog)
+
+    common_keys = get_common_keys(list_of_files=hdf5_files)
+    print("\nCommon keys between all hdf5 files: ", common_keys, "\n")
+
+    chunk_size = get_chunk_size(
+        chunk_size=chunk_size,
+        datasets={key: hdf5_files[0][key] for key in common_keys} if len(hdf5_files) > 0 else {},
+        target_file_size_mb=target_file_size_mb,
+    )
+
+    first_occurrence_masks = None
+    if workers > 1:
+        first_occurrence_masks = get_first_occurrence_masks(
+            list_of_files=hdf5_files,
+            keys=common_keys,
+            hash_type=hash_type,
+            block_size=block_size,
+            workers=workers,
+        )
+
+    hash_of_datasets = DigestSet(hash_type=hash_type)
+    num_total_elements = 0
+
+    with TaskFileWriter(
+        save_dir=save_dir,
+        chunk_size=chunk_size,
+        compression=compression,
+        chunk_target_mb=chunk_target_mb,
+    ) as writer:
+        for i in range(len(hdf5_files)):
+            print("Index of file being processed: ", i)
+
+            file = hdf5_files[i]
+            num_datapoints = hdf5_files.get_num_datapoints(i)
+            num_total_elements += num_datapoints
+
+            for start, end in iterate_row_blocks(num_datapoints=num_datapoints, block_size=block_size):
+                with stage("read", rows=end - start) as span:
+                    slabs = {}
+                    for key in common_keys:
+                        slabs[key] = file[key][start:end]
+                    span.add(nbytes=get_nbytes(datasets=slabs))
+
+                if first_occurrence_masks is None:
+                    with stage("hash", rows=end - start, nbytes=get_nbytes(datasets=slabs)):
+                        digests = hash_file(file=slabs, keys=common_keys, hash_type=hash_type, block_size=block_size)
+                        is_first_occurrence = get_first_occurrence_mask(digests=digests, seen_digests=hash_of_datasets)
+                else:
+                    is_first_occurrence = first_occurrence_masks[i][start:end]
+
+                unique_slabs = {}
                 for key in common_keys:
-                    dedupped_datasets[key].append(dsets[key][i])
+                    unique_slabs[key] = slabs[key][is_first_occurrence]
+                writer.write(slabs=unique_slabs)
 
-        file.close()
+            hdf5_files.close_file(i)
 
-    for key in common_keys:
-        dedupped_datasets[key] = np.array(dedupped_datasets[key])
-        print("key:", key, " shape unique elements: ", dedupped_datasets[key].shape)
+        print("Number of unique elements: ", writer.num_rows_written)
+        print("Number of files written: ", writer.num_files)
 
+    hdf5_files.close()
     print("\nNumber of total elements (including duplicates): ", num_total_elements, "\n")
 
-    divide_and_save_dataset(datasets=dedupped_datasets, save_dir=save_dir, chunk_size=chunk_size)
-
 
 def get_num_datapoints(datasets):
     num_datapoints = None
@@ -245,26 +596,58 @@ def get_num_datapoints(datasets):
     return num_datapoints
 
 
-def divide_and_save_dataset(datasets, save_dir, chunk_size):
-    num_datapoints = get_num_datapoints(datasets=datasets)
+def get_chunk_size(chunk_size, datasets=None, target_file_size_mb=None):
+    # a chunk size of 0 (or none) means the size comes from target_file_size_mb
+    if not chunk_size and target_file_size_mb is not None:
+        chunk_size = get_chunk_size_for_target_file_size(datasets=datasets, target_file_size_mb=target_file_size_mb)
+        print("Chunk size for target file size of", target_file_size_mb, "MB: ", chunk_size)
 
-    if chunk_size == 0:
-        chunk_size = int(input("Enter the size of each individual chunk: "))
+    if not chunk_size or chunk_size < 0:
+        raise ValueError("The number of rows per task file is not set, pass --chunk_size or --target_file_size_mb.")
 
-    assert chunk_size > 0
+    return chunk_size
+
+
+def divide_and_save_dataset(
+    datasets,
+    save_dir,
+    chunk_size,
+    compression=None,
+    target_file_size_mb=None,
+    workers=1,
+    chunk_target_mb=DEFAULT_CHUNK_TARGET_MB,
+):
+    num_datapoints = get_num_datapoints(datasets=datasets)
+    chunk_size = get_chunk_size(chunk_size=chunk_size, datasets=datasets, target_file_size_mb=target_file_size_mb)
     num_chunks = math.ceil(num_datapoints / chunk_size)
 
     assert save_dir is not None and isinstance(save_dir, str)
     if not os.path.isdir(save_dir):
         os.makedirs(save_dir)
 
+    file_paths = [os.path.join(save_dir, "task_" + str(i) + ".hdf5") for i in range(num_chunks)]
+    chunks = []
     for i in range(num_chunks):
-        file_name = "task_" + str(i) + ".hdf5"
-        file_path = os.path.join(save_dir, file_name)
-        file = h5.File(file_path, "w")
-
+        chunk_datasets = {}
         for key in datasets:
-            chunk_dataset = datasets[key][i * chunk_size : (i + 1) * chunk_size]
-            file.create_dataset(key, data=chunk_dataset)
-
-        file.close()
+            chunk_datasets[key] = datasets[key][i * chunk_size : (i + 1) * chunk_size]
+        chunks.append(chunk_datasets)
+
+    if workers <= 1:
+        for file_path, chunk_datasets in zip(file_paths, chunks):
+            save_task_file(
+                file_path=file_path,
+                datasets=chunk_datasets,
+                compression=compression,
+                chunk_target_mb=chunk_target_mb,
+            )
+    else:
+        # h5py serializes all calls within a process, so task files are written by separate processes
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            write_task_file = partial(
+                run_recording_stages,
+                save_task_file,
+                compression=compression,
+                chunk_target_mb=chunk_target_mb,
+            )
+            merge_worker_results(worker_results=executor.map(write_task_file, file_paths, chunks))
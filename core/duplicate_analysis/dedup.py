@@ -9,8 +9,15 @@ import configargparse
 from .check_duplicates_utils import (
     remove_duplicates_between_two_list_of_files,
     remove_duplicates_from_single_list_of_files,
+    stream_duplicates_from_single_list_of_files,
+    remove_spatial_duplicates_between_two_list_of_files,
     analyze_duplicates_between_two_files,
 )
+from ..utils.corpus_catalog import open_corpus_catalog
+from ..utils.hdf5_utils import DEFAULT_CHUNK_TARGET_MB
+from ..utils.instrumentation import add_instrumentation_arguments, start_instrumentation
+from .hash_utils import DEFAULT_BLOCK_SIZE
+from .near_duplicates import report_near_duplicates
 
 
 def parse_script_arguments():
@@ -28,6 +35,9 @@ def parse_script_arguments():
     parser.add_argument("--check_single_regex", action="store_true")
     parser.add_argument("--check_double_regex", action="store_true")
     parser.add_argument("--analyze", action="store_true")
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--near_duplicates", action="store_true")
+    parser.add_argument("--spatial", action="store_true")
 
     # file path option
     parser.add_argument("--target_regex", type=str)
@@ -35,9 +45,43 @@ def parse_script_arguments():
     parser.add_argument("--dedupped_dir", type=str)
     parser.add_argument("--regex", type=str)
 
+    # directory of the persistent digest index of the source files (optional)
+    parser.add_argument("--index_dir", type=str, default=None)
+
+    # json catalog of file names, keys and shapes of the matched hdf5 files (optional)
+    parser.add_argument("--catalog_path", type=str, default=None)
+
     # number of chunks
     parser.add_argument("--chunk_size", type=int)
 
+    # output options
+    parser.add_argument("--compression", type=str, default=None, choices=["gzip", "lzf"])
+    parser.add_argument("--target_file_size_mb", type=float, default=None)
+    parser.add_argument("--write_workers", type=int, default=1)
+    # size of one hdf5 chunk of the written datasets
+    parser.add_argument("--chunk_target_mb", type=float, default=DEFAULT_CHUNK_TARGET_MB)
+
+    # hashing options
+    parser.add_argument("--hash_type", type=str, default="sha256", choices=["sha256", "blake2b128"])
+    parser.add_argument("--block_size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--bloom_filter_bits", type=int, default=0)
+
+    # near duplicate options
+    parser.add_argument("--hamming_threshold", type=int, default=6)
+    parser.add_argument("--num_bands", type=int, default=4)
+    # default: the smallest radius that finds every pair within hamming_threshold bits
+    parser.add_argument("--probe_radius", type=int, default=None)
+
+    # spatial dedup options
+    parser.add_argument("--min_overlap", type=float, default=0.0)
+    parser.add_argument("--spatial_index_path", type=str, default=None)
+
+    # number of processes used for hashing
+    parser.add_argument("--workers", type=int, default=1)
+
+    # per stage metrics and profiling
+    add_instrumentation_arguments(parser=parser)
+
     args = parser.parse_args()
     print(parser.format_values())
 
@@ -45,6 +89,9 @@ def parse_script_arguments():
 
 
 def validate_script_arguments(args):
+    if args.near_duplicates:
+        return
+
     # at least one option is true
     assert args.check_single_regex or args.check_double_regex
     # but not both options
@@ -54,12 +101,47 @@ def validate_script_arguments(args):
 def run_script():
     args = parse_script_arguments()
     validate_script_arguments(args=args)
+    start_instrumentation(script_name="dedup", args=args)
+    catalog = open_corpus_catalog(catalog_path=args.catalog_path)
+
+    if args.near_duplicates:
+        report_near_duplicates(
+            regex=args.regex,
+            save_dir=args.dedupped_dir,
+            hamming_threshold=args.hamming_threshold,
+            num_bands=args.num_bands,
+            probe_radius=args.probe_radius,
+            block_size=args.block_size,
+            catalog=catalog,
+        )
+
+    elif args.check_single_regex and args.streaming:
+        stream_duplicates_from_single_list_of_files(
+            regex=args.regex,
+            save_dir=args.dedupped_dir,
+            chunk_size=args.chunk_size,
+            hash_type=args.hash_type,
+            block_size=args.block_size,
+            workers=args.workers,
+            compression=args.compression,
+            target_file_size_mb=args.target_file_size_mb,
+            chunk_target_mb=args.chunk_target_mb,
+            catalog=catalog,
+        )
 
-    if args.check_single_regex:
+    elif args.check_single_regex:
         remove_duplicates_from_single_list_of_files(
             regex=args.regex,
             save_dir=args.dedupped_dir,
             chunk_size=args.chunk_size,
+            hash_type=args.hash_type,
+            block_size=args.block_size,
+            workers=args.workers,
+            compression=args.compression,
+            target_file_size_mb=args.target_file_size_mb,
+            write_workers=args.write_workers,
+            chunk_target_mb=args.chunk_target_mb,
+            catalog=catalog,
         )
 
     elif args.analyze:
@@ -67,6 +149,19 @@ def run_script():
             source_file_name=args.source_regex,
             target_file_name=args.target_regex,
             save_dir=args.dedupped_dir,
+            hash_type=args.hash_type,
+            chunk_size=args.chunk_size,
+            target_file_size_mb=args.target_file_size_mb,
+        )
+
+    elif args.check_double_regex and args.spatial:
+        remove_spatial_duplicates_between_two_list_of_files(
+            source_regex=args.source_regex,
+            target_regex=args.target_regex,
+            save_dir=args.dedupped_dir,
+            min_overlap=args.min_overlap,
+            spatial_index_path=args.spatial_index_path,
+            catalog=catalog,
         )
 
     elif args.check_double_regex:
@@ -74,6 +169,12 @@ def run_script():
             source_regex=args.source_regex,
             target_regex=args.target_regex,
             save_dir=args.dedupped_dir,
+            hash_type=args.hash_type,
+            block_size=args.block_size,
+            workers=args.workers,
+            index_dir=args.index_dir,
+            bloom_filter_bits=args.bloom_filter_bits,
+            catalog=catalog,
         )
 
 
@@ -0,0 +1,119 @@
+# import from general packages
+import numpy as np
+import os
+import json
+from hashlib import sha1
+
+
+# import from our packages
+from .hash_utils import get_digest_dtype
+
+
+MANIFEST_FILE_NAME = "manifest.json"
+INDEX_FILE_NAME = "index.npy"
+DIGESTS_DIR_NAME = "digests"
+
+
+def get_file_signature(file_name, keys, hash_type):
+    stat = os.stat(file_name)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "keys": sorted(keys),
+        "hash_type": hash_type,
+    }
+
+
+class DigestIndex:
+    # sorted, memory-mapped array of the unique row digests of a set of hdf5 files,
+    # with one digest file per input so unchanged files are never rehashed
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.manifest_path = os.path.join(index_dir, MANIFEST_FILE_NAME)
+        self.index_path = os.path.join(index_dir, INDEX_FILE_NAME)
+        self.digests_dir = os.path.join(index_dir, DIGESTS_DIR_NAME)
+
+        if not os.path.isdir(self.digests_dir):
+            os.makedirs(self.digests_dir)
+
+        self.manifest = {}
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r") as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+        self.digests = None
+
+    def get_digest_path(self, file_name):
+        name = sha1(os.path.abspath(file_name).encode("utf-8")).hexdigest() + ".npy"
+        return os.path.join(self.digests_dir, name)
+
+    def get_stale_files(self, file_names, keys, hash_type):
+        stale_files = []
+        for file_name in file_names:
+            signature = get_file_signature(file_name=file_name, keys=keys, hash_type=hash_type)
+            entry = self.manifest.get(os.path.abspath(file_name))
+
+            if entry is None or entry["signature"] != signature or not os.path.isfile(entry["digest_path"]):
+                stale_files.append(file_name)
+
+        return stale_files
+
+    def update(self, file_names, keys, hash_type, hash_function):
+        # hash_function maps a list of hdf5 file names to one unique digest array per file;
+        # up to date files are recognized from their signature alone, without opening them
+        absolute_file_names = set(os.path.abspath(file_name) for file_name in file_names)
+        stale_files = self.get_stale_files(file_names=file_names, keys=keys, hash_type=hash_type)
+        removed_files = [file_name for file_name in self.manifest if file_name not in absolute_file_names]
+
+        print("\nDigest index: ", self.index_dir)
+        print("Files up to date: ", len(file_names) - len(stale_files))
+        print("Files to hash: ", len(stale_files))
+        print("Files removed: ", len(removed_files), "\n")
+
+        for file_name in removed_files:
+            del self.manifest[file_name]
+
+        if len(stale_files) > 0:
+            for file_name, digests in zip(stale_files, hash_function(stale_files)):
+                file_name = os.path.abspath(file_name)
+                digest_path = self.get_digest_path(file_name=file_name)
+                np.save(digest_path, digests)
+
+                self.manifest[file_name] = {
+                    "signature": get_file_signature(file_name=file_name, keys=keys, hash_type=hash_type),
+                    "digest_path": digest_path,
+                }
+
+        if len(stale_files) > 0 or len(removed_files) > 0 or not os.path.isfile(self.index_path):
+            self.rebuild(hash_type=hash_type)
+            self.save_manifest()
+
+        self.digests = np.load(self.index_path, mmap_mode="r")
+
+    def rebuild(self, hash_type):
+        all_digests = [np.empty(0, dtype=get_digest_dtype(hash_type))]
+        for file_name in sorted(self.manifest):
+            all_digests.append(np.load(self.manifest[file_name]["digest_path"], mmap_mode="r"))
+
+        # write to a temporary file first so an interrupted rebuild never leaves a truncated index
+        temporary_path = self.index_path + ".tmp.npy"
+        np.save(temporary_path, np.unique(np.concatenate(all_digests)))
+        os.replace(temporary_path, self.index_path)
+
+    def save_manifest(self):
+        temporary_path = self.manifest_path + ".tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2, sort_keys=True)
+        os.replace(temporary_path, self.manifest_path)
+
+    def contains(self, digests):
+        digests = np.asarray(digests, dtype=self.digests.dtype)
+        if self.digests.shape[0] == 0:
+            return np.zeros(digests.shape[0], dtype=bool)
+
+        positions = np.searchsorted(self.digests, digests)
+        positions = np.minimum(positions, self.digests.shape[0] - 1)
+        return self.digests[positions] == digests
+
+    def __len__(self):
+        return 0 if self.digests is None else self.digests.shape[0]
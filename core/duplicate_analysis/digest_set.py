@@ -0,0 +1,92 @@
+# import from general packages
+import numpy as np
+
+
+# import from our packages
+from .hash_utils import get_digest_dtype
+
+
+def get_digest_words(digests):
+    # first 16 bytes of every digest as two uint64 words; digests are uniformly distributed already
+    digest_bytes = np.ascontiguousarray(digests).view(np.uint8).reshape(digests.shape[0], digests.dtype.itemsize)
+    return np.ascontiguousarray(digest_bytes[:, :16]).view("<u8")
+
+
+class BloomFilter:
+    def __init__(self, num_bits, num_hashes=4):
+        assert num_bits > 0 and num_hashes > 0
+        self.num_bits = np.uint64(num_bits)
+        self.num_hashes = num_hashes
+        self.bits = np.zeros((num_bits + 7) // 8, dtype=np.uint8)
+
+    def get_positions(self, digests):
+        # double hashing: position_i = h1 + i * h2
+        words = get_digest_words(digests=digests)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        return (words[:, :1] + steps[np.newaxis, :] * words[:, 1:2]) % self.num_bits
+
+    def add(self, digests):
+        positions = self.get_positions(digests=digests).ravel()
+        bit_values = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), bit_values)
+
+    def might_contain(self, digests):
+        positions = self.get_positions(digests=digests)
+        is_set = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return np.all(is_set == 1, axis=1)
+
+
+class DigestSet:
+    # set of fixed-width binary digests stored as a few sorted numpy runs (merged like a binary counter),
+    # with batched, vectorized membership tests and an optional bloom filter in front
+    def __init__(self, hash_type="sha256", bloom_filter_bits=0):
+        self.digest_dtype = get_digest_dtype(hash_type)
+        self.runs = []
+        self.bloom_filter = BloomFilter(num_bits=bloom_filter_bits) if bloom_filter_bits > 0 else None
+
+    def __len__(self):
+        return sum(run.shape[0] for run in self.runs)
+
+    def contains(self, digests):
+        digests = np.asarray(digests, dtype=self.digest_dtype)
+        is_member = np.zeros(digests.shape[0], dtype=bool)
+
+        candidates = np.arange(digests.shape[0])
+        if self.bloom_filter is not None and digests.shape[0] > 0:
+            candidates = candidates[self.bloom_filter.might_contain(digests=digests)]
+
+        for run in self.runs:
+            if candidates.shape[0] == 0:
+                break
+            candidate_digests = digests[candidates]
+            positions = np.minimum(np.searchsorted(run, candidate_digests), run.shape[0] - 1)
+            found = run[positions] == candidate_digests
+            is_member[candidates[found]] = True
+            candidates = candidates[~found]
+
+        return is_member
+
+    def add(self, digests):
+        # returns a mask of the digests that were not in the set before, counting only the first
+        # occurrence of digests repeated within the batch
+        digests = np.asarray(digests, dtype=self.digest_dtype)
+        is_new = np.zeros(digests.shape[0], dtype=bool)
+        if digests.shape[0] == 0:
+            return is_new
+
+        unique_digests, first_indices = np.unique(digests, return_index=True)
+        not_member = ~self.contains(digests=unique_digests)
+        unique_digests = unique_digests[not_member]
+        is_new[first_indices[not_member]] = True
+
+        if unique_digests.shape[0] > 0:
+            if self.bloom_filter is not None:
+                self.bloom_filter.add(digests=unique_digests)
+            self.insert_run(run=unique_digests)
+
+        return is_new
+
+    def insert_run(self, run):
+        while len(self.runs) > 0 and self.runs[-1].shape[0] <= 2 * run.shape[0]:
+            run = np.sort(np.concatenate([self.runs.pop(), run]), kind="mergesort")
+        self.runs.append(run)
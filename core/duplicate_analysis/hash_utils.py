@@ -0,0 +1,95 @@
+# import from general packages
+import numpy as np
+from hashlib import blake2b, sha256
+
+# imports from our packages
+from ..utils.instrumentation import get_nbytes, stage
+
+
+DIGEST_SIZES = {
+    "sha256": 32,
+    "blake2b128": 16,
+}
+
+DEFAULT_BLOCK_SIZE = 256
+
+
+def get_digest_dtype(hash_type):
+    if hash_type not in DIGEST_SIZES:
+        raise ValueError("Hash type " + str(hash_type) + " is not supported.")
+
+    return np.dtype("S" + str(DIGEST_SIZES[hash_type]))
+
+
+def iterate_row_blocks(num_datapoints, block_size):
+    assert block_size > 0
+    for start in range(0, num_datapoints, block_size):
+        yield start, min(start + block_size, num_datapoints)
+
+
+def get_row_records(slabs, keys):
+    # view the bytes of every row across all keys as a single fixed-width uint8 record
+    num_rows = slabs[keys[0]].shape[0]
+    row_bytes = []
+    for key in keys:
+        slab = np.ascontiguousarray(slabs[key])
+        if slab.shape[0] != num_rows:
+            raise ValueError("Incompatible dataset.")
+        row_bytes.append(slab.view(np.uint8).reshape(num_rows, slab.nbytes // max(num_rows, 1)))
+
+    return np.concatenate(row_bytes, axis=1)
+
+
+def _blake2b128_digests(records):
+    # a real 128 bit hash: half the digest size of sha256, so digest sets and indexes take half the memory
+    digests = [blake2b(record, digest_size=16).digest() for record in records]
+    return np.array(digests, dtype=get_digest_dtype("blake2b128")).reshape(records.shape[0])
+
+
+def _sha256_digests(records):
+    digests = [sha256(record).digest() for record in records]
+    return np.array(digests, dtype=get_digest_dtype("sha256")).reshape(records.shape[0])
+
+
+def hash_slabs(slabs, keys, hash_type="sha256"):
+    records = get_row_records(slabs=slabs, keys=keys)
+
+    if hash_type == "sha256":
+        return _sha256_digests(records=records)
+    elif hash_type == "blake2b128":
+        return _blake2b128_digests(records=records)
+    else:
+        raise ValueError("Hash type " + str(hash_type) + " is not supported.")
+
+
+def read_slabs(datasets, keys, start, end):
+    slabs = {}
+    for key in keys:
+        slabs[key] = datasets[key][start:end]
+
+    return slabs
+
+
+def hash_datasets_in_blocks(
+    datasets,
+    keys,
+    num_datapoints,
+    hash_type="sha256",
+    block_size=DEFAULT_BLOCK_SIZE,
+    record_reads=False,
+):
+    # keys are always hashed in sorted order so digests are reproducible across runs and processes.
+    # record_reads times the block reads as a read stage, for datasets that are read from files
+    keys = sorted(keys)
+    digests = np.empty(num_datapoints, dtype=get_digest_dtype(hash_type))
+
+    for start, end in iterate_row_blocks(num_datapoints=num_datapoints, block_size=block_size):
+        if record_reads:
+            with stage("read", rows=end - start) as span:
+                slabs = read_slabs(datasets=datasets, keys=keys, start=start, end=end)
+                span.add(nbytes=get_nbytes(datasets=slabs))
+        else:
+            slabs = read_slabs(datasets=datasets, keys=keys, start=start, end=end)
+        digests[start:end] = hash_slabs(slabs=slabs, keys=keys, hash_type=hash_type)
+
+    return digests
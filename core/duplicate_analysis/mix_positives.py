@@ -14,31 +14,23 @@ from ..utils.hdf5_utils import (
     get_common_keys,
     open_hdf5_file,
     retrieve_datasets_from_hdf5_file,
+    DEFAULT_CHUNK_TARGET_MB,
 )
+from ..utils.corpus_catalog import open_corpus_catalog
+from ..utils.instrumentation import add_instrumentation_arguments, start_instrumentation
+from ..utils.virtual_corpus import VirtualCorpus
 from .check_duplicates_utils import (
     get_num_datapoints,
     divide_and_save_dataset,
 )
 
 
-def load_all_files(regex):
-    files = get_all_hdf5_files_from_regex(regex=regex)
-    common_keys = get_common_keys(list_of_files=files)
+def load_all_files(regex, catalog=None):
+    # rows of every file are read straight into one array per key, without a concatenated copy
+    with VirtualCorpus.from_regex(regex=regex, catalog=catalog) as corpus:
+        dsets = corpus.read_slice(start=0, end=len(corpus))
 
-    dsets = {}
-    for key in common_keys:
-        for file in files:
-            if file[key].shape[0] > 0:
-                if key not in dsets:
-                    dsets[key] = [np.array(file[key])]
-                else:
-                    dsets[key].append(np.array(file[key]))
-
-    for file in files:
-        file.close()
-
-    for key in common_keys:
-        dsets[key] = np.concatenate(dsets[key])
+    for key in dsets:
         print("Key: ", key, "dataset shape: ", dsets[key].shape)
 
     print("")
@@ -46,6 +38,30 @@ def load_all_files(regex):
     return dsets
 
 
+def lazily_sample_files(regex, keys, num_sample, true_positives_only=False, catalog=None):
+    # only row counts (and labels, for positives) are read before sampling; then just the sampled rows
+    with VirtualCorpus.from_regex(regex=regex, catalog=catalog) as corpus:
+        if true_positives_only:
+            labels = corpus["labels"][:].reshape(len(corpus))
+            candidate_indices = np.flatnonzero(labels == 1)
+            print("\nNum true positives: ", candidate_indices.shape[0])
+        else:
+            candidate_indices = np.arange(len(corpus))
+
+        assert num_sample <= candidate_indices.shape[0]
+        random_indices = np.random.choice(a=candidate_indices.shape[0], size=num_sample, replace=False)
+
+        random_dsets = corpus.read_rows(global_indices=candidate_indices[random_indices], keys=keys)
+
+    print("")
+    for key in random_dsets:
+        print("Key: ", key, "dataset shape: ", random_dsets[key].shape)
+
+    print("")
+
+    return random_dsets
+
+
 def randomly_sample_dataset(dsets, num_sample):
     num_datapoints = get_num_datapoints(datasets=dsets)
     assert num_sample <= num_datapoints
@@ -67,13 +83,7 @@ def randomly_sample_dataset(dsets, num_sample):
 
 def choose_true_positives(positive_dsets):
     true_labels = positive_dsets["labels"]
-
-    indices = []
-    for i in range(true_labels.shape[0]):
-        if true_labels[i] == 1:
-            indices.append(i)
-
-    indices = np.array(indices, dtype=np.int32)
+    indices = np.flatnonzero(true_labels.reshape(true_labels.shape[0]) == 1).astype(np.int32)
     print("\nNum true positives: ", indices.shape[0])
 
     true_positives_dsets = {}
@@ -89,6 +99,17 @@ def choose_true_positives(positive_dsets):
     return true_positives_dsets
 
 
+def get_mixture_interleave_indices(num_chunks, neg_pos_ratio):
+    # every chunk i is positive i followed by negatives i, i + 1, ..., i + neg_pos_ratio - 1
+    chunk_indices = np.repeat(np.arange(num_chunks), neg_pos_ratio + 1)
+    offsets_in_chunk = np.tile(np.arange(neg_pos_ratio + 1), num_chunks)
+
+    is_positive = offsets_in_chunk == 0
+    source_indices = np.where(is_positive, chunk_indices, chunk_indices + offsets_in_chunk - 1)
+
+    return is_positive, source_indices
+
+
 def create_mixture_dsets(positive_dsets, negative_dsets, common_keys):
     num_positive_examples = get_num_datapoints(datasets=positive_dsets)
     num_negative_examples = get_num_datapoints(datasets=negative_dsets)
@@ -101,16 +122,23 @@ def create_mixture_dsets(positive_dsets, negative_dsets, common_keys):
     neg_pos_ratio = int(num_negative_examples / num_positive_examples)
     num_chunks = num_positive_examples
 
-    mixture_dsets = defaultdict(list)
-    for i in range(num_chunks):
-        for key in common_keys:
-            mixture_dsets[key].append(positive_dsets[key][i])
-            for j in range(neg_pos_ratio):
-                mixture_dsets[key].append(negative_dsets[key][i + j])
+    is_positive, source_indices = get_mixture_interleave_indices(num_chunks=num_chunks, neg_pos_ratio=neg_pos_ratio)
+
+    mixture_dsets = {}
+    for key in common_keys:
+        positive_dset = positive_dsets[key]
+        negative_dset = negative_dsets[key]
+
+        mixture_dset = np.empty(
+            (is_positive.shape[0],) + positive_dset.shape[1:],
+            dtype=np.result_type(positive_dset, negative_dset),
+        )
+        mixture_dset[is_positive] = positive_dset[source_indices[is_positive]]
+        mixture_dset[~is_positive] = negative_dset[source_indices[~is_positive]]
+        mixture_dsets[key] = mixture_dset
 
     print("Final (unchunked) mixture dataset shapes: ")
     for key in common_keys:
-        mixture_dsets[key] = np.array(mixture_dsets[key])
         print("Key: ", key, "dataset shape: ", mixture_dsets[key].shape)
     print("")
 
@@ -136,18 +164,63 @@ def parse_args():
 
     parser.add_argument("--chunk_size", type=int)
 
+    # output options
+    parser.add_argument("--compression", type=str, default=None, choices=["gzip", "lzf"])
+    parser.add_argument("--target_file_size_mb", type=float, default=None)
+    parser.add_argument("--write_workers", type=int, default=1)
+    # size of one hdf5 chunk of the written datasets
+    parser.add_argument("--chunk_target_mb", type=float, default=DEFAULT_CHUNK_TARGET_MB)
+
+    # read only the sampled rows instead of loading every file
+    parser.add_argument("--lazy", action="store_true")
+
+    # json catalog of file names, keys and shapes of the matched hdf5 files (optional)
+    parser.add_argument("--catalog_path", type=str, default=None)
+
+    # per stage metrics and profiling
+    add_instrumentation_arguments(parser=parser)
+
     args = parser.parse_args()
     print(parser.format_values())
 
     return args
 
 
-def run_script():
-    args = parse_args()
+def get_common_keys_of_regexes(regexes, catalog=None):
+    common_keys = None
+    for regex in regexes:
+        with get_all_hdf5_files_from_regex(regex=regex, catalog=catalog) as files:
+            keys = get_common_keys(list_of_files=files)
+        common_keys = keys if common_keys is None else common_keys.intersection(keys)
+
+    return common_keys if common_keys is not None else set()
+
+
+def sample_files_lazily(args, catalog=None):
+    common_keys = get_common_keys_of_regexes(regexes=[args.neg_regex, args.pos_regex], catalog=catalog)
+
+    # same order of random draws as the eager path: positives first, then negatives
+    positive_random_sample = lazily_sample_files(
+        regex=args.pos_regex,
+        keys=common_keys,
+        num_sample=args.positive_samples,
+        true_positives_only=True,
+        catalog=catalog,
+    )
+    negative_random_sample = lazily_sample_files(
+        regex=args.neg_regex,
+        keys=common_keys,
+        num_sample=args.negative_samples,
+        catalog=catalog,
+    )
 
-    negative_dsets = load_all_files(regex=args.neg_regex)
+    return positive_random_sample, negative_random_sample
 
-    positive_dsets = load_all_files(regex=args.pos_regex)
+
+def sample_files_eagerly(args, catalog=None):
+    negative_dsets = load_all_files(regex=args.neg_regex, catalog=catalog)
+
+    positive_dsets = load_all_files(regex=args.pos_regex, catalog=catalog)
     true_positives_dsets = choose_true_positives(positive_dsets=positive_dsets)
 
     positive_random_sample = randomly_sample_dataset(
@@ -159,6 +232,15 @@ def run_script():
         num_sample=args.negative_samples,
     )
 
+    return positive_random_sample, negative_random_sample
+
+
+def mix_positives_and_negatives(args, catalog=None):
+    if args.lazy:
+        positive_random_sample, negative_random_sample = sample_files_lazily(args=args, catalog=catalog)
+    else:
+        positive_random_sample, negative_random_sample = sample_files_eagerly(args=args, catalog=catalog)
+
     common_keys = set(positive_random_sample.keys()).intersection(set(negative_random_sample.keys()))
     print("\nCommon keys: ", common_keys, "\n")
 
@@ -175,8 +257,19 @@ def run_script():
         datasets=mixture_dsets,
         save_dir=args.save_dir,
         chunk_size=args.chunk_size,
+        compression=args.compression,
+        target_file_size_mb=args.target_file_size_mb,
+        workers=args.write_workers,
+        chunk_target_mb=args.chunk_target_mb,
     )
 
 
+def run_script():
+    args = parse_args()
+    start_instrumentation(script_name="mix_positives", args=args)
+    catalog = open_corpus_catalog(catalog_path=args.catalog_path)
+    mix_positives_and_negatives(args=args, catalog=catalog)
+
+
 if __name__ == "__main__":
     run_script()
@@ -0,0 +1,262 @@
+# import from general packages
+import numpy as np
+import os
+import json
+from itertools import combinations
+
+
+# import from our packages
+from ..utils.hdf5_utils import get_all_hdf5_files_from_regex
+from .hash_utils import DEFAULT_BLOCK_SIZE, iterate_row_blocks
+
+
+HASH_BITS = 64
+HASH_SIZE = 8
+DCT_SIZE = 32
+
+# luminance weights for the R, G, B bands
+GRAYSCALE_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float64)
+
+_POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def get_dct_matrix(size):
+    positions = np.arange(size)
+    dct_matrix = np.cos(np.pi * (2 * positions[np.newaxis, :] + 1) * positions[:, np.newaxis] / (2 * size))
+    dct_matrix *= np.sqrt(2.0 / size)
+    dct_matrix[0] /= np.sqrt(2.0)
+    return dct_matrix
+
+
+def downsample_images(images, size):
+    num_images, height, width = images.shape
+    if height % size == 0 and width % size == 0:
+        return images.reshape(num_images, size, height // size, size, width // size).mean(axis=(2, 4))
+
+    rows = (np.arange(size) * height) // size
+    columns = (np.arange(size) * width) // size
+    return images[:, rows][:, :, columns]
+
+
+def compute_perceptual_hashes(rgb_images):
+    # DCT based perceptual hash of every image in a (B, 3, H, W) block, packed into one uint64 per image;
+    # comparing against the median makes it invariant to the per-file scaling used for export
+    rgb_images = np.nan_to_num(rgb_images.astype(np.float64))
+    grayscale = np.einsum("c,bchw->bhw", GRAYSCALE_WEIGHTS, rgb_images)
+    grayscale = downsample_images(images=grayscale, size=DCT_SIZE)
+
+    dct_matrix = get_dct_matrix(size=DCT_SIZE)[:HASH_SIZE]
+    coefficients = np.einsum("ih,bhw,jw->bij", dct_matrix, grayscale, dct_matrix).reshape(-1, HASH_BITS)
+
+    # the DC coefficient is excluded from the median as it only encodes mean brightness
+    medians = np.median(coefficients[:, 1:], axis=1)
+    bits = coefficients > medians[:, np.newaxis]
+
+    return np.ascontiguousarray(np.packbits(bits, axis=1)).view(">u8").astype(np.uint64).reshape(-1)
+
+
+def hash_images_in_file(file, block_size=DEFAULT_BLOCK_SIZE):
+    num_datapoints = file["images"].shape[0]
+    hashes = np.empty(num_datapoints, dtype=np.uint64)
+    for start, end in iterate_row_blocks(num_datapoints=num_datapoints, block_size=block_size):
+        # same band selection as retrieve_images: bands 1:4, B, G, R --> R, G, B (kept channels first)
+        rgb_images = file["images"][start:end, 1:4][:, ::-1]
+        hashes[start:end] = compute_perceptual_hashes(rgb_images=rgb_images)
+
+    return hashes
+
+
+def get_hamming_distances(hashes_1, hashes_2):
+    xor = np.ascontiguousarray(np.bitwise_xor(hashes_1, hashes_2), dtype=np.uint64)
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
+def get_probe_masks(band_bits, probe_radius):
+    probe_masks = [0]
+    for radius in range(1, probe_radius + 1):
+        for bit_positions in combinations(range(band_bits), radius):
+            probe_masks.append(sum(1 << position for position in bit_positions))
+
+    return np.array(probe_masks, dtype=np.uint64)
+
+
+class HammingLSHIndex:
+    # splits each 64 bit hash into num_bands bands and keeps one sorted array of band values per band;
+    # queries also probe every band value within probe_radius bits, so any pair within
+    # num_bands * (probe_radius + 1) - 1 bits is guaranteed to become a candidate
+    def __init__(self, hashes, num_bands=4, probe_radius=1):
+        assert HASH_BITS % num_bands == 0
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.num_bands = num_bands
+        self.band_bits = HASH_BITS // num_bands
+        self.band_mask = np.uint64((1 << self.band_bits) - 1)
+        self.probe_masks = get_probe_masks(band_bits=self.band_bits, probe_radius=probe_radius)
+
+        self.band_orders = []
+        self.sorted_band_values = []
+        for band in range(num_bands):
+            band_values = self.get_band_values(hashes=self.hashes, band=band)
+            order = np.argsort(band_values, kind="stable")
+            self.band_orders.append(order)
+            self.sorted_band_values.append(band_values[order])
+
+    def get_band_values(self, hashes, band):
+        return (hashes >> np.uint64(band * self.band_bits)) & self.band_mask
+
+    def query(self, query_hashes, threshold):
+        # returns (query index, item index, hamming distance) for every candidate within threshold
+        query_hashes = np.asarray(query_hashes, dtype=np.uint64)
+        query_indices = []
+        item_indices = []
+
+        for band in range(self.num_bands):
+            probes = self.get_band_values(hashes=query_hashes, band=band)[:, np.newaxis] ^ self.probe_masks
+            starts = np.searchsorted(self.sorted_band_values[band], probes.ravel(), side="left")
+            ends = np.searchsorted(self.sorted_band_values[band], probes.ravel(), side="right")
+            counts = ends - starts
+
+            probe_query_indices = np.repeat(np.arange(query_hashes.shape[0]), self.probe_masks.shape[0])
+            offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+            query_indices.append(np.repeat(probe_query_indices, counts))
+            item_indices.append(self.band_orders[band][np.repeat(starts, counts) + offsets])
+
+        query_indices = np.concatenate(query_indices)
+        item_indices = np.concatenate(item_indices)
+
+        # the same pair can be found through several bands and probes
+        pair_codes = np.unique(query_indices.astype(np.int64) * self.hashes.shape[0] + item_indices)
+        query_indices = pair_codes // self.hashes.shape[0]
+        item_indices = pair_codes % self.hashes.shape[0]
+
+        distances = get_hamming_distances(query_hashes[query_indices], self.hashes[item_indices])
+        is_near = distances <= threshold
+
+        return query_indices[is_near], item_indices[is_near], distances[is_near]
+
+
+def get_min_probe_radius(threshold, num_bands):
+    # smallest probe radius for which every pair within threshold bits becomes a candidate
+    return max(0, -(-(threshold + 1) // num_bands) - 1)
+
+
+def find_near_duplicate_pairs(hashes, threshold, num_bands=4, probe_radius=None, block_size=4096):
+    if probe_radius is None:
+        probe_radius = get_min_probe_radius(threshold=threshold, num_bands=num_bands)
+    # recall is only guaranteed up to num_bands * (probe_radius + 1) - 1 bits, see HammingLSHIndex
+    max_threshold = num_bands * (probe_radius + 1) - 1
+    if threshold > max_threshold:
+        raise ValueError(
+            "Hamming threshold " + str(threshold) + " is above the " + str(max_threshold) + " bits that "
+            "probe radius " + str(probe_radius) + " with " + str(num_bands) + " bands can find."
+        )
+
+    lsh_index = HammingLSHIndex(hashes=hashes, num_bands=num_bands, probe_radius=probe_radius)
+
+    pairs = []
+    for start, end in iterate_row_blocks(num_datapoints=hashes.shape[0], block_size=block_size):
+        query_indices, item_indices, distances = lsh_index.query(query_hashes=hashes[start:end], threshold=threshold)
+        query_indices = query_indices + start
+
+        is_ordered_pair = query_indices < item_indices
+        pairs.append(np.stack([query_indices, item_indices, distances], axis=1)[is_ordered_pair])
+
+    if len(pairs) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+
+    return np.concatenate(pairs)
+
+
+def group_into_clusters(num_items, pairs):
+    parents = list(range(num_items))
+
+    def find_root(item):
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    for item_1, item_2 in pairs[:, :2].tolist():
+        root_1 = find_root(item_1)
+        root_2 = find_root(item_2)
+        if root_1 != root_2:
+            parents[max(root_1, root_2)] = min(root_1, root_2)
+
+    # flatten the remaining chains by pointer jumping
+    roots = np.array(parents, dtype=np.int64)
+    next_roots = roots[roots]
+    while not np.array_equal(next_roots, roots):
+        roots = next_roots
+        next_roots = roots[roots]
+
+    order = np.argsort(roots, kind="stable")
+    cluster_roots, cluster_starts, cluster_sizes = np.unique(roots[order], return_index=True, return_counts=True)
+
+    clusters = []
+    for start, size in zip(cluster_starts.tolist(), cluster_sizes.tolist()):
+        if size > 1:
+            clusters.append(order[start : start + size])
+
+    return clusters
+
+
+def report_near_duplicates(
+    regex,
+    save_dir,
+    hamming_threshold,
+    num_bands=4,
+    probe_radius=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+    catalog=None,
+):
+    hdf5_files = get_all_hdf5_files_from_regex(regex=regex, verbose=True, catalog=catalog)
+
+    file_names = []
+    file_indices = []
+    row_indices = []
+    hashes = []
+    for i in range(len(hdf5_files)):
+        file_hashes = hash_images_in_file(file=hdf5_files[i], block_size=block_size)
+        file_names.append(hdf5_files.file_names[i])
+        file_indices.append(np.full(file_hashes.shape[0], i, dtype=np.int64))
+        row_indices.append(np.arange(file_hashes.shape[0]))
+        hashes.append(file_hashes)
+        hdf5_files.close_file(i)
+
+    hdf5_files.close()
+
+    file_indices = np.concatenate(file_indices)
+    row_indices = np.concatenate(row_indices)
+    hashes = np.concatenate(hashes)
+
+    pairs = find_near_duplicate_pairs(
+        hashes=hashes,
+        threshold=hamming_threshold,
+        num_bands=num_bands,
+        probe_radius=probe_radius,
+    )
+    clusters = group_into_clusters(num_items=hashes.shape[0], pairs=pairs)
+
+    print("\nNumber of images: ", hashes.shape[0])
+    print("Number of near duplicate pairs: ", pairs.shape[0])
+    print("Number of near duplicate clusters: ", len(clusters), "\n")
+
+    report = {
+        "hamming_threshold": hamming_threshold,
+        "num_images": int(hashes.shape[0]),
+        "num_pairs": int(pairs.shape[0]),
+        "clusters": [
+            [{"file": file_names[file_indices[item]], "index": int(row_indices[item])} for item in cluster]
+            for cluster in clusters
+        ],
+    }
+
+    if not os.path.isdir(save_dir):
+        os.makedirs(save_dir)
+
+    report_path = os.path.join(save_dir, "near_duplicates.json")
+    with open(report_path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    print("Near duplicate report saved to: ", report_path)
+
+    return report
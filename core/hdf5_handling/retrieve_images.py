@@ -2,13 +2,18 @@
 from PIL import Image
 import argparse
 import configargparse
+import io
 import os
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # import from our scripts
-from ..utils.hdf5_utils import (
-    open_hdf5_file,
-    get_all_hdf5_filenames_from_regex,
+from ..utils.corpus_catalog import open_corpus_catalog
+from ..utils.hdf5_utils import get_all_hdf5_files_from_regex
+from ..utils.instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from ..utils.image_utils import (
+    get_scale_value,
+    normalize_images,
 )
 
 
@@ -27,6 +32,21 @@ def parse_script_arguments():
     parser.add_argument("--regex", type=str)
     parser.add_argument("--image_dir", type=str)
 
+    # export options
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--block_size", type=int, default=256)
+    parser.add_argument("--overwrite", action="store_true")
+
+    # normalization options
+    parser.add_argument("--per_image", action="store_true")
+    parser.add_argument("--percentile", type=float, default=None)
+
+    # json catalog of file names, keys and shapes of the matched hdf5 files (optional)
+    parser.add_argument("--catalog_path", type=str, default=None)
+
+    # per stage metrics and profiling
+    add_instrumentation_arguments(parser=parser)
+
     args = parser.parse_args()
 
     print(parser.format_values())
@@ -34,57 +54,148 @@ def parse_script_arguments():
     return args
 
 
-def retrieve_images(hdf5_file):
-    # retrieve images and close file
-    images = np.array(hdf5_file["images"])
-
-    # reorder axes to 1000, 64, 64, 3
-    images = np.transpose(images[:, 1:4, :, :], axes=[0, 2, 3, 1])
-    images = images[:, :, :, ::-1]  # B, G, R --> R, G, B
-    # Normalize values to be between 0 and 255
-    images *= 255.0 / np.max(images)
-    images = np.clip(images, 0, 255).astype(np.uint8)
+def retrieve_images(hdf5_file, per_image=False, percentile=None):
+    # RGB uint8 images of shape 1000, 64, 64, 3, normalized to be between 0 and 255
+    return normalize_images(images=hdf5_file["images"], per_image=per_image, percentile=percentile)
 
-    return images
 
+def get_image_name(sub_dir, img_indx):
+    return sub_dir + "_" + f"image_{img_indx}.jpeg"
 
-def save_images_as_png(images, image_dir, sub_dir):
-    if not isinstance(images, np.ndarray):
-        raise ValueError("Given images array does not have proper format.")
-    if len(images.shape) != 4:
-        raise ValueError("Given images array does not have proper shape.")
 
-    image_dir = os.path.join(image_dir, sub_dir)
-    if not os.path.isdir(image_dir):
-        os.makedirs(image_dir)
+def get_image_path(image_dir, sub_dir, img_indx):
+    return os.path.join(image_dir, sub_dir, get_image_name(sub_dir=sub_dir, img_indx=img_indx))
 
-    for img_indx in range(images.shape[0]):
-        # create image path
-        img_path = os.path.join(image_dir, sub_dir + "_" + f"image_{img_indx}.jpeg")
 
-        # retreive images
-        img = images[img_indx]
+def save_image(img, img_path):
+    # write to a temporary file first so an interrupted export never leaves a truncated image behind
+    temporary_path = img_path + ".tmp"
+    with stage("encode", rows=1) as span:
         pil_img = Image.fromarray(img).convert("RGB")
-
-        # save image to the aforementioned path
-        pil_img.save(img_path)
+        pil_img.save(temporary_path, format="JPEG")
+        os.replace(temporary_path, img_path)
+        span.add(nbytes=os.path.getsize(img_path))
+
+
+def encode_jpeg(img):
+    # same bytes as save_image writes, kept in memory
+    buffer = io.BytesIO()
+    pil_img = Image.fromarray(img).convert("RGB")
+    pil_img.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def export_images_in_parallel(
+    hdf5_file,
+    image_dir,
+    sub_dir,
+    executor,
+    block_size,
+    max_pending,
+    overwrite=False,
+    per_image=False,
+    percentile=None,
+):
+    images_dset = hdf5_file["images"]
+    num_images = images_dset.shape[0]
+
+    if not os.path.isdir(os.path.join(image_dir, sub_dir)):
+        os.makedirs(os.path.join(image_dir, sub_dir))
+
+    img_paths = [get_image_path(image_dir=image_dir, sub_dir=sub_dir, img_indx=i) for i in range(num_images)]
+    is_missing = np.array([overwrite or not os.path.isfile(img_path) for img_path in img_paths], dtype=bool)
+    if not is_missing.any():
+        return 0
+
+    # rgb bands of one image, the part of each row that is read
+    rgb_nbytes = 3 * images_dset.shape[2] * images_dset.shape[3] * images_dset.dtype.itemsize
+
+    scale_value = None
+    if not per_image:
+        scale_value = get_scale_value(images=images_dset, block_size=block_size, percentile=percentile)
+
+    pending = set()
+    for start in range(0, num_images, block_size):
+        end = min(start + block_size, num_images)
+        if not is_missing[start:end].any():
+            continue
+
+        with stage("read", rows=end - start, nbytes=(end - start) * rgb_nbytes):
+            images = normalize_images(
+                images=images_dset,
+                start=start,
+                end=end,
+                scale_value=scale_value,
+                per_image=per_image,
+                percentile=percentile,
+                block_size=block_size,
+            )
+        for img_indx in range(start, end):
+            if not is_missing[img_indx]:
+                continue
+
+            # bounded number of in-flight images keeps memory flat
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+
+            pending.add(executor.submit(save_image, images[img_indx - start], img_paths[img_indx]))
+
+    for future in pending:
+        future.result()
+
+    return int(is_missing.sum())
+
+
+def export_images_from_regex(
+    regex,
+    image_dir,
+    workers=8,
+    block_size=256,
+    overwrite=False,
+    per_image=False,
+    percentile=None,
+    catalog=None,
+):
+    hdf5_files = get_all_hdf5_files_from_regex(regex=regex, verbose=True, max_open_files=1, catalog=catalog)
+
+    with hdf5_files, ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(len(hdf5_files)):
+            main_file_name = hdf5_files.file_names[i].split("/")[-1]
+            assert main_file_name.endswith(".hdf5")
+            sub_dir = main_file_name[0 : len(main_file_name) - 5]
+
+            num_exported = export_images_in_parallel(
+                hdf5_file=hdf5_files[i],
+                image_dir=image_dir,
+                sub_dir=sub_dir,
+                executor=executor,
+                block_size=block_size,
+                max_pending=4 * workers,
+                overwrite=overwrite,
+                per_image=per_image,
+                percentile=percentile,
+            )
+            hdf5_files.close_file(i)
+
+            print("Exported ", num_exported, "new images to ", os.path.join(image_dir, sub_dir))
 
 
 def run_script():
     args = parse_script_arguments()
-
-    hdf5_file_names = get_all_hdf5_filenames_from_regex(regex=args.regex, verbose=True)
-
-    for i in range(len(hdf5_file_names)):
-        hdf5_file = open_hdf5_file(filepath=hdf5_file_names[i])
-        images = retrieve_images(hdf5_file=hdf5_file)
-        hdf5_file.close()
-
-        main_file_name = hdf5_file_names[i].split("/")[-1]
-        assert main_file_name.endswith(".hdf5")
-        sub_dir = main_file_name[0 : len(main_file_name) - 5]
-
-        save_images_as_png(images=images, image_dir=args.image_dir, sub_dir=sub_dir)
+    start_instrumentation(script_name="retrieve_images", args=args)
+
+    export_images_from_regex(
+        regex=args.regex,
+        image_dir=args.image_dir,
+        workers=args.workers,
+        block_size=args.block_size,
+        overwrite=args.overwrite,
+        per_image=args.per_image,
+        percentile=args.percentile,
+        catalog=open_corpus_catalog(catalog_path=args.catalog_path),
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,376 @@
+# imports from packages
+import argparse
+import configargparse
+import json
+import math
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# imports from our code
+from ..duplicate_analysis.check_duplicates_utils import get_chunk_size, get_first_occurrence_mask, hash_list_of_files
+from ..duplicate_analysis.digest_set import DigestSet
+from ..duplicate_analysis.hash_utils import DEFAULT_BLOCK_SIZE
+from ..duplicate_analysis.mix_positives import get_common_keys_of_regexes, get_mixture_interleave_indices
+from ..hdf5_handling.retrieve_images import export_images_in_parallel
+from ..utils.corpus_catalog import open_corpus_catalog
+from ..utils.hdf5_utils import DEFAULT_CHUNK_TARGET_MB, save_task_file
+from ..utils.instrumentation import add_instrumentation_arguments, start_instrumentation
+from ..utils.virtual_corpus import VirtualCorpus
+
+
+PLAN_FILE_NAME = "plan.npz"
+PROGRESS_FILE_NAME = "completed_tasks.json"
+
+
+def parse_script_arguments():
+    parser = argparse.ArgumentParser()
+    parser = configargparse.ArgumentParser(
+        config_file_parser_class=configargparse.YAMLConfigFileParser,
+        parents=[parser],
+        add_help=False,
+    )
+
+    # config argparse
+    parser.add_argument("--config", is_config_file=True)
+
+    # input corpora, and where the task files and their images are written
+    parser.add_argument("--pos_regex", type=str)
+    parser.add_argument("--neg_regex", type=str)
+    parser.add_argument("--save_dir", type=str)
+    parser.add_argument("--image_dir", type=str)
+
+    # dedup options: duplicates within each corpus, and negatives that are also positives
+    parser.add_argument("--dedup_positives", action="store_true")
+    parser.add_argument("--dedup_negatives", action="store_true")
+    parser.add_argument("--remove_positives_from_negatives", action="store_true")
+    parser.add_argument("--hash_type", type=str, default="sha256", choices=["sha256", "blake2b128"])
+    parser.add_argument("--block_size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--workers", type=int, default=1)
+
+    # mix options
+    parser.add_argument("--negative_samples", type=int)
+    parser.add_argument("--positive_samples", type=int)
+    parser.add_argument("--seed", type=int, default=None)
+
+    # task file options
+    parser.add_argument("--chunk_size", type=int)
+    parser.add_argument("--compression", type=str, default=None, choices=["gzip", "lzf"])
+    parser.add_argument("--target_file_size_mb", type=float, default=None)
+    # size of one hdf5 chunk of the written datasets
+    parser.add_argument("--chunk_target_mb", type=float, default=DEFAULT_CHUNK_TARGET_MB)
+
+    # image export options
+    parser.add_argument("--image_workers", type=int, default=8)
+    parser.add_argument("--per_image", action="store_true")
+    parser.add_argument("--percentile", type=float, default=None)
+
+    # the sampled rows and the finished task files are checkpointed here, so a rerun resumes (optional)
+    parser.add_argument("--checkpoint_dir", type=str, default=None)
+
+    # json catalog of file names, keys and shapes of the matched hdf5 files (optional)
+    parser.add_argument("--catalog_path", type=str, default=None)
+
+    # per stage metrics and profiling
+    add_instrumentation_arguments(parser=parser)
+
+    args = parser.parse_args()
+    print(parser.format_values())
+
+    return args
+
+
+def hash_corpus(corpus, keys, hash_type, block_size, workers):
+    # one digest per row of every file, in file order
+    hashed_files = hash_list_of_files(
+        list_of_files=corpus.hdf5_files,
+        keys=keys,
+        hash_type=hash_type,
+        block_size=block_size,
+        workers=workers,
+    )
+    return [digests for digests, _ in hashed_files]
+
+
+def get_first_occurrence_mask_of_corpus(digests_per_file, hash_type):
+    # same rows as remove_duplicates_from_single_list_of_files keeps, in the same order
+    seen_digests = DigestSet(hash_type=hash_type)
+    masks = [get_first_occurrence_mask(digests=digests, seen_digests=seen_digests) for digests in digests_per_file]
+    return np.concatenate([np.zeros(0, dtype=bool)] + masks)
+
+
+def get_candidate_masks(positive_corpus, negative_corpus, keys, args):
+    # rows that survive dedup, as masks over the global rows of each corpus; nothing but digests is kept
+    positive_mask = np.ones(len(positive_corpus), dtype=bool)
+    negative_mask = np.ones(len(negative_corpus), dtype=bool)
+
+    options = {"keys": keys, "hash_type": args.hash_type, "block_size": args.block_size, "workers": args.workers}
+    positive_digests = None
+    if args.dedup_positives or args.remove_positives_from_negatives:
+        positive_digests = hash_corpus(corpus=positive_corpus, **options)
+    negative_digests = None
+    if args.dedup_negatives or args.remove_positives_from_negatives:
+        negative_digests = hash_corpus(corpus=negative_corpus, **options)
+
+    if args.dedup_positives:
+        positive_mask = get_first_occurrence_mask_of_corpus(digests_per_file=positive_digests, hash_type=args.hash_type)
+    if args.dedup_negatives:
+        negative_mask = get_first_occurrence_mask_of_corpus(digests_per_file=negative_digests, hash_type=args.hash_type)
+
+    if args.remove_positives_from_negatives:
+        # same test as remove_duplicates_between_two_list_of_files, with the positives as source
+        seen_positives = DigestSet(hash_type=args.hash_type)
+        for digests in positive_digests:
+            seen_positives.add(digests=digests)
+        is_positive = [seen_positives.contains(digests=digests) for digests in negative_digests]
+        negative_mask &= ~np.concatenate([np.zeros(0, dtype=bool)] + is_positive)
+
+    print("\nPositives left after dedup: ", int(positive_mask.sum()), "of", len(positive_corpus))
+    print("Negatives left after dedup: ", int(negative_mask.sum()), "of", len(negative_corpus), "\n")
+
+    return positive_mask, negative_mask
+
+
+def sample_rows(candidate_indices, num_sample):
+    # same draw as lazily_sample_files in mix_positives, so a seeded run picks the same rows
+    assert num_sample <= candidate_indices.shape[0]
+    random_indices = np.random.choice(a=candidate_indices.shape[0], size=num_sample, replace=False)
+    return candidate_indices[random_indices]
+
+
+def get_mixture_plan(positive_corpus, negative_corpus, keys, args):
+    # global row indices of the sampled positives and negatives, in sample order
+    positive_mask, negative_mask = get_candidate_masks(
+        positive_corpus=positive_corpus,
+        negative_corpus=negative_corpus,
+        keys=keys,
+        args=args,
+    )
+
+    labels = positive_corpus["labels"][:].reshape(len(positive_corpus))
+    positive_candidates = np.flatnonzero(positive_mask & (labels == 1))
+    negative_candidates = np.flatnonzero(negative_mask)
+    print("Num true positives: ", positive_candidates.shape[0])
+
+    positive_indices = sample_rows(candidate_indices=positive_candidates, num_sample=args.positive_samples)
+    negative_indices = sample_rows(candidate_indices=negative_candidates, num_sample=args.negative_samples)
+
+    return positive_indices, negative_indices
+
+
+def get_plan_settings(positive_corpus, negative_corpus, args):
+    # a checkpointed plan (and the tasks written from it) is only reused for the same inputs and options
+    settings = {
+        "pos_files": positive_corpus.hdf5_files.file_names,
+        "neg_files": negative_corpus.hdf5_files.file_names,
+    }
+    for name in [
+        "dedup_positives",
+        "dedup_negatives",
+        "remove_positives_from_negatives",
+        "hash_type",
+        "positive_samples",
+        "negative_samples",
+        "seed",
+        "chunk_size",
+        "target_file_size_mb",
+        "compression",
+        "chunk_target_mb",
+        "per_image",
+        "percentile",
+    ]:
+        settings[name] = getattr(args, name)
+
+    return json.dumps(settings, sort_keys=True)
+
+
+def load_or_create_mixture_plan(positive_corpus, negative_corpus, keys, args):
+    # returns the sampled rows, and whether they came from the checkpoint
+    plan_path = None
+    settings = get_plan_settings(positive_corpus=positive_corpus, negative_corpus=negative_corpus, args=args)
+    if args.checkpoint_dir is not None:
+        plan_path = os.path.join(args.checkpoint_dir, PLAN_FILE_NAME)
+
+    if plan_path is not None and os.path.isfile(plan_path):
+        plan = np.load(plan_path)
+        if str(plan["settings"]) == settings:
+            print("\nLoaded sampled rows from checkpoint: ", plan_path, "\n")
+            return plan["positive_indices"], plan["negative_indices"], True
+
+    positive_indices, negative_indices = get_mixture_plan(
+        positive_corpus=positive_corpus,
+        negative_corpus=negative_corpus,
+        keys=keys,
+        args=args,
+    )
+
+    if plan_path is not None:
+        if not os.path.isdir(args.checkpoint_dir):
+            os.makedirs(args.checkpoint_dir)
+        with open(plan_path + ".tmp", "wb") as plan_file:
+            np.savez(
+                plan_file,
+                settings=np.array(settings),
+                positive_indices=positive_indices,
+                negative_indices=negative_indices,
+            )
+        os.replace(plan_path + ".tmp", plan_path)
+
+    return positive_indices, negative_indices, False
+
+
+def load_completed_tasks(checkpoint_dir):
+    if checkpoint_dir is None or not os.path.isfile(os.path.join(checkpoint_dir, PROGRESS_FILE_NAME)):
+        return set()
+
+    with open(os.path.join(checkpoint_dir, PROGRESS_FILE_NAME), "r") as progress_file:
+        return set(json.load(progress_file))
+
+
+def save_completed_tasks(checkpoint_dir, completed_tasks):
+    if checkpoint_dir is None:
+        return
+
+    progress_path = os.path.join(checkpoint_dir, PROGRESS_FILE_NAME)
+    with open(progress_path + ".tmp", "w") as progress_file:
+        json.dump(sorted(completed_tasks), progress_file)
+    os.replace(progress_path + ".tmp", progress_path)
+
+
+def iterate_task_datasets(
+    positive_corpus,
+    negative_corpus,
+    positive_indices,
+    negative_indices,
+    keys,
+    chunk_size,
+    completed_tasks,
+):
+    # yields (task index, datasets) for every task file, reading only that task's sampled rows
+    assert negative_indices.shape[0] % positive_indices.shape[0] == 0
+    assert negative_indices.shape[0] >= positive_indices.shape[0]
+    neg_pos_ratio = negative_indices.shape[0] // positive_indices.shape[0]
+
+    # every row of the mixture, as in create_mixture_dsets: one positive, then neg_pos_ratio negatives
+    is_positive, source_indices = get_mixture_interleave_indices(
+        num_chunks=positive_indices.shape[0],
+        neg_pos_ratio=neg_pos_ratio,
+    )
+    global_indices = np.where(
+        is_positive,
+        positive_indices[np.where(is_positive, source_indices, 0)],
+        negative_indices[np.where(is_positive, 0, source_indices)],
+    )
+
+    num_tasks = math.ceil(is_positive.shape[0] / chunk_size)
+    for task_index in range(num_tasks):
+        if task_index in completed_tasks:
+            continue
+
+        start = task_index * chunk_size
+        end = min(start + chunk_size, is_positive.shape[0])
+        task_is_positive = is_positive[start:end]
+
+        task_indices = global_indices[start:end]
+        positive_rows = positive_corpus.read_rows(global_indices=task_indices[task_is_positive], keys=keys)
+        negative_rows = negative_corpus.read_rows(global_indices=task_indices[~task_is_positive], keys=keys)
+
+        task_dsets = {}
+        for key in keys:
+            task_dsets[key] = np.empty(
+                (end - start,) + positive_rows[key].shape[1:],
+                dtype=np.result_type(positive_rows[key], negative_rows[key]),
+            )
+            task_dsets[key][task_is_positive] = positive_rows[key]
+            task_dsets[key][~task_is_positive] = negative_rows[key]
+
+        yield task_index, task_dsets
+
+
+def run_labelling_round(args, catalog=None):
+    # dedup -> mix -> export without intermediate files: both corpora are hashed in full first (the digests of
+    # every row are held in memory), mixing only picks row indices, then a generator reads one task file's rows
+    # at a time, which are written as task_<i>.hdf5 and exported as images from memory
+    if args.seed is not None:
+        np.random.seed(args.seed)
+
+    keys = sorted(get_common_keys_of_regexes(regexes=[args.neg_regex, args.pos_regex], catalog=catalog))
+    print("\nCommon keys: ", keys, "\n")
+
+    positive_corpus = VirtualCorpus.from_regex(regex=args.pos_regex, keys=keys, verbose=True, catalog=catalog)
+    negative_corpus = VirtualCorpus.from_regex(regex=args.neg_regex, keys=keys, verbose=True, catalog=catalog)
+
+    positive_indices, negative_indices, is_resumed = load_or_create_mixture_plan(
+        positive_corpus=positive_corpus,
+        negative_corpus=negative_corpus,
+        keys=keys,
+        args=args,
+    )
+
+    num_rows = positive_indices.shape[0] + negative_indices.shape[0]
+    assert args.chunk_size == 0 or num_rows % args.chunk_size == 0
+    chunk_size = get_chunk_size(
+        chunk_size=args.chunk_size,
+        datasets={key: positive_corpus[key] for key in keys},
+        target_file_size_mb=args.target_file_size_mb,
+    )
+
+    if not os.path.isdir(args.save_dir):
+        os.makedirs(args.save_dir)
+
+    completed_tasks = set()
+    if is_resumed:
+        completed_tasks = load_completed_tasks(checkpoint_dir=args.checkpoint_dir)
+        print("Task files already completed: ", len(completed_tasks), "\n")
+    task_datasets = iterate_task_datasets(
+        positive_corpus=positive_corpus,
+        negative_corpus=negative_corpus,
+        positive_indices=positive_indices,
+        negative_indices=negative_indices,
+        keys=keys,
+        chunk_size=chunk_size,
+        completed_tasks=completed_tasks,
+    )
+
+    with ThreadPoolExecutor(max_workers=args.image_workers) as executor:
+        for task_index, task_dsets in task_datasets:
+            task_name = "task_" + str(task_index)
+            save_task_file(
+                file_path=os.path.join(args.save_dir, task_name + ".hdf5"),
+                datasets=task_dsets,
+                compression=args.compression,
+                chunk_target_mb=args.chunk_target_mb,
+            )
+
+            num_exported = 0
+            if args.image_dir is not None:
+                # overwrite, since images of a task that did not complete may be from an earlier plan
+                num_exported = export_images_in_parallel(
+                    hdf5_file=task_dsets,
+                    image_dir=args.image_dir,
+                    sub_dir=task_name,
+                    executor=executor,
+                    block_size=args.block_size,
+                    max_pending=4 * args.image_workers,
+                    overwrite=True,
+                    per_image=args.per_image,
+                    percentile=args.percentile,
+                )
+
+            completed_tasks.add(task_index)
+            save_completed_tasks(checkpoint_dir=args.checkpoint_dir, completed_tasks=completed_tasks)
+            print("Saved ", task_name, "with", task_dsets[keys[0]].shape[0], "rows and", num_exported, "images")
+
+    positive_corpus.close()
+    negative_corpus.close()
+
+
+def run_script():
+    args = parse_script_arguments()
+    start_instrumentation(script_name="labelling_round", args=args)
+    catalog = open_corpus_catalog(catalog_path=args.catalog_path)
+    run_labelling_round(args=args, catalog=catalog)
+
+
+if __name__ == "__main__":
+    run_script()
@@ -1,21 +1,198 @@
 # general packages
 import boto3
+import io
 import os
+import random
+import threading
+import time
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
-def upload_files_to_bucket(file_names, bucket_name, bucket_key_prefix):
-    bucket = open_bucket(bucket_name=bucket_name)
+MB = 1024 * 1024
+DEFAULT_MAX_POOL_CONNECTIONS = 10
 
-    for file_name in file_names:
-        actual_file_name = os.path.basename(file_name)
-        filekey = os.path.join(bucket_key_prefix, actual_file_name)
-        bucket.upload_file(Filename=file_name, Key=filekey)
+# one session and client (and resource, once asked for) per process and endpoint / pool size, plus the buckets
+# already validated
+_connections = {}
+_validated_buckets = {}
+_connections_lock = threading.Lock()
 
 
-def open_bucket(bucket_name):
-    s3 = boto3.resource("s3")
-    bucket_names = [bucket.name for bucket in s3.buckets.all()]
-    assert bucket_name in bucket_names
+def get_s3_connection(endpoint_url=None, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    connection_key = (os.getpid(), endpoint_url, max_pool_connections)
+    with _connections_lock:
+        if connection_key not in _connections:
+            session = boto3.session.Session()
+            config = Config(max_pool_connections=max_pool_connections, retries={"max_attempts": 3, "mode": "standard"})
+            _connections[connection_key] = {
+                "session": session,
+                "config": config,
+                "client": session.client("s3", endpoint_url=endpoint_url, config=config),
+            }
 
+        return _connections[connection_key]
+
+
+def get_s3_client(endpoint_url=None, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    # boto3 clients are thread safe, so a single warm client is shared by all upload threads
+    return get_s3_connection(endpoint_url=endpoint_url, max_pool_connections=max_pool_connections)["client"]
+
+
+def get_s3_resource(endpoint_url=None, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    # created on first use only, since a resource holds a client (and connection pool) of its own
+    connection = get_s3_connection(endpoint_url=endpoint_url, max_pool_connections=max_pool_connections)
+    with _connections_lock:
+        if "resource" not in connection:
+            connection["resource"] = connection["session"].resource(
+                "s3",
+                endpoint_url=endpoint_url,
+                config=connection["config"],
+            )
+
+        return connection["resource"]
+
+
+def bucket_exists(bucket_name, client=None, endpoint_url=None):
+    # a single cached HEAD request, sent with the given client, instead of listing every bucket in the account
+    bucket_key = (os.getpid(), endpoint_url, bucket_name)
+    if bucket_key not in _validated_buckets:
+        if client is None:
+            client = get_s3_client(endpoint_url=endpoint_url)
+        try:
+            client.head_bucket(Bucket=bucket_name)
+            _validated_buckets[bucket_key] = True
+        except ClientError as error:
+            if error.response.get("Error", {}).get("Code") not in ("404", "NoSuchBucket"):
+                raise
+            _validated_buckets[bucket_key] = False
+
+    return _validated_buckets[bucket_key]
+
+
+def get_transfer_config(multipart_threshold_mb=8, multipart_chunksize_mb=8, max_concurrency=1):
+    # files are already uploaded concurrently, so by default each single transfer does not spawn more threads
+    return TransferConfig(
+        multipart_threshold=int(multipart_threshold_mb * MB),
+        multipart_chunksize=int(multipart_chunksize_mb * MB),
+        max_concurrency=max_concurrency,
+        use_threads=max_concurrency > 1,
+    )
+
+
+def upload_file_with_retries(client, file_name, bucket_name, filekey, transfer_config, max_retries, backoff_seconds):
+    for attempt in range(max_retries + 1):
+        try:
+            client.upload_file(Filename=file_name, Bucket=bucket_name, Key=filekey, Config=transfer_config)
+            return os.path.getsize(file_name)
+        except (BotoCoreError, ClientError, S3UploadFailedError):
+            if attempt == max_retries:
+                raise
+
+            # exponential backoff with jitter
+            time.sleep(backoff_seconds * (2**attempt) * (1 + random.random()))
+
+
+def upload_bytes_with_retries(client, data, bucket_name, filekey, transfer_config, max_retries, backoff_seconds):
+    # same as upload_file_with_retries, for content that only exists in memory
+    for attempt in range(max_retries + 1):
+        try:
+            client.upload_fileobj(Fileobj=io.BytesIO(data), Bucket=bucket_name, Key=filekey, Config=transfer_config)
+            return len(data)
+        except (BotoCoreError, ClientError, S3UploadFailedError):
+            if attempt == max_retries:
+                raise
+
+            # exponential backoff with jitter
+            time.sleep(backoff_seconds * (2**attempt) * (1 + random.random()))
+
+
+def print_upload_report(bucket_key_prefix, num_files, num_bytes, num_failed, seconds):
+    seconds = max(seconds, 1e-9)
+    print("\nUploaded to: ", bucket_key_prefix)
+    print("Files: ", num_files, "failed: ", num_failed)
+    print("Size: ", round(num_bytes / MB, 2), "MB")
+    print("Time: ", round(seconds, 2), "seconds")
+    print("Throughput: ", round(num_files / seconds, 2), "files/s,", round(num_bytes / MB / seconds, 2), "MB/s\n")
+
+
+def upload_files_to_bucket(
+    file_names,
+    bucket_name,
+    bucket_key_prefix,
+    client=None,
+    workers=16,
+    transfer_config=None,
+    max_retries=5,
+    backoff_seconds=0.5,
+    endpoint_url=None,
+    verbose=False,
+):
+    if client is None:
+        client = get_s3_client(
+            endpoint_url=endpoint_url,
+            max_pool_connections=max(workers, DEFAULT_MAX_POOL_CONNECTIONS),
+        )
+    if transfer_config is None:
+        transfer_config = get_transfer_config()
+
+    assert bucket_exists(bucket_name=bucket_name, client=client, endpoint_url=endpoint_url)
+
+    start = time.time()
+    num_bytes = 0
+    num_uploaded = 0
+    failed_file_names = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for file_name in file_names:
+            actual_file_name = os.path.basename(file_name)
+            filekey = os.path.join(bucket_key_prefix, actual_file_name)
+            future = executor.submit(
+                upload_file_with_retries,
+                client=client,
+                file_name=file_name,
+                bucket_name=bucket_name,
+                filekey=filekey,
+                transfer_config=transfer_config,
+                max_retries=max_retries,
+                backoff_seconds=backoff_seconds,
+            )
+            futures[future] = file_name
+
+        for future in as_completed(futures):
+            try:
+                num_bytes += future.result()
+                num_uploaded += 1
+            except (BotoCoreError, ClientError, S3UploadFailedError) as error:
+                print("Failed to upload ", futures[future], ": ", error)
+                failed_file_names.append(futures[future])
+
+            if verbose and num_uploaded > 0 and num_uploaded % 1000 == 0:
+                print("Uploaded ", num_uploaded, "/", len(file_names), "files")
+
+    print_upload_report(
+        bucket_key_prefix=bucket_key_prefix,
+        num_files=num_uploaded,
+        num_bytes=num_bytes,
+        num_failed=len(failed_file_names),
+        seconds=time.time() - start,
+    )
+
+    return {
+        "num_files": num_uploaded,
+        "num_bytes": num_bytes,
+        "failed_file_names": failed_file_names,
+        "seconds": time.time() - start,
+    }
+
+
+def open_bucket(bucket_name, client=None, endpoint_url=None):
+    assert bucket_exists(bucket_name=bucket_name, client=client, endpoint_url=endpoint_url)
+
+    s3 = get_s3_resource(endpoint_url=endpoint_url)
     bucket = s3.Bucket(bucket_name)
     return bucket
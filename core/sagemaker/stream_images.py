@@ -0,0 +1,270 @@
+# general imports
+import argparse
+import configargparse
+import os
+import sys
+import time
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# imports from our packages
+from ..hdf5_handling.retrieve_images import encode_jpeg, get_image_name
+from ..utils.corpus_catalog import open_corpus_catalog
+from ..utils.hdf5_utils import get_all_hdf5_files_from_regex
+from ..utils.image_utils import get_scale_value, normalize_images
+from ..utils.instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from .sagemaker_utils import (
+    DEFAULT_MAX_POOL_CONNECTIONS,
+    bucket_exists,
+    get_s3_client,
+    get_transfer_config,
+    print_upload_report,
+    upload_bytes_with_retries,
+)
+from .upload_manifest import list_bucket_objects
+
+
+def parse_script_arguments():
+    parser = argparse.ArgumentParser()
+    parser = configargparse.ArgumentParser(
+        config_file_parser_class=configargparse.YAMLConfigFileParser,
+        parents=[parser],
+        add_help=False,
+    )
+
+    # config argparse
+    parser.add_argument("--config", is_config_file=True)
+
+    # task options
+    parser.add_argument("--regex", type=str)
+    parser.add_argument("--bucket_name", type=str)
+    parser.add_argument("--verbose", action="store_true")
+
+    # upload engine options
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--max_in_flight", type=int, default=256)
+    parser.add_argument("--max_retries", type=int, default=5)
+    parser.add_argument("--max_pool_connections", type=int, default=None)
+
+    # optional S3 compatible endpoint, e.g. a local stand-in for testing
+    parser.add_argument("--endpoint_url", type=str, default=None)
+
+    # skip images whose key is already in the bucket
+    parser.add_argument("--skip_existing", action="store_true")
+
+    # export options
+    parser.add_argument("--block_size", type=int, default=256)
+    parser.add_argument("--per_image", action="store_true")
+    parser.add_argument("--percentile", type=float, default=None)
+
+    # json catalog of file names, keys and shapes of the matched hdf5 files (optional)
+    parser.add_argument("--catalog_path", type=str, default=None)
+
+    # per stage metrics and profiling
+    add_instrumentation_arguments(parser=parser)
+
+    args = parser.parse_args()
+    print(parser.format_values())
+
+    return args
+
+
+def encode_and_upload_image(client, img, bucket_name, filekey, transfer_config, max_retries, backoff_seconds):
+    with stage("encode", rows=1) as span:
+        data = encode_jpeg(img=img)
+        span.add(nbytes=len(data))
+
+    with stage("upload", rows=1, nbytes=len(data)):
+        return upload_bytes_with_retries(
+            client=client,
+            data=data,
+            bucket_name=bucket_name,
+            filekey=filekey,
+            transfer_config=transfer_config,
+            max_retries=max_retries,
+            backoff_seconds=backoff_seconds,
+        )
+
+
+def stream_images_to_bucket(
+    hdf5_file,
+    sub_dir,
+    bucket_name,
+    client,
+    executor,
+    transfer_config,
+    block_size=256,
+    max_in_flight=256,
+    max_retries=5,
+    backoff_seconds=0.5,
+    existing_keys=None,
+    per_image=False,
+    percentile=None,
+):
+    # uploads the images of one hdf5 file to <sub_dir>/input/<sub_dir>_image_<i>.jpeg, the keys upload_files.py
+    # uses for an exported image directory. at most max_in_flight images are being encoded or uploaded, so
+    # memory holds those images plus the normalized blocks they come from
+    images_dset = hdf5_file["images"]
+    num_images = images_dset.shape[0]
+    bucket_key_prefix = os.path.join(sub_dir, "input")
+
+    filekeys = [os.path.join(bucket_key_prefix, get_image_name(sub_dir=sub_dir, img_indx=i)) for i in range(num_images)]
+    is_missing = [existing_keys is None or filekey not in existing_keys for filekey in filekeys]
+
+    report = {"num_files": 0, "num_bytes": 0, "failed_file_names": []}
+    if not any(is_missing):
+        return report
+
+    def collect(done_futures):
+        for future in done_futures:
+            try:
+                report["num_bytes"] += future.result()
+                report["num_files"] += 1
+            except (BotoCoreError, ClientError, S3UploadFailedError) as error:
+                print("Failed to upload ", pending_keys[future], ": ", error)
+                report["failed_file_names"].append(pending_keys[future])
+            del pending_keys[future]
+
+    scale_value = None
+    if not per_image:
+        scale_value = get_scale_value(images=images_dset, block_size=block_size, percentile=percentile)
+
+    pending = set()
+    pending_keys = {}
+    for start in range(0, num_images, block_size):
+        end = min(start + block_size, num_images)
+        if not any(is_missing[start:end]):
+            continue
+
+        with stage("read", rows=end - start):
+            images = normalize_images(
+                images=images_dset,
+                start=start,
+                end=end,
+                scale_value=scale_value,
+                per_image=per_image,
+                percentile=percentile,
+                block_size=block_size,
+            )
+
+        for img_indx in range(start, end):
+            if not is_missing[img_indx]:
+                continue
+
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done_futures=done)
+
+            future = executor.submit(
+                encode_and_upload_image,
+                client=client,
+                img=images[img_indx - start],
+                bucket_name=bucket_name,
+                filekey=filekeys[img_indx],
+                transfer_config=transfer_config,
+                max_retries=max_retries,
+                backoff_seconds=backoff_seconds,
+            )
+            pending.add(future)
+            pending_keys[future] = filekeys[img_indx]
+
+    collect(done_futures=wait(pending).done)
+
+    return report
+
+
+def stream_images_from_regex(
+    regex,
+    bucket_name,
+    workers=16,
+    max_in_flight=256,
+    block_size=256,
+    max_retries=5,
+    max_pool_connections=None,
+    endpoint_url=None,
+    skip_existing=False,
+    per_image=False,
+    percentile=None,
+    verbose=False,
+    catalog=None,
+):
+    if max_pool_connections is None:
+        max_pool_connections = max(workers, DEFAULT_MAX_POOL_CONNECTIONS)
+    client = get_s3_client(endpoint_url=endpoint_url, max_pool_connections=max_pool_connections)
+    transfer_config = get_transfer_config()
+    assert bucket_exists(bucket_name=bucket_name, client=client, endpoint_url=endpoint_url)
+
+    hdf5_files = get_all_hdf5_files_from_regex(regex=regex, verbose=verbose, max_open_files=1, catalog=catalog)
+    failed_file_names = []
+
+    with hdf5_files, ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(len(hdf5_files)):
+            main_file_name = hdf5_files.file_names[i].split("/")[-1]
+            assert main_file_name.endswith(".hdf5")
+            sub_dir = main_file_name[0 : len(main_file_name) - 5]
+
+            existing_keys = None
+            if skip_existing:
+                existing_keys = list_bucket_objects(
+                    client=client,
+                    bucket_name=bucket_name,
+                    prefix=os.path.join(sub_dir, "input") + "/",
+                )
+
+            start = time.time()
+            report = stream_images_to_bucket(
+                hdf5_file=hdf5_files[i],
+                sub_dir=sub_dir,
+                bucket_name=bucket_name,
+                client=client,
+                executor=executor,
+                transfer_config=transfer_config,
+                block_size=block_size,
+                max_in_flight=max_in_flight,
+                max_retries=max_retries,
+                existing_keys=existing_keys,
+                per_image=per_image,
+                percentile=percentile,
+            )
+            hdf5_files.close_file(i)
+
+            print_upload_report(
+                bucket_key_prefix=os.path.join(sub_dir, "input"),
+                num_files=report["num_files"],
+                num_bytes=report["num_bytes"],
+                num_failed=len(report["failed_file_names"]),
+                seconds=time.time() - start,
+            )
+            failed_file_names += report["failed_file_names"]
+
+    return failed_file_names
+
+
+def run_script():
+    args = parse_script_arguments()
+    start_instrumentation(script_name="stream_images", args=args)
+
+    failed_file_names = stream_images_from_regex(
+        regex=args.regex,
+        bucket_name=args.bucket_name,
+        workers=args.workers,
+        max_in_flight=args.max_in_flight,
+        block_size=args.block_size,
+        max_retries=args.max_retries,
+        max_pool_connections=args.max_pool_connections,
+        endpoint_url=args.endpoint_url,
+        skip_existing=args.skip_existing,
+        per_image=args.per_image,
+        percentile=args.percentile,
+        verbose=args.verbose,
+        catalog=open_corpus_catalog(catalog_path=args.catalog_path),
+    )
+
+    print("\nImages that failed to upload: ", len(failed_file_names))
+    if len(failed_file_names) > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_script()
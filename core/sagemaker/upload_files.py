@@ -3,10 +3,22 @@ import argparse
 import configargparse
 import glob
 import os
+import sys
 import time
 
 # imports from our packages
-from .sagemaker_utils import upload_files_to_bucket
+from ..utils.instrumentation import add_instrumentation_arguments, stage, start_instrumentation
+from .sagemaker_utils import (
+    DEFAULT_MAX_POOL_CONNECTIONS,
+    get_s3_client,
+    get_transfer_config,
+    upload_files_to_bucket,
+)
+from .upload_manifest import (
+    MANIFEST_FILE_NAME,
+    UploadManifest,
+    list_bucket_objects,
+)
 
 
 def parse_script_arguments():
@@ -25,6 +37,25 @@ def parse_script_arguments():
     parser.add_argument("--bucket_name", type=str)
     parser.add_argument("--verbose", action="store_true")
 
+    # upload engine options
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--max_retries", type=int, default=5)
+    parser.add_argument("--multipart_threshold_mb", type=float, default=8)
+    parser.add_argument("--multipart_chunksize_mb", type=float, default=8)
+    parser.add_argument("--max_concurrency", type=int, default=1)
+    parser.add_argument("--max_pool_connections", type=int, default=None)
+
+    # optional S3 compatible endpoint, e.g. a local stand-in for testing
+    parser.add_argument("--endpoint_url", type=str, default=None)
+
+    # incremental sync options
+    parser.add_argument("--sync", action="store_true")
+    parser.add_argument("--manifest_path", type=str, default=None)
+    parser.add_argument("--reconcile", action="store_true")
+
+    # per stage metrics and profiling
+    add_instrumentation_arguments(parser=parser)
+
     # parse and print args
     args = parser.parse_args()
     print(parser.format_values())
@@ -40,13 +71,15 @@ def get_all_directory_elements(directory, content_type, verbose):
     else:
         raise ValueError("Given content type not supported.")
 
-    elements = []
-    for potential_element in os.listdir(directory):
-        path_to_element = os.path.join(directory, potential_element)
-        if check_function(path_to_element):
-            elements.append(path_to_element)
+    with stage("discover") as span:
+        elements = []
+        for potential_element in os.listdir(directory):
+            path_to_element = os.path.join(directory, potential_element)
+            if check_function(path_to_element):
+                elements.append(path_to_element)
 
-    elements.sort()
+        elements.sort()
+        span.add(rows=len(elements))
 
     if verbose:
         print("\nDirectory name: ", directory)
@@ -59,8 +92,31 @@ def get_all_directory_elements(directory, content_type, verbose):
     return elements
 
 
+def select_images_to_sync(manifest, client, images, bucket_name, bucket_key_prefix, reconcile):
+    filekeys = [os.path.join(bucket_key_prefix, os.path.basename(image)) for image in images]
+
+    bucket_objects = None
+    if reconcile:
+        bucket_objects = list_bucket_objects(client=client, bucket_name=bucket_name, prefix=bucket_key_prefix + "/")
+        num_removed = manifest.reconcile(bucket_objects=bucket_objects, prefix=bucket_key_prefix + "/")
+        print("\nManifest entries missing from or changed in the bucket: ", num_removed)
+
+    files_to_upload, num_skipped_bytes = manifest.select_files_to_upload(
+        file_names=images,
+        filekeys=filekeys,
+        bucket_objects=bucket_objects,
+    )
+
+    print("\nSubdirectory: ", bucket_key_prefix)
+    print("Files skipped: ", len(images) - len(files_to_upload), "bytes skipped: ", num_skipped_bytes)
+    print("Files to upload: ", len(files_to_upload), "\n")
+
+    return files_to_upload
+
+
 def run_script():
     args = parse_script_arguments()
+    start_instrumentation(script_name="upload_files", args=args)
 
     subdirs = get_all_directory_elements(
         directory=args.img_dir,
@@ -68,6 +124,24 @@ def run_script():
         verbose=args.verbose,
     )
 
+    max_pool_connections = args.max_pool_connections
+    if max_pool_connections is None:
+        max_pool_connections = max(args.workers, DEFAULT_MAX_POOL_CONNECTIONS)
+    client = get_s3_client(endpoint_url=args.endpoint_url, max_pool_connections=max_pool_connections)
+    transfer_config = get_transfer_config(
+        multipart_threshold_mb=args.multipart_threshold_mb,
+        multipart_chunksize_mb=args.multipart_chunksize_mb,
+        max_concurrency=args.max_concurrency,
+    )
+
+    manifest = None
+    if args.sync:
+        manifest_path = args.manifest_path
+        if manifest_path is None:
+            manifest_path = os.path.join(args.img_dir, MANIFEST_FILE_NAME)
+        manifest = UploadManifest(manifest_path=manifest_path, bucket_name=args.bucket_name)
+
+    failed_file_names = []
     for subdir in subdirs:
         start = time.time()
 
@@ -79,16 +153,53 @@ def run_script():
 
         bucket_key_prefix = os.path.join(images_to_upload[0].split("/")[-2], "input")
 
-        upload_files_to_bucket(
-            file_names=images_to_upload,
-            bucket_name=args.bucket_name,
-            bucket_key_prefix=bucket_key_prefix,
-        )
+        files_to_upload = None
+        if manifest is not None:
+            files_to_upload = select_images_to_sync(
+                manifest=manifest,
+                client=client,
+                images=images_to_upload,
+                bucket_name=args.bucket_name,
+                bucket_key_prefix=bucket_key_prefix,
+                reconcile=args.reconcile,
+            )
+            images_to_upload = [file_name for file_name, _, _ in files_to_upload]
+
+        if len(images_to_upload) == 0:
+            if manifest is not None:
+                manifest.save()
+            continue
+
+        with stage("upload") as span:
+            upload_report = upload_files_to_bucket(
+                file_names=images_to_upload,
+                bucket_name=args.bucket_name,
+                bucket_key_prefix=bucket_key_prefix,
+                client=client,
+                workers=args.workers,
+                transfer_config=transfer_config,
+                max_retries=args.max_retries,
+                endpoint_url=args.endpoint_url,
+                verbose=args.verbose,
+            )
+            span.add(rows=upload_report["num_files"], nbytes=upload_report["num_bytes"])
+        failed_file_names.extend(upload_report["failed_file_names"])
+
+        if manifest is not None:
+            subdir_failed_file_names = set(upload_report["failed_file_names"])
+            for file_name, filekey, content_md5 in files_to_upload:
+                if file_name not in subdir_failed_file_names:
+                    manifest.update(filekey=filekey, file_name=file_name, content_md5=content_md5)
+            manifest.save()
 
         end = time.time()
 
         print("\nTime took to upload ", len(images_to_upload), "files: ", end - start, "seconds.")
 
+    print("\nFiles that failed to upload: ", len(failed_file_names))
+    if len(failed_file_names) > 0:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     start = time.time()
@@ -0,0 +1,114 @@
+# general packages
+import json
+import os
+from hashlib import md5
+
+
+MANIFEST_FILE_NAME = ".upload_manifest.json"
+
+
+def compute_file_md5(file_name, block_size=1024 * 1024):
+    # md5 matches the ETag S3 reports for objects uploaded in a single part
+    hash_encoder = md5()
+    with open(file_name, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            hash_encoder.update(block)
+
+    return hash_encoder.hexdigest()
+
+
+def get_file_stat(file_name):
+    stat = os.stat(file_name)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def list_bucket_objects(client, bucket_name, prefix):
+    bucket_objects = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for bucket_object in page.get("Contents", []):
+            bucket_objects[bucket_object["Key"]] = {
+                "size": bucket_object["Size"],
+                "etag": bucket_object["ETag"].strip('"'),
+            }
+
+    return bucket_objects
+
+
+class UploadManifest:
+    # local record of every uploaded key: source path, size, mtime and md5 of the uploaded content.
+    # records are kept per bucket, so syncing the same directory to another bucket uploads everything again
+    def __init__(self, manifest_path, bucket_name):
+        self.manifest_path = manifest_path
+        self.bucket_name = bucket_name
+        self.buckets = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "r") as manifest_file:
+                # a manifest without per bucket records does not say where its keys went, so it is not trusted
+                self.buckets = json.load(manifest_file).get("buckets", {})
+
+        self.entries = self.buckets.setdefault(bucket_name, {})
+
+    def save(self):
+        temporary_path = self.manifest_path + ".tmp"
+        with open(temporary_path, "w") as manifest_file:
+            json.dump({"buckets": self.buckets}, manifest_file, indent=1, sort_keys=True)
+        os.replace(temporary_path, self.manifest_path)
+
+    def update(self, filekey, file_name, content_md5=None):
+        size, mtime = get_file_stat(file_name=file_name)
+        self.entries[filekey] = {
+            "path": file_name,
+            "size": size,
+            "mtime": mtime,
+            "md5": content_md5 if content_md5 is not None else compute_file_md5(file_name=file_name),
+        }
+
+    def reconcile(self, bucket_objects, prefix):
+        # forget uploads that are no longer in the bucket under prefix, or differ from it
+        num_removed = 0
+        for filekey in list(self.entries):
+            if not filekey.startswith(prefix):
+                continue
+
+            bucket_object = bucket_objects.get(filekey)
+            entry = self.entries[filekey]
+            if bucket_object is None or bucket_object["size"] != entry["size"]:
+                del self.entries[filekey]
+                num_removed += 1
+            elif "-" not in bucket_object["etag"] and bucket_object["etag"] != entry["md5"]:
+                del self.entries[filekey]
+                num_removed += 1
+
+        return num_removed
+
+    def select_files_to_upload(self, file_names, filekeys, bucket_objects=None):
+        # returns the (file name, key, md5) triples that are new or changed, and the number of skipped bytes
+        files_to_upload = []
+        num_skipped_bytes = 0
+
+        for file_name, filekey in zip(file_names, filekeys):
+            size, mtime = get_file_stat(file_name=file_name)
+            entry = self.entries.get(filekey)
+
+            # unchanged size and mtime: trust the manifest without reading the file
+            if entry is not None and entry["size"] == size and entry["mtime"] == mtime:
+                num_skipped_bytes += size
+                continue
+
+            content_md5 = compute_file_md5(file_name=file_name)
+            if entry is not None and entry["size"] == size and entry["md5"] == content_md5:
+                self.update(filekey=filekey, file_name=file_name, content_md5=content_md5)
+                num_skipped_bytes += size
+                continue
+
+            # already in the bucket with identical content, e.g. uploaded before the manifest existed
+            bucket_object = None if bucket_objects is None else bucket_objects.get(filekey)
+            if bucket_object is not None and bucket_object["size"] == size and bucket_object["etag"] == content_md5:
+                self.update(filekey=filekey, file_name=file_name, content_md5=content_md5)
+                num_skipped_bytes += size
+                continue
+
+            files_to_upload.append((file_name, filekey, content_md5))
+
+        return files_to_upload, num_skipped_bytes
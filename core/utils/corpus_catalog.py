@@ -0,0 +1,233 @@
+import fnmatch
+import glob
+import h5py as h5
+import json
+import numpy as np
+import os
+
+
+CATALOG_VERSION = 2
+
+
+def split_regex(regex):
+    # (directory the pattern is rooted at, pattern parts below it); the root is the longest leading
+    # directory of the pattern without glob magic characters
+    parts = regex.split(os.sep)
+    num_root_parts = 0
+    while num_root_parts < len(parts) - 1 and not glob.has_magic(parts[num_root_parts]):
+        num_root_parts += 1
+
+    root_prefix = os.sep.join(parts[:num_root_parts]) + os.sep if num_root_parts > 0 else ""
+    root = root_prefix.rstrip(os.sep) or root_prefix
+    return root, root_prefix, parts[num_root_parts:]
+
+
+def is_hidden(name):
+    return name.startswith(".")
+
+
+def match_parts(path_parts, pattern_parts, is_directory=False):
+    # glob(recursive=True) matching of a path below the root; a directory matches if a path below it can
+    if len(path_parts) == 0:
+        return len(pattern_parts) > 0 if is_directory else all(pattern == "**" for pattern in pattern_parts)
+    if len(pattern_parts) == 0:
+        return False
+
+    name, pattern = path_parts[0], pattern_parts[0]
+    if pattern == "**":
+        # zero or more directories, like glob it does not descend into hidden ones
+        if match_parts(path_parts=path_parts, pattern_parts=pattern_parts[1:], is_directory=is_directory):
+            return True
+        return not is_hidden(name) and match_parts(
+            path_parts=path_parts[1:], pattern_parts=pattern_parts, is_directory=is_directory
+        )
+
+    if glob.has_magic(pattern) and is_hidden(name) and not is_hidden(pattern):
+        return False
+    return fnmatch.fnmatchcase(name, pattern) and match_parts(
+        path_parts=path_parts[1:], pattern_parts=pattern_parts[1:], is_directory=is_directory
+    )
+
+
+def list_directory(directory, mtime, root_prefix, pattern_parts):
+    # the sub directories a match can be below and the matching files of one directory
+    subdirectories = []
+    files = []
+    with os.scandir(directory or os.curdir) as entries:
+        for entry in entries:
+            path = os.path.join(directory, entry.name)
+            path_parts = path[len(root_prefix) :].split(os.sep)
+            try:
+                is_subdirectory = entry.is_dir()
+            except OSError:
+                is_subdirectory = False
+
+            if is_subdirectory:
+                if match_parts(path_parts=path_parts, pattern_parts=pattern_parts, is_directory=True):
+                    subdirectories.append(path)
+            elif match_parts(path_parts=path_parts, pattern_parts=pattern_parts):
+                files.append(path)
+
+    return {"mtime": mtime, "subdirectories": sorted(subdirectories), "files": sorted(files)}
+
+
+def update_directory_tree(regex, directories):
+    # every directory a match can be below is stat'ed, since a new file only changes the mtime of its own
+    # directory, but only directories whose mtime changed are listed again
+    root, root_prefix, pattern_parts = split_regex(regex=regex)
+    updated_directories = {}
+    is_modified = False
+
+    pending = [root]
+    while len(pending) > 0:
+        directory = pending.pop()
+        try:
+            mtime = os.stat(directory or os.curdir).st_mtime_ns
+        except FileNotFoundError:
+            is_modified = is_modified or directory in directories
+            continue
+        if not os.path.isdir(directory or os.curdir):
+            continue
+
+        listing = directories.get(directory)
+        if listing is None or listing["mtime"] != mtime:
+            listing = list_directory(
+                directory=directory, mtime=mtime, root_prefix=root_prefix, pattern_parts=pattern_parts
+            )
+            is_modified = True
+
+        updated_directories[directory] = listing
+        pending += listing["subdirectories"]
+
+    is_modified = is_modified or len(updated_directories) != len(directories)
+    return updated_directories, is_modified
+
+
+def read_file_metadata(file_name, stat):
+    entry = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "is_hdf5": h5.is_hdf5(file_name)}
+    if not entry["is_hdf5"]:
+        return entry
+
+    entry["keys"] = []
+    entry["datasets"] = {}
+    with h5.File(file_name, "r") as file:
+        for key in file.keys():
+            entry["keys"].append(key)
+            if isinstance(file[key], h5.Dataset):
+                entry["datasets"][key] = {"shape": list(file[key].shape), "dtype": file[key].dtype.str}
+
+    return entry
+
+
+class CorpusCatalog:
+    # json catalog of the files matched by each regex and of every file's keys, dataset shapes, dtypes,
+    # size and mtime; of the directories a regex searches only those whose mtime changed are listed again,
+    # and files are re-read only if their size or mtime changed
+    def __init__(self, catalog_path):
+        self.catalog_path = catalog_path
+        self.regexes = {}
+        self.files = {}
+
+        if os.path.isfile(catalog_path):
+            with open(catalog_path, "r") as catalog_file:
+                catalog = json.load(catalog_file)
+            if catalog.get("version") == CATALOG_VERSION:
+                self.regexes = catalog["regexes"]
+                self.files = catalog["files"]
+
+    def save(self):
+        catalog_dir = os.path.dirname(self.catalog_path)
+        if catalog_dir != "" and not os.path.isdir(catalog_dir):
+            os.makedirs(catalog_dir)
+
+        temporary_path = self.catalog_path + ".tmp"
+        with open(temporary_path, "w") as catalog_file:
+            json.dump({"version": CATALOG_VERSION, "regexes": self.regexes, "files": self.files}, catalog_file)
+        os.replace(temporary_path, self.catalog_path)
+
+    def get_candidates(self, regex):
+        regex_entry = self.regexes.get(regex, {"candidates": [], "directories": {}})
+        directories, is_modified = update_directory_tree(regex=regex, directories=regex_entry["directories"])
+        if not is_modified:
+            return regex_entry["candidates"], False
+
+        candidates = sorted(file_name for listing in directories.values() for file_name in listing["files"])
+        self.regexes[regex] = {"candidates": candidates, "directories": directories}
+        return candidates, True
+
+    def get_file_names(self, regex):
+        # sorted hdf5 files matched by regex, with the metadata of new or modified files refreshed
+        candidates, is_modified = self.get_candidates(regex=regex)
+
+        file_names = []
+        for file_name in candidates:
+            try:
+                stat = os.stat(file_name)
+            except FileNotFoundError:
+                continue
+            if not os.path.isfile(file_name):
+                continue
+
+            entry = self.files.get(file_name)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+                entry = read_file_metadata(file_name=file_name, stat=stat)
+                self.files[file_name] = entry
+                is_modified = True
+
+            if entry["is_hdf5"]:
+                file_names.append(file_name)
+
+        if is_modified:
+            self.save()
+
+        return file_names
+
+    def get_entry(self, file_name):
+        entry = self.files.get(file_name)
+        if entry is None:
+            stat = os.stat(file_name)
+            entry = read_file_metadata(file_name=file_name, stat=stat)
+            self.files[file_name] = entry
+
+        if not entry["is_hdf5"]:
+            raise ValueError(file_name + " is not a valid hdf5 file.")
+
+        return entry
+
+    def get_keys(self, file_name):
+        return set(self.get_entry(file_name=file_name)["keys"])
+
+    def get_common_keys(self, file_names):
+        common_keys = None
+        for file_name in file_names:
+            set_of_keys = self.get_keys(file_name=file_name)
+            common_keys = set_of_keys if common_keys is None else common_keys.intersection(set_of_keys)
+
+        return common_keys if common_keys is not None else set()
+
+    def get_shape(self, file_name, key):
+        return tuple(self.get_entry(file_name=file_name)["datasets"][key]["shape"])
+
+    def get_dtype(self, file_name, key):
+        return np.dtype(self.get_entry(file_name=file_name)["datasets"][key]["dtype"])
+
+    def get_num_datapoints(self, file_name, keys=None):
+        entry = self.get_entry(file_name=file_name)
+        keys = entry["keys"] if keys is None else keys
+
+        num_datapoints = None
+        for key in keys:
+            if num_datapoints is None:
+                num_datapoints = entry["datasets"][key]["shape"][0]
+            elif num_datapoints != entry["datasets"][key]["shape"][0]:
+                raise ValueError("Incompatible dataset.")
+
+        return num_datapoints
+
+
+def open_corpus_catalog(catalog_path=None):
+    # scripts run without a catalog (plain glob and file reads) unless a catalog path is given
+    if catalog_path is None:
+        return None
+
+    return CorpusCatalog(catalog_path=catalog_path)
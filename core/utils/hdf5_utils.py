@@ -2,6 +2,30 @@ import numpy as np
 import h5py as h5
 import os
 import glob
+import re
+import threading
+from collections import OrderedDict
+
+from .image_utils import SCALE_VALUE_ATTRIBUTE, get_max_band_value
+from .instrumentation import get_nbytes, stage
+
+
+DEFAULT_MAX_OPEN_FILES = 32
+
+# h5py raw data chunk cache, per open file: the default 1 MB / 521 slots cannot hold a single
+# block of image rows, so block reads would decompress the same chunks repeatedly
+DEFAULT_RDCC_NBYTES = 16 * 2**20
+DEFAULT_RDCC_NSLOTS = 10007
+DEFAULT_RDCC_W0 = 1.0
+
+# size of one hdf5 chunk of a written dataset, a whole number of rows
+DEFAULT_CHUNK_TARGET_MB = 1.0
+
+
+def get_natural_sort_key(file_name):
+    # numbers in file names compare as numbers, so task_2.hdf5 comes before task_10.hdf5 and the task files
+    # written by dedup or mix_positives are read back in the order of their rows
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", file_name)]
 
 
 def get_all_hdf5_files_in_a_directory(dir_path):
@@ -12,29 +36,29 @@ def get_all_hdf5_files_in_a_directory(dir_path):
             if os.path.isfile(object_path) and h5.is_hdf5(object_path):
                 valid_files.append(object_path)
 
-    valid_files.sort()
+    valid_files.sort(key=get_natural_sort_key)
     return valid_files
 
 
-def get_all_hdf5_files_from_regex(regex, verbose=False):
-    valid_file_names = get_all_hdf5_filenames_from_regex(regex=regex, verbose=verbose)
-
-    hdf5_files = []
-    for filepath in valid_file_names:
-        hdf5_file = open_hdf5_file(filepath=filepath)
-        hdf5_files.append(hdf5_file)
+def get_all_hdf5_files_from_regex(regex, verbose=False, max_open_files=DEFAULT_MAX_OPEN_FILES, catalog=None):
+    # files are opened lazily by the returned pool, on first access
+    valid_file_names = get_all_hdf5_filenames_from_regex(regex=regex, verbose=verbose, catalog=catalog)
+    return HDF5FilePool(file_names=valid_file_names, max_open_files=max_open_files, catalog=catalog)
 
-    return hdf5_files
 
+def get_all_hdf5_filenames_from_regex(regex, verbose=False, catalog=None):
+    with stage("discover") as span:
+        if catalog is not None:
+            valid_files = catalog.get_file_names(regex=regex)
+        else:
+            valid_files = []
+            possible_files = glob.glob(regex, recursive=True)
+            for file_name in possible_files:
+                if os.path.isfile(file_name) and h5.is_hdf5(file_name):
+                    valid_files.append(file_name)
 
-def get_all_hdf5_filenames_from_regex(regex, verbose=False):
-    valid_files = []
-    possible_files = glob.glob(regex, recursive=True)
-    for file_name in possible_files:
-        if os.path.isfile(file_name) and h5.is_hdf5(file_name):
-            valid_files.append(file_name)
-
-    valid_files.sort()
+        valid_files.sort(key=get_natural_sort_key)
+        span.add(rows=len(valid_files))
 
     if verbose:
         print("\nRegex: ", regex)
@@ -46,26 +70,149 @@ def get_all_hdf5_filenames_from_regex(regex, verbose=False):
 
 
 def get_common_keys(list_of_files):
-    if len(list_of_files) == 0:
-        return set()
+    # list_of_files can be any iterable of open files; a pool with a catalog answers without opening them
+    if isinstance(list_of_files, HDF5FilePool):
+        return list_of_files.get_common_keys()
 
-    common_keys = set(list_of_files[0].keys())
-    for i in range(1, len(list_of_files)):
-        set_of_keys = set(list_of_files[i].keys())
-        common_keys = common_keys.intersection(set_of_keys)
+    common_keys = None
+    for file in list_of_files:
+        set_of_keys = set(file.keys())
+        common_keys = set_of_keys if common_keys is None else common_keys.intersection(set_of_keys)
 
-    return common_keys
+    return common_keys if common_keys is not None else set()
 
 
-def open_hdf5_file(filepath):
+def open_hdf5_file(
+    filepath,
+    verbose=True,
+    rdcc_nbytes=DEFAULT_RDCC_NBYTES,
+    rdcc_nslots=DEFAULT_RDCC_NSLOTS,
+    rdcc_w0=DEFAULT_RDCC_W0,
+):
     if not h5.is_hdf5(filepath):
         raise ValueError(filepath + " is not a valid hdf5 file.")
-    print("File path: ", filepath)
+    if verbose:
+        print("File path: ", filepath)
 
-    file = h5.File(filepath, "r")
+    file = h5.File(filepath, "r", rdcc_nbytes=rdcc_nbytes, rdcc_nslots=rdcc_nslots, rdcc_w0=rdcc_w0)
     return file
 
 
+class HDF5FilePool:
+    # read only hdf5 files indexed like a list, opened lazily on first access; at most max_open_files
+    # handles stay open, and the least recently used one is closed (and reopened on demand) beyond that
+    def __init__(
+        self,
+        file_names,
+        max_open_files=DEFAULT_MAX_OPEN_FILES,
+        rdcc_nbytes=DEFAULT_RDCC_NBYTES,
+        rdcc_nslots=DEFAULT_RDCC_NSLOTS,
+        rdcc_w0=DEFAULT_RDCC_W0,
+        catalog=None,
+    ):
+        assert max_open_files > 0
+        self.file_names = list(file_names)
+        self.max_open_files = max_open_files
+        self.catalog = catalog
+        self.cache_options = {"rdcc_nbytes": rdcc_nbytes, "rdcc_nslots": rdcc_nslots, "rdcc_w0": rdcc_w0}
+        self.open_files = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.file_names)
+
+    def __getitem__(self, index):
+        index = range(len(self.file_names))[index]
+        with self.lock:
+            file = self.open_files.get(index)
+            # a handle closed by the caller is reopened instead of being returned
+            if file is not None and file.id.valid:
+                self.open_files.move_to_end(index)
+                return file
+
+            with stage("open"):
+                file = open_hdf5_file(filepath=self.file_names[index], verbose=False, **self.cache_options)
+            self.open_files[index] = file
+            self.open_files.move_to_end(index)
+
+            while len(self.open_files) > self.max_open_files:
+                _, evicted_file = self.open_files.popitem(last=False)
+                evicted_file.close()
+
+            return file
+
+    def __iter__(self):
+        for index in range(len(self.file_names)):
+            yield self[index]
+
+    @property
+    def num_open_files(self):
+        return len(self.open_files)
+
+    def get_common_keys(self):
+        if self.catalog is not None:
+            return self.catalog.get_common_keys(file_names=self.file_names)
+
+        common_keys = None
+        for file in self:
+            set_of_keys = set(file.keys())
+            common_keys = set_of_keys if common_keys is None else common_keys.intersection(set_of_keys)
+
+        return common_keys if common_keys is not None else set()
+
+    def get_shape(self, index, key):
+        if self.catalog is not None:
+            return self.catalog.get_shape(file_name=self.file_names[index], key=key)
+        return self[index][key].shape
+
+    def get_dtype(self, index, key):
+        if self.catalog is not None:
+            return self.catalog.get_dtype(file_name=self.file_names[index], key=key)
+        return self[index][key].dtype
+
+    def get_num_datapoints(self, index, keys=None):
+        # number of rows of file index, checked to be the same for all keys (default: every key of the file)
+        if self.catalog is not None:
+            return self.catalog.get_num_datapoints(file_name=self.file_names[index], keys=keys)
+
+        file = self[index]
+        num_datapoints = None
+        for key in file.keys() if keys is None else keys:
+            if num_datapoints is None:
+                num_datapoints = file[key].shape[0]
+            elif num_datapoints != file[key].shape[0]:
+                raise ValueError("Incompatible dataset.")
+
+        return num_datapoints
+
+    def get_nbytes(self, index, keys):
+        # uncompressed size of keys of file index
+        nbytes = 0
+        for key in keys:
+            shape = self.get_shape(index, key)
+            nbytes += int(np.prod(shape, dtype=np.int64)) * np.dtype(self.get_dtype(index, key)).itemsize
+
+        return nbytes
+
+    def close_file(self, index):
+        with self.lock:
+            file = self.open_files.pop(range(len(self.file_names))[index], None)
+            if file is not None:
+                file.close()
+
+    def close(self):
+        with self.lock:
+            while len(self.open_files) > 0:
+                _, file = self.open_files.popitem(last=False)
+                file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
 def retrieve_datasets_from_hdf5_file(hdf5_file, keys):
     datasets = {}
     len = None
@@ -77,3 +224,160 @@ def retrieve_datasets_from_hdf5_file(hdf5_file, keys):
             raise ValueError("Different datasets in same HDF5 file have different shapes.")
 
     return len, datasets
+
+
+def get_rows_per_chunk(row_shape, dtype, chunk_target_mb=DEFAULT_CHUNK_TARGET_MB):
+    row_nbytes = int(np.prod(row_shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+    return max(1, int(chunk_target_mb * 2**20) // max(row_nbytes, 1))
+
+
+def get_row_nbytes(datasets):
+    row_nbytes = 0
+    for key in datasets:
+        row_nbytes += int(np.prod(datasets[key].shape[1:], dtype=np.int64)) * np.dtype(datasets[key].dtype).itemsize
+
+    return row_nbytes
+
+
+def get_chunk_size_for_target_file_size(datasets, target_file_size_mb):
+    # number of rows per task file so that an uncompressed file is about target_file_size_mb
+    return max(1, int(target_file_size_mb * 2**20) // max(get_row_nbytes(datasets=datasets), 1))
+
+
+def get_dataset_creation_options(
+    row_shape,
+    dtype,
+    num_rows,
+    compression=None,
+    compression_level=4,
+    chunk_target_mb=DEFAULT_CHUNK_TARGET_MB,
+):
+    # chunks hold whole rows so reading one row never decompresses a neighbouring tile's bytes twice
+    options = {}
+    if num_rows > 0 and all(dim > 0 for dim in row_shape):
+        rows_per_chunk = min(
+            num_rows, get_rows_per_chunk(row_shape=row_shape, dtype=dtype, chunk_target_mb=chunk_target_mb)
+        )
+        options["chunks"] = (rows_per_chunk,) + tuple(row_shape)
+
+        if compression is not None:
+            options["compression"] = compression
+            options["shuffle"] = True
+            if compression == "gzip":
+                options["compression_opts"] = compression_level
+
+    return options
+
+
+def store_scale_value(dataset, images):
+    # keeps the max over the RGB bands of everything written to an images dataset, so readers need no full scan
+    if dataset is None or images is None:
+        return
+
+    scale_value = get_max_band_value(images=np.asarray(images))
+    if scale_value is None:
+        return
+    if SCALE_VALUE_ATTRIBUTE in dataset.attrs:
+        scale_value = max(scale_value, dataset.attrs[SCALE_VALUE_ATTRIBUTE])
+    dataset.attrs[SCALE_VALUE_ATTRIBUTE] = scale_value
+
+
+def save_task_file(file_path, datasets, compression=None, chunk_target_mb=DEFAULT_CHUNK_TARGET_MB):
+    num_rows = datasets[next(iter(datasets))].shape[0] if len(datasets) > 0 else 0
+    with stage("write", rows=num_rows, nbytes=get_nbytes(datasets=datasets)):
+        file = h5.File(file_path, "w")
+        for key in datasets:
+            options = get_dataset_creation_options(
+                row_shape=datasets[key].shape[1:],
+                dtype=datasets[key].dtype,
+                num_rows=datasets[key].shape[0],
+                compression=compression,
+                chunk_target_mb=chunk_target_mb,
+            )
+            file.create_dataset(key, data=datasets[key], **options)
+
+        store_scale_value(dataset=file.get("images"), images=datasets.get("images"))
+        file.close()
+    return file_path
+
+
+class TaskFileWriter:
+    # appends rows to resizable, chunked datasets in save_dir/task_<i>.hdf5, rolling over every chunk_size rows
+    def __init__(self, save_dir, chunk_size, compression=None, chunk_target_mb=DEFAULT_CHUNK_TARGET_MB):
+        assert chunk_size > 0
+        assert save_dir is not None and isinstance(save_dir, str)
+        if not os.path.isdir(save_dir):
+            os.makedirs(save_dir)
+
+        self.save_dir = save_dir
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.chunk_target_mb = chunk_target_mb
+        self.num_files = 0
+        self.num_rows_written = 0
+        self.file = None
+        self.rows_in_file = 0
+
+    def _open_next_file(self, slabs):
+        file_path = os.path.join(self.save_dir, "task_" + str(self.num_files) + ".hdf5")
+        self.file = h5.File(file_path, "w")
+        self.num_files += 1
+        self.rows_in_file = 0
+
+        for key in slabs:
+            row_shape = slabs[key].shape[1:]
+            options = get_dataset_creation_options(
+                row_shape=row_shape,
+                dtype=slabs[key].dtype,
+                num_rows=self.chunk_size,
+                compression=self.compression,
+                chunk_target_mb=self.chunk_target_mb,
+            )
+            self.file.create_dataset(
+                key,
+                shape=(0,) + row_shape,
+                maxshape=(self.chunk_size,) + row_shape,
+                dtype=slabs[key].dtype,
+                **options,
+            )
+
+    def write(self, slabs):
+        num_rows = None
+        for key in slabs:
+            if num_rows is None:
+                num_rows = slabs[key].shape[0]
+            elif num_rows != slabs[key].shape[0]:
+                raise ValueError("Incompatible dataset.")
+
+        with stage("write", rows=num_rows or 0, nbytes=get_nbytes(datasets=slabs)):
+            self._write(slabs=slabs, num_rows=num_rows)
+
+    def _write(self, slabs, num_rows):
+        start = 0
+        while num_rows is not None and start < num_rows:
+            if self.file is None or self.rows_in_file == self.chunk_size:
+                self.close()
+                self._open_next_file(slabs=slabs)
+
+            end = min(num_rows, start + self.chunk_size - self.rows_in_file)
+            for key in slabs:
+                dataset = self.file[key]
+                dataset.resize(self.rows_in_file + end - start, axis=0)
+                dataset[self.rows_in_file :] = slabs[key][start:end]
+                if key == "images":
+                    store_scale_value(dataset=dataset, images=slabs[key][start:end])
+
+            self.rows_in_file += end - start
+            self.num_rows_written += end - start
+            start = end
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,122 @@
+import numpy as np
+
+from .instrumentation import stage
+
+
+DEFAULT_BLOCK_SIZE = 256
+NUM_HISTOGRAM_BINS = 2**16
+
+# bands 1:4 of the images are B, G, R
+RGB_BANDS = slice(1, 4)
+
+# attribute of an images dataset holding the max over its RGB bands, written with the file
+SCALE_VALUE_ATTRIBUTE = "scale_value"
+
+
+def iterate_bands_in_blocks(images, start, end, block_size):
+    for block_start in range(start, end, block_size):
+        block_end = min(block_start + block_size, end)
+        yield block_start, block_end, images[block_start:block_end, RGB_BANDS]
+
+
+def get_max_band_value(images):
+    # max over the RGB bands of in memory images, or None when there are none
+    if images.ndim != 4 or images.shape[0] == 0 or images[:, RGB_BANDS].size == 0:
+        return None
+    return np.max(images[:, RGB_BANDS])
+
+
+def get_stored_scale_value(images):
+    attrs = getattr(images, "attrs", None)
+    if attrs is None or SCALE_VALUE_ATTRIBUTE not in attrs:
+        return None
+    return attrs[SCALE_VALUE_ATTRIBUTE]
+
+
+def get_scale_value(images, block_size=DEFAULT_BLOCK_SIZE, percentile=None):
+    # max (or approximate percentile, from a histogram) over the RGB bands of all images, read block by block.
+    # the max is taken from the images dataset when it was stored there at write time, without reading it
+    if percentile is None or percentile >= 100:
+        stored_scale_value = get_stored_scale_value(images=images)
+        if stored_scale_value is not None:
+            return stored_scale_value
+
+    num_images = images.shape[0]
+    min_value = None
+    max_value = None
+    with stage("read", rows=num_images) as span:
+        for _, _, bands in iterate_bands_in_blocks(images=images, start=0, end=num_images, block_size=block_size):
+            span.add(nbytes=bands.nbytes)
+            block_min = np.min(bands)
+            block_max = np.max(bands)
+            min_value = block_min if min_value is None else min(min_value, block_min)
+            max_value = block_max if max_value is None else max(max_value, block_max)
+
+    if percentile is None or percentile >= 100 or max_value is None or min_value == max_value:
+        return max_value
+
+    histogram = np.zeros(NUM_HISTOGRAM_BINS, dtype=np.int64)
+    with stage("read", rows=num_images) as span:
+        for _, _, bands in iterate_bands_in_blocks(images=images, start=0, end=num_images, block_size=block_size):
+            span.add(nbytes=bands.nbytes)
+            histogram += np.histogram(bands, bins=NUM_HISTOGRAM_BINS, range=(min_value, max_value))[0]
+
+    bin_index = np.searchsorted(np.cumsum(histogram), percentile / 100.0 * histogram.sum())
+    bin_edges = np.linspace(min_value, max_value, NUM_HISTOGRAM_BINS + 1)
+    return bands.dtype.type(bin_edges[min(bin_index + 1, NUM_HISTOGRAM_BINS)])
+
+
+def get_per_image_scale_values(bands, percentile=None):
+    flat_bands = bands.reshape(bands.shape[0], -1)
+    if percentile is None or percentile >= 100:
+        return np.max(flat_bands, axis=1)
+
+    return np.percentile(flat_bands, percentile, axis=1).astype(bands.dtype)
+
+
+def normalize_images(
+    images,
+    start=0,
+    end=None,
+    out=None,
+    scale_value=None,
+    per_image=False,
+    percentile=None,
+    block_size=DEFAULT_BLOCK_SIZE,
+):
+    # (N, C, H, W) images --> (N, H, W, 3) uint8 RGB, scaled so the max (or percentile) maps to 255;
+    # works block by block with one reused float buffer and writes straight into out
+    end = images.shape[0] if end is None else end
+    height, width = images.shape[2], images.shape[3]
+
+    if out is None:
+        out = np.empty((end - start, height, width, 3), dtype=np.uint8)
+    assert out.shape == (end - start, height, width, 3) and out.dtype == np.uint8
+
+    if not per_image and scale_value is None:
+        scale_value = get_scale_value(images=images, block_size=block_size, percentile=percentile)
+
+    work_buffer = None
+    for block_start, block_end, bands in iterate_bands_in_blocks(
+        images=images,
+        start=start,
+        end=end,
+        block_size=block_size,
+    ):
+        if work_buffer is None:
+            work_dtype = bands.dtype if np.issubdtype(bands.dtype, np.floating) else np.float32
+            work_buffer = np.empty((min(block_size, end - start), height, width, 3), dtype=work_dtype)
+
+        work = work_buffer[: block_end - block_start]
+        # reorder axes to B, 64, 64, 3 and B, G, R --> R, G, B in a single copy
+        np.copyto(work, np.transpose(bands, axes=[0, 2, 3, 1])[:, :, :, ::-1])
+
+        if per_image:
+            work *= (255.0 / get_per_image_scale_values(bands=bands, percentile=percentile))[:, None, None, None]
+        else:
+            work *= 255.0 / scale_value
+
+        np.clip(work, 0, 255, out=work)
+        np.copyto(out[block_start - start : block_end - start], work, casting="unsafe")
+
+    return out
@@ -0,0 +1,265 @@
+import atexit
+import cProfile
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+MB = 1024 * 1024
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / MB if sys.platform == "darwin" else peak_rss / 1024.0
+
+
+class Span:
+    # one timed pass through a stage; rows and bytes are added by the code inside the span
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.nbytes = 0
+        self.child_seconds = 0.0
+
+    def add(self, rows=0, nbytes=0):
+        self.rows += int(rows)
+        self.nbytes += int(nbytes)
+
+
+class StageRecorder:
+    # totals per stage name: calls, seconds, rows, bytes and the peak rss of the process when the stage
+    # ended. stages nest, e.g. read inside hash: seconds include nested stages, self_seconds exclude them.
+    # spans of worker threads (and merged spans of worker processes) add up, so a stage's seconds can be
+    # more than the wall time of the run; merged stages keep the peak rss of the worker process
+    def __init__(self):
+        self.stages = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_time = time.perf_counter()
+
+    def get_stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def stage(self, name, rows=0, nbytes=0):
+        span = Span(name=name)
+        span.add(rows=rows, nbytes=nbytes)
+        stack = self.get_stack()
+        stack.append(span)
+
+        peak_rss_mb = get_peak_rss_mb()
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            if len(stack) > 0:
+                stack[-1].child_seconds += seconds
+            self.record(span=span, seconds=seconds, start_peak_rss_mb=peak_rss_mb)
+
+    def record(self, span, seconds, start_peak_rss_mb):
+        peak_rss_mb = get_peak_rss_mb()
+        with self.lock:
+            totals = self.stages.get(span.name)
+            if totals is None:
+                totals = {
+                    "calls": 0,
+                    "seconds": 0.0,
+                    "self_seconds": 0.0,
+                    "rows": 0,
+                    "bytes": 0,
+                    "peak_rss_mb": 0.0,
+                    "peak_rss_growth_mb": 0.0,
+                }
+                self.stages[span.name] = totals
+
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["self_seconds"] += seconds - span.child_seconds
+            totals["rows"] += span.rows
+            totals["bytes"] += span.nbytes
+            totals["peak_rss_mb"] = max(totals["peak_rss_mb"], peak_rss_mb)
+            # a stage that raised the process peak is the one to look at for memory
+            totals["peak_rss_growth_mb"] = max(totals["peak_rss_growth_mb"], peak_rss_mb - start_peak_rss_mb)
+
+    def get_metrics(self):
+        with self.lock:
+            stages = OrderedDict()
+            for name, totals in self.stages.items():
+                stage_metrics = dict(totals)
+                stage_metrics["rows_per_second"] = totals["rows"] / max(totals["seconds"], 1e-9)
+                stage_metrics["bytes_per_second"] = totals["bytes"] / max(totals["seconds"], 1e-9)
+                stages[name] = stage_metrics
+
+        return {
+            "total_seconds": time.perf_counter() - self.start_time,
+            "peak_rss_mb": get_peak_rss_mb(),
+            "stages": stages,
+        }
+
+    def merge(self, stages):
+        # adds the stage totals of another recorder, e.g. of a worker process
+        with self.lock:
+            for name, other_totals in stages.items():
+                totals = self.stages.get(name)
+                if totals is None:
+                    self.stages[name] = dict(other_totals)
+                    continue
+
+                for field in ["calls", "seconds", "self_seconds", "rows", "bytes"]:
+                    totals[field] += other_totals[field]
+                for field in ["peak_rss_mb", "peak_rss_growth_mb"]:
+                    totals[field] = max(totals[field], other_totals[field])
+
+    def get_stages(self):
+        with self.lock:
+            return OrderedDict((name, dict(totals)) for name, totals in self.stages.items())
+
+    def reset(self):
+        with self.lock:
+            self.stages = OrderedDict()
+            self.start_time = time.perf_counter()
+
+
+recorder = StageRecorder()
+
+# script name, arguments and profiler of the last start_instrumentation call, finished at exit
+_started_instrumentation = {}
+
+
+def run_recording_stages(function, *args, **kwargs):
+    # for process pool workers: returns (result, stage totals of this call), for recorder.merge in the parent
+    recorder.reset()
+    result = function(*args, **kwargs)
+    return result, recorder.get_stages()
+
+
+def merge_worker_results(worker_results):
+    # merges the stage totals returned by run_recording_stages and returns the results
+    results = []
+    for result, stages in worker_results:
+        recorder.merge(stages=stages)
+        results.append(result)
+
+    return results
+
+
+def stage(name, rows=0, nbytes=0):
+    # with stage("read") as span: ... span.add(rows=..., nbytes=...)
+    return recorder.stage(name=name, rows=rows, nbytes=nbytes)
+
+
+def get_nbytes(datasets):
+    return sum(int(datasets[key].nbytes) for key in datasets)
+
+
+def add_instrumentation_arguments(parser):
+    # json file of per stage metrics, written when the script exits (optional)
+    parser.add_argument("--metrics_path", type=str, default=None)
+
+    # profile the whole run with cProfile (.prof, for pstats or snakeviz) or pyinstrument (text report)
+    parser.add_argument("--profile", type=str, default=None, choices=["cprofile", "pyinstrument"])
+    parser.add_argument("--profile_path", type=str, default=None)
+
+    return parser
+
+
+def start_profiler(profile):
+    if profile == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    # pyinstrument is not part of the environment, so it is only imported when asked for
+    from pyinstrument import Profiler
+
+    profiler = Profiler()
+    profiler.start()
+    return profiler
+
+
+def stop_profiler(profiler, profile, profile_path):
+    if profile == "cprofile":
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+    else:
+        profiler.stop()
+        with open(profile_path, "w") as profile_file:
+            profile_file.write(profiler.output_text(unicode=False, color=False))
+
+    print("Profile saved to: ", profile_path)
+
+
+def print_metrics(metrics):
+    print("\nStage metrics (total", round(metrics["total_seconds"], 2), "seconds)")
+    print(
+        "{:<12} {:>8} {:>11} {:>11} {:>12} {:>12} {:>10} {:>13}".format(
+            "stage", "calls", "seconds", "self", "rows/s", "MB/s", "peak MB", "peak grew MB"
+        )
+    )
+    for name, stage_metrics in metrics["stages"].items():
+        print(
+            "{:<12} {:>8} {:>11.2f} {:>11.2f} {:>12.1f} {:>12.1f} {:>10.1f} {:>13.1f}".format(
+                name,
+                stage_metrics["calls"],
+                stage_metrics["seconds"],
+                stage_metrics["self_seconds"],
+                stage_metrics["rows_per_second"],
+                stage_metrics["bytes_per_second"] / MB,
+                stage_metrics["peak_rss_mb"],
+                stage_metrics["peak_rss_growth_mb"],
+            )
+        )
+
+
+def save_metrics(metrics, metrics_path):
+    metrics_dir = os.path.dirname(metrics_path)
+    if metrics_dir != "" and not os.path.isdir(metrics_dir):
+        os.makedirs(metrics_dir)
+
+    temporary_path = metrics_path + ".tmp"
+    with open(temporary_path, "w") as metrics_file:
+        json.dump(metrics, metrics_file, indent=2)
+    os.replace(temporary_path, metrics_path)
+
+    print("Metrics saved to: ", metrics_path)
+
+
+def finish_instrumentation(script_name, args, profiler=None):
+    if profiler is not None:
+        profile_path = args.profile_path
+        if profile_path is None:
+            profile_path = script_name + (".prof" if args.profile == "cprofile" else ".txt")
+        stop_profiler(profiler=profiler, profile=args.profile, profile_path=profile_path)
+
+    metrics = recorder.get_metrics()
+    print_metrics(metrics=metrics)
+
+    if args.metrics_path is not None:
+        metrics["script"] = script_name
+        metrics["argv"] = sys.argv
+        metrics["finished"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+        save_metrics(metrics=metrics, metrics_path=args.metrics_path)
+
+
+def finish_started_instrumentation():
+    finish_instrumentation(**_started_instrumentation)
+
+
+def start_instrumentation(script_name, args):
+    # the summary (and the metrics file and profile, when asked for) is written at exit, also after an error.
+    # it is written once per process, for the last call
+    recorder.reset()
+    profiler = start_profiler(profile=args.profile) if args.profile is not None else None
+    if len(_started_instrumentation) == 0:
+        atexit.register(finish_started_instrumentation)
+    _started_instrumentation.update(script_name=script_name, args=args, profiler=profiler)
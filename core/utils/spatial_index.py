@@ -0,0 +1,263 @@
+import numpy as np
+import os
+
+from .hdf5_utils import get_all_hdf5_files_from_regex, get_all_hdf5_filenames_from_regex
+
+
+# boxes touching more cells than this are not put in the grid, but tested against every query instead
+MAX_CELLS_PER_BOX = 64
+
+
+def normalize_bounds(bounds):
+    # bounds rows are (lon, lat, lon, lat) corners; order them as (min_lon, min_lat, max_lon, max_lat)
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    return np.stack(
+        [
+            np.minimum(bounds[:, 0], bounds[:, 2]),
+            np.minimum(bounds[:, 1], bounds[:, 3]),
+            np.maximum(bounds[:, 0], bounds[:, 2]),
+            np.maximum(bounds[:, 1], bounds[:, 3]),
+        ],
+        axis=1,
+    )
+
+
+def get_overlap_fractions(boxes_1, boxes_2):
+    # intersection area divided by the area of the smaller box, for row-aligned pairs of boxes
+    widths = np.minimum(boxes_1[:, 2], boxes_2[:, 2]) - np.maximum(boxes_1[:, 0], boxes_2[:, 0])
+    heights = np.minimum(boxes_1[:, 3], boxes_2[:, 3]) - np.maximum(boxes_1[:, 1], boxes_2[:, 1])
+    intersections = np.clip(widths, 0, None) * np.clip(heights, 0, None)
+
+    areas_1 = (boxes_1[:, 2] - boxes_1[:, 0]) * (boxes_1[:, 3] - boxes_1[:, 1])
+    areas_2 = (boxes_2[:, 2] - boxes_2[:, 0]) * (boxes_2[:, 3] - boxes_2[:, 1])
+    smaller_areas = np.minimum(areas_1, areas_2)
+
+    return np.divide(
+        intersections,
+        smaller_areas,
+        out=(intersections > 0).astype(np.float64),
+        where=smaller_areas > 0,
+    )
+
+
+def get_finite_mask(boxes):
+    # boxes with a NaN or infinite bound overlap nothing
+    return np.all(np.isfinite(boxes), axis=1)
+
+
+def boxes_intersect(boxes_1, boxes_2):
+    # strict, so tiles of a contiguous tiling that only share an edge or a corner do not overlap
+    return (
+        (boxes_1[:, 0] < boxes_2[:, 2])
+        & (boxes_2[:, 0] < boxes_1[:, 2])
+        & (boxes_1[:, 1] < boxes_2[:, 3])
+        & (boxes_2[:, 1] < boxes_1[:, 3])
+    )
+
+
+def get_file_mtimes(file_names):
+    return [os.stat(file_name).st_mtime_ns for file_name in file_names]
+
+
+def get_index_path(index_path):
+    return index_path if index_path.endswith(".npz") else index_path + ".npz"
+
+
+class GridSpatialIndex:
+    # uniform grid over (lon, lat); every box is registered in each cell it touches and the
+    # (cell id, box) entries are kept sorted by cell id, so cell lookups are binary searches.
+    # queries only enumerate cells within the extent of the indexed cells
+    def __init__(self, boxes, file_indices, row_indices, file_names, file_mtimes=None, cell_size=None):
+        self.boxes = normalize_bounds(boxes)
+        self.file_indices = np.asarray(file_indices, dtype=np.int64)
+        self.row_indices = np.asarray(row_indices, dtype=np.int64)
+        self.file_names = list(file_names)
+        self.file_mtimes = list(file_mtimes) if file_mtimes is not None else get_file_mtimes(self.file_names)
+
+        if cell_size is None:
+            cell_size = self.get_default_cell_size()
+        self.cell_size = float(cell_size)
+
+        # a box touches at most (width / cell size + 2) * (height / cell size + 2) cells, wherever the origin is
+        is_finite = get_finite_mask(self.boxes)
+        with np.errstate(over="ignore", invalid="ignore"):
+            extents = (self.boxes[:, 2:] - self.boxes[:, :2]) / self.cell_size + 2
+            is_gridded = is_finite & (np.prod(extents, axis=1) <= MAX_CELLS_PER_BOX)
+        self.large_box_indices = np.flatnonzero(is_finite & ~is_gridded)
+
+        if is_gridded.any():
+            self.origin = self.boxes[is_gridded, :2].min(axis=0)
+        else:
+            self.origin = np.zeros(2, dtype=np.float64)
+
+        x_start, y_start, x_end, y_end = self.get_cell_ranges(boxes=self.boxes[is_gridded])
+        if is_gridded.any():
+            self.cell_extent = np.array([x_start.min(), y_start.min(), x_end.max(), y_end.max()])
+        else:
+            self.cell_extent = np.array([0.0, 0.0, -1.0, -1.0])
+
+        gridded_indices = np.flatnonzero(is_gridded)
+        box_indices, cell_ids = self.get_box_cells(boxes=self.boxes[gridded_indices])
+        order = np.argsort(cell_ids, kind="stable")
+        self.cell_ids = cell_ids[order]
+        self.cell_box_indices = gridded_indices[box_indices[order]]
+
+    def __len__(self):
+        return self.boxes.shape[0]
+
+    def get_default_cell_size(self):
+        # twice the median tile extent keeps each tile in at most four cells
+        boxes = self.boxes[get_finite_mask(self.boxes)]
+        if boxes.shape[0] == 0:
+            return 1.0
+        with np.errstate(over="ignore"):
+            extents = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+        median_extent = float(np.median(extents))
+        return 2.0 * median_extent if median_extent > 0 else 1.0
+
+    def get_cell_coordinates(self, values, axis):
+        # floats, so a huge bound cannot overflow the int64 cell coordinates
+        with np.errstate(over="ignore"):
+            return np.floor((values - self.origin[axis]) / self.cell_size)
+
+    def get_cell_ranges(self, boxes):
+        # first and last cell of every box along each axis, as floats
+        return (
+            self.get_cell_coordinates(values=boxes[:, 0], axis=0),
+            self.get_cell_coordinates(values=boxes[:, 1], axis=1),
+            self.get_cell_coordinates(values=boxes[:, 2], axis=0),
+            self.get_cell_coordinates(values=boxes[:, 3], axis=1),
+        )
+
+    def get_box_cells(self, boxes):
+        # returns (box index, cell id) for every indexed cell touched by every finite box
+        is_finite = get_finite_mask(boxes)
+        x_start, y_start, x_end, y_end = self.get_cell_ranges(boxes=np.where(is_finite[:, np.newaxis], boxes, 0))
+
+        # cells outside the extent of the indexed cells hold no boxes, so they are never enumerated
+        x_min, y_min, x_max, y_max = self.cell_extent
+        x_start = np.clip(x_start, x_min, x_max + 1).astype(np.int64)
+        y_start = np.clip(y_start, y_min, y_max + 1).astype(np.int64)
+        num_x = np.clip(np.clip(x_end, x_min - 1, x_max).astype(np.int64) - x_start + 1, 0, None)
+        num_y = np.clip(np.clip(y_end, y_min - 1, y_max).astype(np.int64) - y_start + 1, 0, None)
+        counts = np.where(is_finite, num_x * num_y, 0)
+
+        box_indices = np.repeat(np.arange(boxes.shape[0]), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cell_x = x_start[box_indices] + offsets // num_y[box_indices]
+        cell_y = y_start[box_indices] + offsets % num_y[box_indices]
+
+        # coordinates are shifted to be non-negative before packing into a single int64 id
+        return box_indices, ((cell_x + 2**31) << 32) | (cell_y + 2**31)
+
+    def get_candidate_pairs(self, boxes):
+        query_indices, cell_ids = self.get_box_cells(boxes=boxes)
+        starts = np.searchsorted(self.cell_ids, cell_ids, side="left")
+        ends = np.searchsorted(self.cell_ids, cell_ids, side="right")
+        counts = ends - starts
+
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        query_indices = np.repeat(query_indices, counts)
+        box_indices = self.cell_box_indices[np.repeat(starts, counts) + offsets]
+
+        # boxes too large for the grid are candidates for every finite query
+        finite_query_indices = np.flatnonzero(get_finite_mask(boxes))
+        query_indices = np.concatenate(
+            [query_indices, np.repeat(finite_query_indices, self.large_box_indices.shape[0])]
+        )
+        box_indices = np.concatenate([box_indices, np.tile(self.large_box_indices, finite_query_indices.shape[0])])
+
+        # a pair sharing several cells is only reported once
+        pair_codes = np.unique(query_indices * max(len(self), 1) + box_indices)
+        return pair_codes // max(len(self), 1), pair_codes % max(len(self), 1)
+
+    def query_overlaps(self, boxes, min_overlap=0.0):
+        # returns (query index, indexed box index) for every overlapping pair
+        boxes = normalize_bounds(boxes)
+        if boxes.shape[0] == 0 or len(self) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        query_indices, box_indices = self.get_candidate_pairs(boxes=boxes)
+        query_boxes = boxes[query_indices]
+        indexed_boxes = self.boxes[box_indices]
+
+        if min_overlap > 0:
+            is_overlap = get_overlap_fractions(query_boxes, indexed_boxes) >= min_overlap
+        else:
+            is_overlap = boxes_intersect(query_boxes, indexed_boxes)
+
+        return query_indices[is_overlap], box_indices[is_overlap]
+
+    def query_bounding_box(self, min_lon, min_lat, max_lon, max_lat):
+        _, box_indices = self.query_overlaps(boxes=[[min_lon, min_lat, max_lon, max_lat]])
+        return box_indices
+
+    def get_locations(self, box_indices):
+        return [(self.file_names[self.file_indices[index]], int(self.row_indices[index])) for index in box_indices]
+
+    def save(self, index_path):
+        index_path = get_index_path(index_path=index_path)
+        index_dir = os.path.dirname(index_path)
+        if index_dir != "" and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+
+        np.savez(
+            index_path,
+            boxes=self.boxes,
+            file_indices=self.file_indices,
+            row_indices=self.row_indices,
+            file_names=np.array(self.file_names, dtype=str),
+            file_mtimes=np.array(self.file_mtimes, dtype=np.int64),
+            cell_size=np.array(self.cell_size),
+        )
+
+    @classmethod
+    def load(cls, index_path):
+        with np.load(get_index_path(index_path=index_path)) as index_file:
+            return cls(
+                boxes=index_file["boxes"],
+                file_indices=index_file["file_indices"],
+                row_indices=index_file["row_indices"],
+                file_names=index_file["file_names"].tolist(),
+                file_mtimes=index_file["file_mtimes"].tolist(),
+                cell_size=float(index_file["cell_size"]),
+            )
+
+
+def build_spatial_index_from_regex(regex, cell_size=None, verbose=False, catalog=None):
+    boxes = [np.empty((0, 4), dtype=np.float64)]
+    file_indices = []
+    row_indices = []
+    hdf5_files = get_all_hdf5_files_from_regex(regex=regex, verbose=verbose, max_open_files=1, catalog=catalog)
+    with hdf5_files:
+        file_names = hdf5_files.file_names
+        for i in range(len(hdf5_files)):
+            file_boxes = normalize_bounds(hdf5_files[i]["bounds"][:, :4])
+
+            boxes.append(file_boxes)
+            file_indices.append(np.full(file_boxes.shape[0], i, dtype=np.int64))
+            row_indices.append(np.arange(file_boxes.shape[0]))
+
+    return GridSpatialIndex(
+        boxes=np.concatenate(boxes),
+        file_indices=np.concatenate(file_indices) if len(file_indices) > 0 else [],
+        row_indices=np.concatenate(row_indices) if len(row_indices) > 0 else [],
+        file_names=file_names,
+        cell_size=cell_size,
+    )
+
+
+def load_or_build_spatial_index(regex, index_path=None, cell_size=None, catalog=None):
+    # a saved index is reused only if the regex still matches exactly the same, unmodified files
+    if index_path is not None and os.path.isfile(get_index_path(index_path=index_path)):
+        spatial_index = GridSpatialIndex.load(index_path=index_path)
+        file_names = get_all_hdf5_filenames_from_regex(regex=regex, catalog=catalog)
+        if spatial_index.file_names == file_names and spatial_index.file_mtimes == get_file_mtimes(file_names):
+            print("Loaded spatial index: ", get_index_path(index_path=index_path))
+            return spatial_index
+
+    spatial_index = build_spatial_index_from_regex(regex=regex, cell_size=cell_size, verbose=True, catalog=catalog)
+    if index_path is not None:
+        spatial_index.save(index_path=index_path)
+
+    return spatial_index
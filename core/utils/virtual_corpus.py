@@ -0,0 +1,217 @@
+import numpy as np
+
+from .hdf5_utils import DEFAULT_MAX_OPEN_FILES, get_all_hdf5_files_from_regex, get_common_keys
+from .instrumentation import get_nbytes, stage
+
+
+def get_runs(sorted_indices, max_gap=0):
+    # splits sorted, unique row indices into runs of rows that can be read with one hyperslab;
+    # runs separated by at most max_gap unselected rows are merged. returns (first, end) positions
+    if sorted_indices.shape[0] == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(sorted_indices) > max_gap + 1) + 1
+    run_starts = np.concatenate([[0], breaks])
+    run_ends = np.concatenate([breaks, [sorted_indices.shape[0]]])
+
+    return list(zip(run_starts.tolist(), run_ends.tolist()))
+
+
+class VirtualDataset:
+    # one key of a VirtualCorpus, indexed like the concatenation of that key over all files
+    def __init__(self, corpus, key):
+        self.corpus = corpus
+        self.key = key
+        self.shape = (len(corpus),) + corpus.get_row_shape(key=key)
+        self.dtype = corpus.get_dtype(key=key)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        rows, selection = index[0], index[1:]
+
+        if isinstance(rows, (int, np.integer)):
+            return self.corpus.read_rows(global_indices=[rows], keys=[self.key], selection=selection)[self.key][0]
+
+        if isinstance(rows, slice):
+            start, end, step = rows.indices(len(self))
+            if step == 1:
+                return self.corpus.read_slice(start=start, end=end, keys=[self.key], selection=selection)[self.key]
+            rows = np.arange(start, end, step)
+
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+
+        return self.corpus.read_rows(global_indices=rows, keys=[self.key], selection=selection)[self.key]
+
+
+class VirtualCorpus:
+    # all files of an HDF5FilePool presented as one logical dataset per key, through an offset index
+    # over the files; reads are translated into hyperslab reads of the files, written into one
+    # preallocated output array, so the corpus is never concatenated in memory
+    def __init__(self, hdf5_files, keys=None):
+        self.hdf5_files = hdf5_files
+        self.keys = sorted(keys if keys is not None else get_common_keys(list_of_files=hdf5_files))
+
+        row_counts = [hdf5_files.get_num_datapoints(i, keys=self.keys) for i in range(len(hdf5_files))]
+        self.file_offsets = np.concatenate([[0], np.cumsum(row_counts, dtype=np.int64)]).astype(np.int64)
+        # files without rows (e.g. a dedup output with every row removed, saved as a 1d float64 array) take up no
+        # global indices and are left out of the row shape and dtype
+        self.nonempty_file_indices = [i for i, row_count in enumerate(row_counts) if row_count > 0]
+        self.dtypes = {}
+
+    @classmethod
+    def from_regex(cls, regex, keys=None, verbose=False, max_open_files=DEFAULT_MAX_OPEN_FILES, catalog=None):
+        hdf5_files = get_all_hdf5_files_from_regex(
+            regex=regex,
+            verbose=verbose,
+            max_open_files=max_open_files,
+            catalog=catalog,
+        )
+        return cls(hdf5_files=hdf5_files, keys=keys)
+
+    def __len__(self):
+        return int(self.file_offsets[-1])
+
+    def __getitem__(self, key):
+        return VirtualDataset(corpus=self, key=key)
+
+    @property
+    def num_files(self):
+        return len(self.hdf5_files)
+
+    def get_row_counts(self):
+        return np.diff(self.file_offsets)
+
+    def get_row_shape(self, key, selection=()):
+        # shape of one row of key after applying selection to its trailing dimensions
+        if len(self.nonempty_file_indices) == 0:
+            return ()
+
+        row_shape = tuple(self.hdf5_files.get_shape(self.nonempty_file_indices[0], key)[1:])
+        return np.empty((0,) + row_shape, dtype=np.uint8)[(slice(None),) + tuple(selection)].shape[1:]
+
+    def get_dtype(self, key):
+        # a dtype that holds the rows of every file, e.g. float64 if one file stores float32 and another float64
+        if len(self.nonempty_file_indices) == 0:
+            return np.dtype(np.float64)
+        if key not in self.dtypes:
+            self.dtypes[key] = np.result_type(*[self.hdf5_files.get_dtype(i, key) for i in self.nonempty_file_indices])
+        return self.dtypes[key]
+
+    def locate(self, global_indices):
+        # (file index, row index within that file) of every global row index
+        global_indices = np.asarray(global_indices, dtype=np.int64)
+        file_indices = np.searchsorted(self.file_offsets, global_indices, side="right") - 1
+        return file_indices, global_indices - self.file_offsets[file_indices]
+
+    def allocate(self, keys, num_rows, selection):
+        return {
+            key: np.empty(
+                (num_rows,) + self.get_row_shape(key=key, selection=selection),
+                dtype=self.get_dtype(key=key),
+            )
+            for key in keys
+        }
+
+    def read_slice(self, start, end, keys=None, selection=()):
+        keys = self.keys if keys is None else keys
+        selection = tuple(selection)
+        start = max(start, 0)
+        end = min(max(end, start), len(self))
+        dsets = self.allocate(keys=keys, num_rows=end - start, selection=selection)
+        with stage("read", rows=end - start, nbytes=get_nbytes(datasets=dsets)):
+            self.read_slice_into(dsets=dsets, start=start, end=end, keys=keys, selection=selection)
+
+        return dsets
+
+    def read_slice_into(self, dsets, start, end, keys, selection):
+        first_file = np.searchsorted(self.file_offsets, start, side="right") - 1
+        last_file = np.searchsorted(self.file_offsets, end, side="left")
+        for file_index in range(max(first_file, 0), min(last_file, self.num_files)):
+            local_start = max(start, self.file_offsets[file_index]) - self.file_offsets[file_index]
+            local_end = min(end, self.file_offsets[file_index + 1]) - self.file_offsets[file_index]
+            if local_end <= local_start:
+                continue
+
+            position = self.file_offsets[file_index] + local_start - start
+            for key in keys:
+                dset = self.hdf5_files[file_index][key]
+                dsets[key][position : position + local_end - local_start] = dset[
+                    (slice(local_start, local_end),) + selection
+                ]
+
+    def read_rows(self, global_indices, keys=None, selection=(), max_gap=0):
+        # rows in the order of global_indices (repeats allowed); each file is read once per run of
+        # selected rows, where runs closer than max_gap rows are read together
+        keys = self.keys if keys is None else keys
+        selection = tuple(selection)
+        global_indices = np.asarray(global_indices, dtype=np.int64).reshape(-1)
+        global_indices = np.where(global_indices < 0, global_indices + len(self), global_indices)
+        if global_indices.shape[0] > 0 and (global_indices.min() < 0 or global_indices.max() >= len(self)):
+            raise IndexError("Index out of range for a corpus of " + str(len(self)) + " rows.")
+
+        unique_indices, inverse_indices = np.unique(global_indices, return_inverse=True)
+        file_indices, local_indices = self.locate(global_indices=unique_indices)
+        dsets = self.allocate(keys=keys, num_rows=unique_indices.shape[0], selection=selection)
+        with stage("read", rows=unique_indices.shape[0], nbytes=get_nbytes(datasets=dsets)):
+            self.read_rows_into(
+                dsets=dsets,
+                file_indices=file_indices,
+                local_indices=local_indices,
+                keys=keys,
+                selection=selection,
+                max_gap=max_gap,
+            )
+
+        if not np.array_equal(unique_indices, global_indices):
+            for key in keys:
+                dsets[key] = dsets[key][inverse_indices]
+
+        return dsets
+
+    def read_rows_into(self, dsets, file_indices, local_indices, keys, selection, max_gap):
+        # unique indices are sorted, so the rows of each file are one contiguous range of positions
+        file_starts = np.searchsorted(file_indices, np.arange(self.num_files), side="left")
+        file_ends = np.searchsorted(file_indices, np.arange(self.num_files), side="right")
+        for file_index in np.flatnonzero(file_ends > file_starts):
+            file_local_indices = local_indices[file_starts[file_index] : file_ends[file_index]]
+            for first, end in get_runs(sorted_indices=file_local_indices, max_gap=max_gap):
+                run_indices = file_local_indices[first:end]
+                run_start = run_indices[0]
+                run_end = run_indices[-1] + 1
+                position = file_starts[file_index] + first
+
+                for key in keys:
+                    slab = self.hdf5_files[file_index][key][(slice(run_start, run_end),) + selection]
+                    if run_end - run_start != end - first:
+                        slab = slab[run_indices - run_start]
+                    dsets[key][position : position + end - first] = slab
+
+    def iterate_blocks(self, block_size, keys=None, selection=()):
+        # yields (global start, global end, slabs) blocks of at most block_size rows, never spanning two files
+        keys = self.keys if keys is None else keys
+        for file_index in range(self.num_files):
+            file_offset = self.file_offsets[file_index]
+            for local_start in range(0, self.file_offsets[file_index + 1] - file_offset, block_size):
+                local_end = min(local_start + block_size, self.file_offsets[file_index + 1] - file_offset)
+                with stage("read", rows=local_end - local_start) as span:
+                    slabs = {}
+                    for key in keys:
+                        dset = self.hdf5_files[file_index][key]
+                        slabs[key] = dset[(slice(local_start, local_end),) + tuple(selection)]
+                    span.add(nbytes=get_nbytes(datasets=slabs))
+                yield file_offset + local_start, file_offset + local_end, slabs
+
+    def close(self):
+        self.hdf5_files.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
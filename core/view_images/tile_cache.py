@@ -0,0 +1,141 @@
+import os
+import threading
+from collections import OrderedDict
+from hashlib import sha1
+
+
+MB = 1024 * 1024
+
+
+def get_tile_key(file_identity, index, image_format):
+    # file identity is (path, mtime, size), so tiles of a rewritten file are never served from the cache
+    path, mtime, size = file_identity
+    return "{}:{}:{}:{}:{}".format(path, mtime, size, index, image_format)
+
+
+def get_tile_etag(tile_key):
+    return sha1(tile_key.encode("utf-8")).hexdigest()
+
+
+class TileCache:
+    # in memory LRU of encoded tiles bounded by total bytes, backed by an optional on disk cache
+    # that is also bounded by total bytes and evicts the least recently used files first
+    def __init__(self, max_memory_mb=256, cache_dir=None, max_disk_mb=4096):
+        self.max_memory_bytes = int(max_memory_mb * MB)
+        self.max_disk_bytes = int(max_disk_mb * MB)
+        self.cache_dir = cache_dir
+        self.tiles = OrderedDict()
+        self.memory_bytes = 0
+        self.disk_files = OrderedDict()
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if cache_dir is not None:
+            self.load_disk_files()
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def load_disk_files(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        disk_files = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith(".tmp"):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, file_name))
+            disk_files.append((stat.st_mtime_ns, file_name, stat.st_size))
+
+        for _, file_name, size in sorted(disk_files):
+            self.disk_files[file_name] = size
+            self.disk_bytes += size
+
+        self.evict_disk_files()
+
+    def get_disk_path(self, tile_key):
+        return os.path.join(self.cache_dir, get_tile_etag(tile_key=tile_key))
+
+    def get(self, tile_key):
+        with self.lock:
+            if tile_key in self.tiles:
+                self.tiles.move_to_end(tile_key)
+                self.hits += 1
+                return self.tiles[tile_key]
+
+        tile = self.read_from_disk(tile_key=tile_key)
+        with self.lock:
+            if tile is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.put_in_memory(tile_key=tile_key, tile=tile)
+            return tile
+
+    def put(self, tile_key, tile):
+        with self.lock:
+            self.put_in_memory(tile_key=tile_key, tile=tile)
+        self.write_to_disk(tile_key=tile_key, tile=tile)
+
+    def put_in_memory(self, tile_key, tile):
+        if tile_key in self.tiles:
+            self.memory_bytes -= len(self.tiles.pop(tile_key))
+
+        if len(tile) > self.max_memory_bytes:
+            return
+
+        self.tiles[tile_key] = tile
+        self.memory_bytes += len(tile)
+        while self.memory_bytes > self.max_memory_bytes:
+            _, evicted_tile = self.tiles.popitem(last=False)
+            self.memory_bytes -= len(evicted_tile)
+
+    def read_from_disk(self, tile_key):
+        if self.cache_dir is None:
+            return None
+
+        disk_path = self.get_disk_path(tile_key=tile_key)
+        try:
+            with open(disk_path, "rb") as tile_file:
+                tile = tile_file.read()
+        except (FileNotFoundError, OSError):
+            return None
+
+        with self.lock:
+            file_name = os.path.basename(disk_path)
+            if file_name in self.disk_files:
+                self.disk_files.move_to_end(file_name)
+
+        return tile
+
+    def write_to_disk(self, tile_key, tile):
+        if self.cache_dir is None:
+            return
+
+        disk_path = self.get_disk_path(tile_key=tile_key)
+        file_name = os.path.basename(disk_path)
+
+        # written under a temporary name first, so a reader never sees a partial tile
+        temporary_path = "{}.{}.tmp".format(disk_path, threading.get_ident())
+        with open(temporary_path, "wb") as tile_file:
+            tile_file.write(tile)
+        os.replace(temporary_path, disk_path)
+
+        with self.lock:
+            if file_name in self.disk_files:
+                self.disk_bytes -= self.disk_files.pop(file_name)
+            self.disk_files[file_name] = len(tile)
+            self.disk_bytes += len(tile)
+            self.evict_disk_files()
+
+    def evict_disk_files(self):
+        while self.disk_bytes > self.max_disk_bytes and len(self.disk_files) > 0:
+            file_name, size = self.disk_files.popitem(last=False)
+            self.disk_bytes -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                pass
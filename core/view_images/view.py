@@ -4,11 +4,13 @@ import numpy as np
 import os
 import pandas as pd
 
-from base64 import encodebytes
 from flask import Flask
-from flask import render_template, send_from_directory, jsonify, request, send_file
+from flask import render_template, send_from_directory, jsonify, request, send_file, url_for, abort, Response
 from PIL import Image, ImageOps
 
+from ..utils.image_utils import get_scale_value, normalize_images
+from .tile_cache import TileCache, get_tile_etag, get_tile_key
+
 
 app = Flask(__name__)
 
@@ -17,77 +19,174 @@ TEMPLATES_AUTO_RELOAD = True
 LOW_INDEX = 0
 HIGH_INDEX = 25
 
+# tiles are decoded in aligned blocks of rows, so scrolling through a page reads each block once
+TILE_BLOCK_SIZE = 32
+TILE_FORMATS = {"jpeg": ("JPEG", "image/jpeg", 100), "webp": ("WEBP", "image/webp", 90)}
+TILE_MAX_AGE = 24 * 60 * 60
+
+tile_cache = TileCache(
+    max_memory_mb=int(os.environ.get("TILE_CACHE_MB", 256)),
+    cache_dir=os.environ.get("TILE_CACHE_DIR"),
+    max_disk_mb=int(os.environ.get("TILE_CACHE_DISK_MB", 4096)),
+)
+
+# per file scale values, keyed by (path, mtime, size) so a rewritten file is rescanned
+_scale_values = {}
+
 
 def create_examples():
-    indices = [i for i in range(LOW_INDEX, HIGH_INDEX)]
-    examples = {
-        #'/atlas/u/jihyeonlee/handlabeling/delta+1/jihyeon/examples_0_new.hdf5': indices,
-        #'/atlas/u/jihyeonlee/handlabeling/delta+1/jihyeon/examples_1_new.hdf5': indices,
-        #'/atlas/u/jihyeonlee/handlabeling/delta+1/jihyeon/examples_3_new.hdf5': indices,
-        #'/atlas/u/jihyeonlee/handlabeling/delta-1/jihyeon/examples_1_new.hdf5': indices,
-        "/atlas/u/jihyeonlee/handlabeling/positives/examples_0_new.hdf5": indices,
-        "/atlas/u/jihyeonlee/handlabeling/positives/examples_1_new.hdf5": indices,
-        "/atlas/u/jihyeonlee/handlabeling/positives/examples_3_new.hdf5": indices,
-        "/atlas/u/jihyeonlee/handlabeling/positives/examples_4_new.hdf5": indices,
-        "/atlas/u/jihyeonlee/handlabeling/positives/examples_5_new.hdf5": indices,
-        "/atlas/u/jihyeonlee/handlabeling/positives/examples_6_new.hdf5": indices,
-        "/atlas/u/jihyeonlee/handlabeling/positives/examples_7_new.hdf5": indices,
-    }
+    examples = [
+        #'/atlas/u/jihyeonlee/handlabeling/delta+1/jihyeon/examples_0_new.hdf5',
+        #'/atlas/u/jihyeonlee/handlabeling/delta+1/jihyeon/examples_1_new.hdf5',
+        #'/atlas/u/jihyeonlee/handlabeling/delta+1/jihyeon/examples_3_new.hdf5',
+        #'/atlas/u/jihyeonlee/handlabeling/delta-1/jihyeon/examples_1_new.hdf5',
+        "/atlas/u/jihyeonlee/handlabeling/positives/examples_0_new.hdf5",
+        "/atlas/u/jihyeonlee/handlabeling/positives/examples_1_new.hdf5",
+        "/atlas/u/jihyeonlee/handlabeling/positives/examples_3_new.hdf5",
+        "/atlas/u/jihyeonlee/handlabeling/positives/examples_4_new.hdf5",
+        "/atlas/u/jihyeonlee/handlabeling/positives/examples_5_new.hdf5",
+        "/atlas/u/jihyeonlee/handlabeling/positives/examples_6_new.hdf5",
+        "/atlas/u/jihyeonlee/handlabeling/positives/examples_7_new.hdf5",
+    ]
 
     return examples
 
 
-def encode_images(imgs):
-    encoded_imgs = []
-    for np_img in imgs:
-        pil_img = Image.fromarray(np_img)
-        byte_arr = io.BytesIO()
-        pil_img.save(byte_arr, "JPEG", quality=100)
-        # byte_arr.seek(0)
-        encoded_img = encodebytes(byte_arr.getvalue()).decode("ascii")  # encode as base64
-        encoded_img_tag = f'<img src="data:image/jpg;base64,{encoded_img}" height="256"/>'
-        encoded_imgs.append(encoded_img_tag)
-    return encoded_imgs
-
-
-def load_data(hdf5_filename, indexes):
-    global images
-    global labels
-    global bounds
-    global total
-    # Read in the current data
+def encode_image(np_img, image_format):
+    pil_format, _, quality = TILE_FORMATS[image_format]
+    pil_img = Image.fromarray(np_img)
+    byte_arr = io.BytesIO()
+    pil_img.save(byte_arr, pil_format, quality=quality)
+    return byte_arr.getvalue()
+
+
+def get_file_identity(hdf5_filename):
+    stat = os.stat(hdf5_filename)
+    return hdf5_filename, stat.st_mtime_ns, stat.st_size
+
+
+def get_page_range(low, high, total):
+    low = min(max(low, 0), total)
+    high = min(max(high, low), total)
+    return low, high
+
+
+def get_cached_scale_value(file_identity, images):
+    # the max stored with the file, or for files written without one the max over the whole file, computed once
+    # (block by block) and reused by every page
+    if file_identity not in _scale_values:
+        for cached_identity in [identity for identity in _scale_values if identity[0] == file_identity[0]]:
+            _scale_values.pop(cached_identity, None)
+        _scale_values[file_identity] = get_scale_value(images=images)
+
+    return _scale_values[file_identity]
+
+
+def load_tiles(hdf5_filename, index, image_format):
+    # decodes the aligned block of rows around index, caches every tile of it and returns the requested one
+    file_identity = get_file_identity(hdf5_filename)
+    with h5py.File(hdf5_filename, "r") as f:
+        total = f["images"].shape[0]
+        if index < 0 or index >= total:
+            return None
+
+        start = index - index % TILE_BLOCK_SIZE
+        end = min(start + TILE_BLOCK_SIZE, total)
+
+        # RGB uint8 images of shape (end - start), 64, 64, 3, scaled like the exported images
+        images = normalize_images(
+            images=f["images"][start:end],
+            scale_value=get_cached_scale_value(file_identity=file_identity, images=f["images"]),
+        )
+
+    tile_data = None
+    for i in range(start, end):
+        tile_key = get_tile_key(file_identity=file_identity, index=i, image_format=image_format)
+        if i == index:
+            tile_data = encode_image(np_img=images[i - start], image_format=image_format)
+            tile_cache.put(tile_key=tile_key, tile=tile_data)
+        elif tile_cache.get(tile_key) is None:
+            tile_cache.put(tile_key=tile_key, tile=encode_image(np_img=images[i - start], image_format=image_format))
+
+    return tile_data
+
+
+def load_data(hdf5_filename, low, high):
+    # Read in only the labels and bounds of the rows shown on the page, the images are served as tiles
     with h5py.File(hdf5_filename, "r") as f:
-        print(f.keys())
-        images = np.transpose(f["images"][:, 1:4, :, :], axes=[0, 2, 3, 1])  # reorder axes to 1000, 64, 64, 3
-        images = images[:, :, :, ::-1]  # B, G, R --> R, G, B
-        # Normalize values to be between 0 and 255
-        # images *= 255. / (0.8 * np.max(images))
-        images *= 255.0 / np.max(images)
-        images = np.clip(images, 0, 255).astype(np.uint8)
-        labels = f["labels"][:]
-        bounds = f["bounds"][:]
-        total = images.shape[0]
+        total = f["images"].shape[0]
+        low, high = get_page_range(low=low, high=high, total=total)
+        labels = f["labels"][low:high]
+        bounds = f["bounds"][low:high]
+
     return {
-        "images": encode_images(images[indexes]),
-        "labels": labels[indexes],
-        "lon": bounds[indexes, 0],
-        "lat": bounds[indexes, 3],
+        "indices": list(range(low, high)),
+        "labels": labels,
+        "lon": bounds[:, 0],
+        "lat": bounds[:, 3],
+        "low": low,
+        "high": high,
+        "total": total,
     }
 
 
-@app.context_processor
-def inject_dict_for_all_templates():
-    examples = create_examples()
-    examples_data = {}
-    for hdf5_file in examples.keys():
-        examples_data[hdf5_file] = load_data(hdf5_file, examples[hdf5_file])
+def get_page_links(file_index, low, high, total):
+    page_size = max(high - low, 1)
+    links = {}
+    if low > 0:
+        links["previous"] = url_for("hello", file_index=file_index, low=max(low - page_size, 0), high=low)
+    if high < total:
+        links["next"] = url_for("hello", file_index=file_index, low=high, high=min(high + page_size, total))
 
-    return {"examples": examples_data}
+    return links
 
 
 @app.route("/")
-def hello():
-    return render_template("index.html")
+@app.route("/<int:file_index>")
+def hello(file_index=0):
+    examples = create_examples()
+    if file_index < 0 or file_index >= len(examples):
+        abort(404)
+
+    low = request.args.get("low", default=LOW_INDEX, type=int)
+    high = request.args.get("high", default=HIGH_INDEX, type=int)
+
+    # everything the page needs is built for this request only, from the rows it displays
+    example = load_data(examples[file_index], low=low, high=high)
+
+    return render_template(
+        "index.html",
+        filenames=examples,
+        file_index=file_index,
+        filename=examples[file_index],
+        example=example,
+        links=get_page_links(file_index=file_index, low=example["low"], high=example["high"], total=example["total"]),
+    )
+
+
+@app.route("/tile/<int:file_index>/<int:index>")
+def tile(file_index, index):
+    examples = create_examples()
+    image_format = request.args.get("format", default="jpeg")
+    if file_index < 0 or file_index >= len(examples) or image_format not in TILE_FORMATS:
+        abort(404)
+
+    hdf5_filename = examples[file_index]
+    tile_key = get_tile_key(file_identity=get_file_identity(hdf5_filename), index=index, image_format=image_format)
+    etag = get_tile_etag(tile_key=tile_key)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        tile_data = tile_cache.get(tile_key)
+        if tile_data is None:
+            tile_data = load_tiles(hdf5_filename=hdf5_filename, index=index, image_format=image_format)
+        if tile_data is None:
+            abort(404)
+        response = Response(tile_data, mimetype=TILE_FORMATS[image_format][1])
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "public, max-age={}".format(TILE_MAX_AGE)
+    return response
 
 
 if __name__ == "__main__":
@@ -0,0 +1,104 @@
+import boto3
+import contextlib
+import h5py as h5
+import io
+import numpy as np
+import os
+import pytest
+import sys
+
+try:
+    from moto import mock_aws
+except ImportError:
+    # moto < 5, the last releases that support python 3.7
+    from moto import mock_s3 as mock_aws
+
+from core.sagemaker import sagemaker_utils, upload_files
+
+
+BUCKET_NAME = "brick-bucket"
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    # a local S3 stand-in with an empty brick-bucket; no request leaves the process
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_SECURITY_TOKEN", "testing")
+    monkeypatch.setenv("AWS_SESSION_TOKEN", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+
+    # connections and validated buckets are cached per process, so every test starts without them
+    sagemaker_utils._connections.clear()
+    sagemaker_utils._validated_buckets.clear()
+
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET_NAME)
+        yield client
+
+    sagemaker_utils._connections.clear()
+    sagemaker_utils._validated_buckets.clear()
+
+
+def write_task_file(file_path, num_images, seed):
+    rng = np.random.RandomState(seed)
+    with h5.File(file_path, "w") as file:
+        file.create_dataset("images", data=rng.uniform(0, 3000, size=(num_images, 13, 8, 8)).astype(np.float32))
+        file.create_dataset("labels", data=rng.randint(0, 2, size=num_images).astype(np.float32))
+        file.create_dataset("bounds", data=rng.uniform(-10, 10, size=(num_images, 4)).astype(np.float32))
+
+
+@pytest.fixture
+def task_dir(tmp_path):
+    # task_0.hdf5 and task_1.hdf5, 5 and 3 images of 13 bands of 8 x 8 pixels
+    task_dir = tmp_path / "tasks"
+    task_dir.mkdir()
+    for i, num_images in enumerate([5, 3]):
+        write_task_file(file_path=str(task_dir / ("task_" + str(i) + ".hdf5")), num_images=num_images, seed=i)
+
+    return str(task_dir)
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    # images/task_0 and images/task_1 with 3 and 2 jpeg files, laid out like the exported images
+    image_dir = tmp_path / "images"
+    for i, num_images in enumerate([3, 2]):
+        sub_dir = image_dir / ("task_" + str(i))
+        sub_dir.mkdir(parents=True)
+        for j in range(num_images):
+            (sub_dir / ("task_" + str(i) + "_image_" + str(j) + ".jpeg")).write_bytes(os.urandom(100 + j))
+
+    return str(image_dir)
+
+
+def run_upload_files_script(monkeypatch, image_dir, options=()):
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["upload_files", "--img_dir", image_dir, "--bucket_name", BUCKET_NAME, "--workers", "2", "--max_retries", "0"]
+        + list(options),
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        upload_files.run_script()
+
+
+def get_bucket_objects(client, bucket_name=BUCKET_NAME):
+    bucket_objects = {}
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket_name):
+        for bucket_object in page.get("Contents", []):
+            key = bucket_object["Key"]
+            bucket_objects[key] = client.get_object(Bucket=bucket_name, Key=key)["Body"].read()
+
+    return bucket_objects
+
+
+def get_directory_files(directory):
+    directory_files = {}
+    for sub_dir, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            with open(os.path.join(sub_dir, file_name), "rb") as file:
+                directory_files[os.path.relpath(os.path.join(sub_dir, file_name), directory)] = file.read()
+
+    return directory_files
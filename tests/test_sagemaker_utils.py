@@ -0,0 +1,139 @@
+import contextlib
+import io
+import os
+import pytest
+import threading
+from botocore.exceptions import ClientError
+
+from core.sagemaker import sagemaker_utils
+from core.sagemaker.sagemaker_utils import bucket_exists, get_s3_client, open_bucket, upload_files_to_bucket
+from conftest import BUCKET_NAME, get_bucket_objects
+
+
+class FlakyClient:
+    # answers the first num_failures uploads of each key in failing_keys (every key if None) with a SlowDown
+    # error, like S3 under load, and passes every other upload (and every other call) to the real client
+    def __init__(self, client, num_failures, failing_keys=None):
+        self.client = client
+        self.num_failures = num_failures
+        self.failing_keys = failing_keys
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        with self.lock:
+            self.attempts[Key] = self.attempts.get(Key, 0) + 1
+            is_failing_key = self.failing_keys is None or Key in self.failing_keys
+            is_failure = is_failing_key and self.attempts[Key] <= self.num_failures
+
+        if is_failure:
+            raise ClientError({"Error": {"Code": "SlowDown", "Message": "Reduce your request rate."}}, "PutObject")
+        return self.client.upload_file(Filename=Filename, Bucket=Bucket, Key=Key, Config=Config)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def write_image_files(image_dir, num_files):
+    os.makedirs(image_dir)
+    file_names = []
+    for i in range(num_files):
+        file_name = os.path.join(image_dir, "task_0_image_" + str(i) + ".jpeg")
+        with open(file_name, "wb") as file:
+            file.write(os.urandom(100 + i))
+        file_names.append(file_name)
+
+    return file_names
+
+
+def upload(file_names, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return upload_files_to_bucket(
+            file_names=file_names, bucket_name=BUCKET_NAME, bucket_key_prefix="task_0/input", **kwargs
+        )
+
+
+def test_upload_files_to_bucket_uploads_every_file_concurrently(s3_client, tmp_path):
+    file_names = write_image_files(image_dir=str(tmp_path / "task_0"), num_files=20)
+    report = upload(file_names=file_names, workers=8)
+
+    assert report["num_files"] == 20
+    assert report["num_bytes"] == sum(os.path.getsize(file_name) for file_name in file_names)
+    assert report["failed_file_names"] == []
+
+    expected_objects = {}
+    for file_name in file_names:
+        with open(file_name, "rb") as file:
+            expected_objects["task_0/input/" + os.path.basename(file_name)] = file.read()
+    assert get_bucket_objects(client=s3_client) == expected_objects
+
+
+def test_upload_files_to_bucket_retries_failed_uploads(s3_client, tmp_path):
+    file_names = write_image_files(image_dir=str(tmp_path / "task_0"), num_files=5)
+    client = FlakyClient(client=s3_client, num_failures=2)
+    report = upload(file_names=file_names, client=client, workers=2, max_retries=2, backoff_seconds=0)
+
+    assert report["num_files"] == 5
+    assert report["failed_file_names"] == []
+    assert all(attempts == 3 for attempts in client.attempts.values())
+    assert len(get_bucket_objects(client=s3_client)) == 5
+
+
+def test_upload_files_to_bucket_reports_files_that_keep_failing(s3_client, tmp_path):
+    file_names = write_image_files(image_dir=str(tmp_path / "task_0"), num_files=5)
+    client = FlakyClient(client=s3_client, num_failures=10, failing_keys={"task_0/input/task_0_image_3.jpeg"})
+    report = upload(file_names=file_names, client=client, workers=2, max_retries=1, backoff_seconds=0)
+
+    assert report["num_files"] == 4
+    assert report["failed_file_names"] == [file_names[3]]
+    assert client.attempts["task_0/input/task_0_image_3.jpeg"] == 2
+    assert "task_0/input/task_0_image_3.jpeg" not in get_bucket_objects(client=s3_client)
+
+
+def count_head_bucket_requests(client):
+    head_bucket_requests = []
+    client.meta.events.register("before-call.s3.HeadBucket", lambda **kwargs: head_bucket_requests.append(1))
+    return head_bucket_requests
+
+
+def test_get_s3_client_is_cached_per_pool_size(s3_client):
+    assert get_s3_client() is get_s3_client()
+    assert get_s3_client(max_pool_connections=32) is get_s3_client(max_pool_connections=32)
+    assert get_s3_client(max_pool_connections=32) is not get_s3_client()
+
+
+def test_bucket_exists_sends_one_head_request(s3_client):
+    head_bucket_requests = count_head_bucket_requests(client=get_s3_client())
+
+    assert bucket_exists(bucket_name=BUCKET_NAME)
+    assert bucket_exists(bucket_name=BUCKET_NAME)
+    assert not bucket_exists(bucket_name="missing-bucket")
+    assert not bucket_exists(bucket_name="missing-bucket")
+    assert len(head_bucket_requests) == 2
+
+
+def test_open_bucket_rejects_a_missing_bucket(s3_client):
+    assert open_bucket(bucket_name=BUCKET_NAME).name == BUCKET_NAME
+    with pytest.raises(AssertionError):
+        open_bucket(bucket_name="missing-bucket")
+
+
+def test_uploads_of_several_directories_validate_the_bucket_once(s3_client, tmp_path):
+    head_bucket_requests = count_head_bucket_requests(client=get_s3_client())
+    for i in range(3):
+        file_names = write_image_files(image_dir=str(tmp_path / ("task_" + str(i))), num_files=2)
+        upload(file_names=file_names, workers=2)
+
+    assert len(head_bucket_requests) == 1
+
+
+def test_uploads_validate_the_bucket_with_the_given_client(s3_client, tmp_path):
+    client = get_s3_client(max_pool_connections=32)
+    head_bucket_requests = count_head_bucket_requests(client=client)
+    file_names = write_image_files(image_dir=str(tmp_path / "task_0"), num_files=2)
+    upload(file_names=file_names, client=client, workers=2)
+
+    # no client or resource of the default pool size is created next to the given one
+    assert len(head_bucket_requests) == 1
+    assert list(sagemaker_utils._connections) == [(os.getpid(), None, 32)]
+    assert "resource" not in sagemaker_utils._connections[(os.getpid(), None, 32)]
@@ -0,0 +1,43 @@
+import numpy as np
+
+from core.utils.spatial_index import GridSpatialIndex
+
+
+def get_tiling_index(num_tiles):
+    # a contiguous num_tiles x num_tiles tiling of unit tiles, stored as (lon, lat, lon, lat) bounds
+    boxes = np.array([[x, y, x + 1, y + 1] for x in range(num_tiles) for y in range(num_tiles)], dtype=np.float64)
+    return GridSpatialIndex(
+        boxes=boxes,
+        file_indices=np.zeros(boxes.shape[0]),
+        row_indices=np.arange(boxes.shape[0]),
+        file_names=["task_0.hdf5"],
+        file_mtimes=[0],
+    )
+
+
+def test_adjacent_tiles_do_not_overlap():
+    spatial_index = get_tiling_index(num_tiles=4)
+
+    # the tile itself overlaps, the tiles sharing an edge or a corner with it do not
+    query_indices, box_indices = spatial_index.query_overlaps(boxes=[[1, 1, 2, 2]])
+    assert query_indices.tolist() == [0]
+    np.testing.assert_array_equal(spatial_index.boxes[box_indices], [[1, 1, 2, 2]])
+
+    _, box_indices = spatial_index.query_overlaps(boxes=[[0, 0, 1, 1]], min_overlap=0.5)
+    np.testing.assert_array_equal(spatial_index.boxes[box_indices], [[0, 0, 1, 1]])
+
+
+def test_shifted_tiles_overlap_every_tile_they_cover():
+    spatial_index = get_tiling_index(num_tiles=4)
+
+    _, box_indices = spatial_index.query_overlaps(boxes=[[0.5, 0.5, 1.5, 1.5]])
+    assert sorted(map(tuple, spatial_index.boxes[box_indices].tolist())) == [
+        (0, 0, 1, 1),
+        (0, 1, 1, 2),
+        (1, 0, 2, 1),
+        (1, 1, 2, 2),
+    ]
+
+    # a quarter of each covered tile
+    _, box_indices = spatial_index.query_overlaps(boxes=[[0.5, 0.5, 1.5, 1.5]], min_overlap=0.5)
+    assert box_indices.shape[0] == 0
@@ -0,0 +1,85 @@
+import contextlib
+import io
+import os
+import pytest
+import sys
+from botocore.exceptions import ClientError
+
+from core.hdf5_handling.retrieve_images import export_images_from_regex
+from core.sagemaker import stream_images
+from core.sagemaker.stream_images import stream_images_from_regex
+from conftest import BUCKET_NAME, get_bucket_objects, get_directory_files
+
+
+def stream_task_dir(task_dir, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return stream_images_from_regex(
+            regex=os.path.join(task_dir, "*.hdf5"), bucket_name=BUCKET_NAME, block_size=2, **kwargs
+        )
+
+
+def test_streamed_images_match_exported_images(s3_client, task_dir, tmp_path):
+    failed_file_names = stream_task_dir(task_dir=task_dir, workers=4, max_in_flight=3)
+    assert failed_file_names == []
+
+    image_dir = str(tmp_path / "images")
+    with contextlib.redirect_stdout(io.StringIO()):
+        export_images_from_regex(regex=os.path.join(task_dir, "*.hdf5"), image_dir=image_dir, block_size=2)
+
+    # <task>/<task>_image_<i>.jpeg on disk is <task>/input/<task>_image_<i>.jpeg in the bucket
+    expected_objects = {}
+    for image_path, data in get_directory_files(directory=image_dir).items():
+        sub_dir, image_name = os.path.split(image_path)
+        expected_objects[os.path.join(sub_dir, "input", image_name)] = data
+
+    assert len(expected_objects) == 8
+    assert get_bucket_objects(client=s3_client) == expected_objects
+
+
+def test_skip_existing_uploads_only_missing_images(s3_client, task_dir, monkeypatch):
+    stream_task_dir(task_dir=task_dir)
+    s3_client.delete_object(Bucket=BUCKET_NAME, Key="task_1/input/task_1_image_2.jpeg")
+
+    uploaded_keys = []
+    upload_bytes_with_retries = stream_images.upload_bytes_with_retries
+
+    def record_upload(**kwargs):
+        uploaded_keys.append(kwargs["filekey"])
+        return upload_bytes_with_retries(**kwargs)
+
+    monkeypatch.setattr(stream_images, "upload_bytes_with_retries", record_upload)
+    assert stream_task_dir(task_dir=task_dir, skip_existing=True) == []
+
+    assert uploaded_keys == ["task_1/input/task_1_image_2.jpeg"]
+    assert len(get_bucket_objects(client=s3_client)) == 8
+
+
+def run_stream_images_script(monkeypatch, task_dir):
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["stream_images", "--regex", os.path.join(task_dir, "*.hdf5"), "--bucket_name", BUCKET_NAME, "--workers", "2"],
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        stream_images.run_script()
+
+
+def test_run_script_succeeds_when_every_image_is_uploaded(s3_client, task_dir, monkeypatch):
+    run_stream_images_script(monkeypatch=monkeypatch, task_dir=task_dir)
+    assert len(get_bucket_objects(client=s3_client)) == 8
+
+
+def test_run_script_exits_non_zero_when_uploads_fail(s3_client, task_dir, monkeypatch):
+    upload_bytes_with_retries = stream_images.upload_bytes_with_retries
+
+    def fail_one_upload(**kwargs):
+        if kwargs["filekey"] == "task_0/input/task_0_image_1.jpeg":
+            raise ClientError({"Error": {"Code": "SlowDown", "Message": "Reduce your request rate."}}, "PutObject")
+        return upload_bytes_with_retries(**kwargs)
+
+    monkeypatch.setattr(stream_images, "upload_bytes_with_retries", fail_one_upload)
+    with pytest.raises(SystemExit) as exit_info:
+        run_stream_images_script(monkeypatch=monkeypatch, task_dir=task_dir)
+
+    assert exit_info.value.code == 1
+    assert len(get_bucket_objects(client=s3_client)) == 7
@@ -0,0 +1,34 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from core.sagemaker import sagemaker_utils
+from conftest import get_bucket_objects, get_directory_files, run_upload_files_script
+
+
+def test_run_script_uploads_every_subdirectory(s3_client, image_dir, monkeypatch):
+    run_upload_files_script(monkeypatch=monkeypatch, image_dir=image_dir)
+
+    # <task>/<task>_image_<i>.jpeg on disk is <task>/input/<task>_image_<i>.jpeg in the bucket
+    expected_objects = {}
+    for image_path, data in get_directory_files(directory=image_dir).items():
+        sub_dir, image_name = image_path.split("/")
+        expected_objects[sub_dir + "/input/" + image_name] = data
+
+    assert len(expected_objects) == 5
+    assert get_bucket_objects(client=s3_client) == expected_objects
+
+
+def test_run_script_exits_non_zero_when_uploads_fail(s3_client, image_dir, monkeypatch):
+    upload_file_with_retries = sagemaker_utils.upload_file_with_retries
+
+    def fail_one_upload(**kwargs):
+        if kwargs["filekey"] == "task_1/input/task_1_image_0.jpeg":
+            raise ClientError({"Error": {"Code": "SlowDown", "Message": "Reduce your request rate."}}, "PutObject")
+        return upload_file_with_retries(**kwargs)
+
+    monkeypatch.setattr(sagemaker_utils, "upload_file_with_retries", fail_one_upload)
+    with pytest.raises(SystemExit) as exit_info:
+        run_upload_files_script(monkeypatch=monkeypatch, image_dir=image_dir)
+
+    assert exit_info.value.code == 1
+    assert len(get_bucket_objects(client=s3_client)) == 4
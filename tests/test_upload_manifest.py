@@ -0,0 +1,119 @@
+import json
+import os
+import pytest
+from botocore.exceptions import ClientError
+
+from core.sagemaker import sagemaker_utils
+from core.sagemaker.upload_manifest import MANIFEST_FILE_NAME, UploadManifest
+from conftest import BUCKET_NAME, get_bucket_objects, run_upload_files_script
+
+
+@pytest.fixture
+def uploaded_keys(monkeypatch):
+    # keys passed to the upload engine, in any order
+    uploaded_keys = []
+    upload_file_with_retries = sagemaker_utils.upload_file_with_retries
+
+    def record_upload(**kwargs):
+        uploaded_keys.append(kwargs["filekey"])
+        return upload_file_with_retries(**kwargs)
+
+    monkeypatch.setattr(sagemaker_utils, "upload_file_with_retries", record_upload)
+    return uploaded_keys
+
+
+def sync(monkeypatch, image_dir, reconcile=False):
+    options = ["--sync", "--reconcile"] if reconcile else ["--sync"]
+    run_upload_files_script(monkeypatch=monkeypatch, image_dir=image_dir, options=options)
+
+
+def get_manifest_keys(image_dir):
+    with open(os.path.join(image_dir, MANIFEST_FILE_NAME), "r") as manifest_file:
+        return sorted(json.load(manifest_file)["buckets"][BUCKET_NAME])
+
+
+def test_second_sync_skips_every_uploaded_file(s3_client, image_dir, monkeypatch, uploaded_keys):
+    sync(monkeypatch=monkeypatch, image_dir=image_dir)
+    assert len(uploaded_keys) == 5
+    assert get_manifest_keys(image_dir=image_dir) == sorted(get_bucket_objects(client=s3_client))
+
+    del uploaded_keys[:]
+    sync(monkeypatch=monkeypatch, image_dir=image_dir)
+    assert uploaded_keys == []
+
+
+def test_sync_uploads_a_file_whose_content_changed(s3_client, image_dir, monkeypatch, uploaded_keys):
+    sync(monkeypatch=monkeypatch, image_dir=image_dir)
+
+    # same size, new content and mtime
+    image_path = os.path.join(image_dir, "task_0", "task_0_image_1.jpeg")
+    stat = os.stat(image_path)
+    with open(image_path, "wb") as image_file:
+        image_file.write(os.urandom(stat.st_size))
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    # a file touched without changing its content is skipped after checking its md5
+    touched_path = os.path.join(image_dir, "task_1", "task_1_image_0.jpeg")
+    touched_stat = os.stat(touched_path)
+    os.utime(touched_path, ns=(touched_stat.st_atime_ns, touched_stat.st_mtime_ns + 10**9))
+
+    del uploaded_keys[:]
+    sync(monkeypatch=monkeypatch, image_dir=image_dir)
+
+    assert uploaded_keys == ["task_0/input/task_0_image_1.jpeg"]
+    with open(image_path, "rb") as image_file:
+        assert get_bucket_objects(client=s3_client)["task_0/input/task_0_image_1.jpeg"] == image_file.read()
+
+
+def test_failed_files_are_left_out_of_the_manifest(s3_client, image_dir, monkeypatch, uploaded_keys):
+    upload_file_with_retries = sagemaker_utils.upload_file_with_retries
+
+    def fail_one_upload(**kwargs):
+        if kwargs["filekey"] == "task_0/input/task_0_image_2.jpeg":
+            raise ClientError({"Error": {"Code": "SlowDown", "Message": "Reduce your request rate."}}, "PutObject")
+        return upload_file_with_retries(**kwargs)
+
+    monkeypatch.setattr(sagemaker_utils, "upload_file_with_retries", fail_one_upload)
+    with pytest.raises(SystemExit):
+        sync(monkeypatch=monkeypatch, image_dir=image_dir)
+    assert "task_0/input/task_0_image_2.jpeg" not in get_manifest_keys(image_dir=image_dir)
+    assert len(get_manifest_keys(image_dir=image_dir)) == 4
+
+    # the next sync uploads only the file that failed
+    monkeypatch.setattr(sagemaker_utils, "upload_file_with_retries", upload_file_with_retries)
+    del uploaded_keys[:]
+    sync(monkeypatch=monkeypatch, image_dir=image_dir)
+    assert uploaded_keys == ["task_0/input/task_0_image_2.jpeg"]
+    assert get_manifest_keys(image_dir=image_dir) == sorted(get_bucket_objects(client=s3_client))
+
+
+def test_reconcile_uploads_objects_deleted_from_the_bucket(s3_client, image_dir, monkeypatch, uploaded_keys):
+    sync(monkeypatch=monkeypatch, image_dir=image_dir)
+    s3_client.delete_object(Bucket=BUCKET_NAME, Key="task_1/input/task_1_image_1.jpeg")
+
+    # without reconcile the manifest is trusted
+    del uploaded_keys[:]
+    sync(monkeypatch=monkeypatch, image_dir=image_dir)
+    assert uploaded_keys == []
+
+    sync(monkeypatch=monkeypatch, image_dir=image_dir, reconcile=True)
+    assert uploaded_keys == ["task_1/input/task_1_image_1.jpeg"]
+    assert len(get_bucket_objects(client=s3_client)) == 5
+
+
+def test_manifest_records_are_kept_per_bucket(image_dir):
+    manifest_path = os.path.join(image_dir, MANIFEST_FILE_NAME)
+    image_path = os.path.join(image_dir, "task_0", "task_0_image_0.jpeg")
+    manifest = UploadManifest(manifest_path=manifest_path, bucket_name=BUCKET_NAME)
+    manifest.update(filekey="task_0/input/task_0_image_0.jpeg", file_name=image_path)
+    manifest.save()
+
+    files_to_upload, _ = UploadManifest(manifest_path=manifest_path, bucket_name=BUCKET_NAME).select_files_to_upload(
+        file_names=[image_path], filekeys=["task_0/input/task_0_image_0.jpeg"]
+    )
+    assert files_to_upload == []
+
+    files_to_upload, _ = UploadManifest(manifest_path=manifest_path, bucket_name="other-bucket").select_files_to_upload(
+        file_names=[image_path], filekeys=["task_0/input/task_0_image_0.jpeg"]
+    )
+    assert [file_name for file_name, _, _ in files_to_upload] == [image_path]
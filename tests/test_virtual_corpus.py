@@ -0,0 +1,53 @@
+import h5py as h5
+import numpy as np
+import os
+
+from core.utils.virtual_corpus import VirtualCorpus
+from conftest import write_task_file
+
+
+def write_empty_task_file(file_path):
+    # what the two-list dedup writes when it removes every row of a file
+    with h5.File(file_path, "w") as file:
+        for key in ["images", "labels", "bounds"]:
+            file.create_dataset(key, data=np.array([]))
+
+
+def read_dataset(file_name, key):
+    with h5.File(file_name, "r") as file:
+        return file[key][:]
+
+
+def test_virtual_corpus_skips_files_without_rows(task_dir):
+    # task_0 and task_1 hold 5 and 3 rows, task_00 (matched first) and task_2 hold none
+    write_empty_task_file(file_path=os.path.join(task_dir, "task_00.hdf5"))
+    write_empty_task_file(file_path=os.path.join(task_dir, "task_2.hdf5"))
+
+    expected_dsets = {}
+    for key in ["images", "labels", "bounds"]:
+        file_names = [os.path.join(task_dir, "task_" + str(i) + ".hdf5") for i in range(2)]
+        expected_dsets[key] = np.concatenate([read_dataset(file_name=file_name, key=key) for file_name in file_names])
+
+    with VirtualCorpus.from_regex(regex=os.path.join(task_dir, "*.hdf5")) as corpus:
+        assert len(corpus) == 8
+        assert corpus["images"].shape == (8, 13, 8, 8)
+        assert corpus["bounds"].shape == (8, 4)
+        assert corpus["images"].dtype == np.float32
+
+        dsets = corpus.read_slice(start=0, end=len(corpus))
+        row_indices = np.array([7, 0, 5, 4, 0])
+        rows = corpus.read_rows(global_indices=row_indices, keys=["bounds"])
+
+    for key in expected_dsets:
+        assert dsets[key].dtype == np.float32
+        np.testing.assert_array_equal(dsets[key], expected_dsets[key])
+    np.testing.assert_array_equal(rows["bounds"], expected_dsets["bounds"][row_indices])
+
+
+def test_virtual_corpus_of_empty_files_has_no_rows(tmp_path):
+    write_empty_task_file(file_path=str(tmp_path / "task_0.hdf5"))
+    write_task_file(file_path=str(tmp_path / "task_1.hdf5"), num_images=0, seed=0)
+
+    with VirtualCorpus.from_regex(regex=str(tmp_path / "*.hdf5")) as corpus:
+        assert len(corpus) == 0
+        assert corpus.read_slice(start=0, end=len(corpus))["images"].shape[0] == 0